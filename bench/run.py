@@ -0,0 +1,245 @@
+"""
+This module runs the benchmarks against a synthetic site (see `server.py`)
+and saves the results as JSON, so runs on different commits can be compared.
+Run it from the `py-downloader` directory:
+
+    py -m bench.run --output before.json
+    py -m bench.run --output after.json --compare before.json
+
+Every benchmark runs in a fresh process, so its peak RSS is not affected by
+the benchmarks before it. The latency percentiles are measured by the server,
+from reading a request to sending its response.
+"""
+
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from tempfile import TemporaryDirectory
+from typing import Callable
+
+import httpx
+
+from bench.server import SiteConfig, SyntheticServer
+from src.crawler import Crawler, UrlFilterer
+from src.file_downloader import download_many
+from src.parsing import Parser
+from src.probe import clear_cache, probe_many
+from src.sharding import crawl_sharded
+from src.simple_crawler import crawl
+
+
+@dataclass
+class Options:
+    """
+    attributes:
+        depth: The depth both crawlers search to.
+        workers: The number of concurrent workers of the crawler, the downloader and the prober.
+        downloads: The number of images downloaded and probed.
+        parse_processes: The number of processes `Crawler` parses pages in (0 parses in the event loop).
+        shards: The number of processes of the sharded crawl.
+    """
+    depth: int = 4
+    workers: int = 16
+    downloads: int = 100
+    parse_processes: int = 0
+    shards: int = 4
+
+
+def bench_simple_crawler(server: SyntheticServer, options: Options) -> dict[str, float]:
+    start = time.perf_counter()
+    _to_download, visited, *_ = crawl(server.page_url(0), options.depth, "img")
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "pages": visited, "pages_per_s": visited / seconds}
+
+
+def bench_crawler(server: SyntheticServer, options: Options) -> dict[str, float]:
+    filterer = UrlFilterer(lambda x: True, lambda x: x in ["http", "https"], lambda x: True)
+
+    async def run() -> Crawler:
+        limits = httpx.Limits(max_connections=options.workers)
+        async with httpx.AsyncClient(limits=limits) as client:
+            crawler = Crawler(
+                client, [server.page_url(0)], filterer, options.workers, options.depth, -1,
+                # a single host which is allowed to be crawled as fast as possible
+                host_rate=1e6, max_per_host=options.workers, parser=Parser("bs4", "img", processes=options.parse_processes),
+            )
+            await crawler.run()
+        return crawler
+
+    start = time.perf_counter()
+    crawler = asyncio.run(run())
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "pages": crawler.parsed, "pages_per_s": crawler.parsed / seconds}
+
+
+def any_host_filter() -> UrlFilterer:
+    return UrlFilterer(lambda x: True, lambda x: x in ["http", "https"], lambda x: True)
+
+
+def bench_sharded_crawler(server: SyntheticServer, options: Options) -> dict[str, float]:
+    # every shard crawls its hosts as fast as possible, like `bench_crawler`; use `--hosts` to spread the site out
+    result = crawl_sharded(
+        [server.page_url(0)], any_host_filter, options.shards, options.workers, options.depth,
+        host_rate=1e6, max_per_host=options.workers,
+    )
+    return {"seconds": result.seconds, "pages": result.parsed, "pages_per_s": result.parsed / result.seconds}
+
+
+def bench_download(server: SyntheticServer, options: Options) -> dict[str, float]:
+    urls = [server.image_url(i % server.config.distinct_images) for i in range(options.downloads)]
+    with TemporaryDirectory() as path:
+        start = time.perf_counter()
+        results = download_many(urls, path, workers=options.workers, per_host=options.workers)
+        seconds = time.perf_counter() - start
+    size = sum(result.size for result in results)
+    return {
+        "seconds": seconds,
+        "files": sum(result.status == "downloaded" for result in results),
+        "files_per_s": len(results) / seconds,
+        "mb_per_s": size / seconds / 1e6,
+    }
+
+
+def bench_probe(server: SyntheticServer, options: Options) -> dict[str, float]:
+    urls = [server.image_url(i) for i in range(min(options.downloads, server.config.distinct_images))]
+    clear_cache()
+    start = time.perf_counter()
+    infos = probe_many(urls, workers=options.workers)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "files": len(infos), "files_per_s": len(infos) / seconds}
+
+
+BENCHMARKS: dict[str, Callable[[SyntheticServer, Options], dict[str, float]]] = {
+    "simple_crawler": bench_simple_crawler,
+    "crawler": bench_crawler,
+    "sharded_crawler": bench_sharded_crawler,
+    "download": bench_download,
+    "probe": bench_probe,
+}
+HIGHER_IS_BETTER = ("pages_per_s", "files_per_s", "mb_per_s")
+LOWER_IS_BETTER = ("latency_p50", "latency_p99", "peak_rss_mib")
+
+
+def peak_rss_mib() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def percentile(values: list[float], p: int) -> float | None:
+    if not values: return None
+    if len(values) == 1: return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def run_benchmark(name: str, config: SiteConfig, options: Options) -> dict[str, float]:
+    """Runs a single benchmark against a new server in the current process."""
+    with SyntheticServer(config) as server:
+        result = BENCHMARKS[name](server, options)
+    result.update({
+        "requests": server.requests,
+        "errors": server.errors,
+        "latency_p50": percentile(server.latencies, 50),
+        "latency_p99": percentile(server.latencies, 99),
+        "peak_rss_mib": peak_rss_mib(),
+    })
+    return result
+
+
+def run_isolated(name: str, config: SiteConfig, options: Options) -> dict[str, float]:
+    """Runs a single benchmark in a fresh process."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, name, config, options).result()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Prints the change of every metric and returns the names of the metrics which got worse by more than `tolerance`."""
+    regressions = []
+    for name, result in results["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old is None: continue
+        for metric, value in result.items():
+            if metric not in HIGHER_IS_BETTER + LOWER_IS_BETTER or not value or not old.get(metric): continue
+            change = value / old[metric] - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = " REGRESSION" if worse > tolerance else ""
+            print(f"{name:>16} {metric:<14} {old[metric]:>12.4g} -> {value:>12.4g} ({change:+.1%}){flag}")
+            if flag: regressions.append(f"{name}.{metric}")
+    return regressions
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> int:
+    defaults, default_options = SiteConfig(), Options()
+    parser = argparse.ArgumentParser(description="Benchmarks the crawlers and the downloader against a synthetic site.")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="The benchmarks to run.")
+    parser.add_argument("--output", default="bench_output.json", help="Where the results are saved as JSON.")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="The relative change counted as a regression.")
+    parser.add_argument("--pages", type=int, default=defaults.pages)
+    parser.add_argument("--fanout", type=int, default=defaults.fanout)
+    parser.add_argument("--page-size", type=int, default=defaults.page_size)
+    parser.add_argument("--images", type=int, default=defaults.images)
+    parser.add_argument("--distinct-images", type=int, default=defaults.distinct_images)
+    parser.add_argument("--image-size", type=int, default=defaults.image_size)
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--hosts", type=int, default=defaults.hosts)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--depth", type=int, default=default_options.depth)
+    parser.add_argument("--workers", type=int, default=default_options.workers)
+    parser.add_argument("--downloads", type=int, default=default_options.downloads)
+    parser.add_argument("--parse-processes", type=int, default=default_options.parse_processes)
+    parser.add_argument("--shards", type=int, default=default_options.shards)
+    args = parser.parse_args(argv)
+
+    config = SiteConfig(
+        args.pages, args.fanout, args.page_size, args.images, args.distinct_images,
+        args.image_size, args.latency, args.jitter, args.error_rate, args.hosts, args.seed,
+    )
+    options = Options(args.depth, args.workers, args.downloads, args.parse_processes, args.shards)
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": asdict(config),
+        "options": asdict(options),
+        "results": {},
+    }
+    for name in args.only:
+        print(f"Running {name}...")
+        results["results"][name] = result = run_isolated(name, config, options)
+        print("    " + ", ".join(f"{metric}: {value:.4g}" for metric, value in result.items() if value is not None))
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved the results to {args.output}")
+
+    if args.compare is None: return 0
+    with open(args.compare) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions: print(f"{len(regressions)} metric{'' if len(regressions) == 1 else 's'} regressed: {', '.join(regressions)}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
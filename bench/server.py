@@ -0,0 +1,194 @@
+"""
+This module implements a local HTTP server which generates synthetic sites
+for the benchmarks.
+
+Every page `/pages/<i>.html` links to `fanout` other pages and shows
+`images` images `/images/<j>.png`; both are picked by a random generator
+seeded with the page number, so a site is the same every time it is served.
+Responses are delayed by `latency` ± `jitter` seconds and fail with a 500
+response at the given `error_rate`. Images answer HEAD and `Range` requests,
+like the static file servers the downloader is usually pointed at. With
+`hosts` greater than 1 the pages are spread over the loopback addresses
+127.0.0.1 to 127.0.0.<hosts>, so crawls over several hosts (e.g. sharded
+crawls) can be measured.
+
+The server runs its own event loop in a background thread, so it can be used
+by blocking code (`requests`, `asyncio.run`) as well as by async code.
+"""
+
+
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class SiteConfig:
+    """
+    attributes:
+        pages: The number of pages of the site.
+        fanout: The number of links on every page.
+        page_size: The size of every page in bytes (padded with text).
+        images: The number of images shown on every page.
+        distinct_images: The number of different images; pages share images when it is smaller than `pages * images`.
+        image_size: The size of every image in bytes.
+        latency: The number of seconds every response is delayed by.
+        jitter: The maximum number of seconds added to or removed from the latency.
+        error_rate: The probability that a request is answered with a 500 response.
+        hosts: The number of hosts the pages are spread over; page i belongs to 127.0.0.<i % hosts + 1>.
+        seed: Makes the site and the errors reproducible.
+    """
+    pages: int = 500
+    fanout: int = 8
+    page_size: int = 16 * 2 ** 10
+    images: int = 4
+    distinct_images: int = 200
+    image_size: int = 256 * 2 ** 10
+    latency: float = 0.005
+    jitter: float = 0.002
+    error_rate: float = 0.0
+    hosts: int = 1
+    seed: int = 0
+
+
+class SyntheticSite:
+    def __init__(self, config: SiteConfig) -> None:
+        """Generates the pages and images of a site.
+
+        Args:
+            config (SiteConfig): The shape of the site.
+        """
+        self.config = config
+        self.image = bytes(random.Random(config.seed).getrandbits(8) for _ in range(min(config.image_size, 2 ** 16)))
+        self.image = (self.image * (config.image_size // max(1, len(self.image)) + 1))[:config.image_size]
+
+    def page(self, number: int, port: int = 0) -> bytes:
+        config = self.config
+        rng = random.Random(config.seed * 1_000_003 + number)
+        links = [rng.randrange(config.pages) for _ in range(config.fanout)]
+        images = [rng.randrange(config.distinct_images) for _ in range(config.images)] if config.distinct_images else []
+        if config.hosts > 1: hrefs = [f"http://127.0.0.{link % config.hosts + 1}:{port}/pages/{link}.html" for link in links]
+        else: hrefs = [f"/pages/{link}.html" for link in links]
+        body = "".join(f'<a href="{href}">page {link}</a>\n' for href, link in zip(hrefs, links))
+        body += "".join(f'<img src="/images/{image}.png"/>\n' for image in images)
+        html = f"<!DOCTYPE html>\n<html><head><title>Page {number}</title></head><body>\n{body}<p>"
+        end = "</p></body></html>\n"
+        padding = max(0, config.page_size - len(html) - len(end))
+        return (html + "lorem ipsum " * (padding // 12) + " " * (padding % 12) + end).encode()
+
+
+class SyntheticServer:
+    def __init__(self, config: SiteConfig | None = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        """Creates a server for a synthetic site; it runs while it is used as a context manager.
+
+        Args:
+            config (SiteConfig | None): The shape of the site.
+            host (str): The address the server listens on.
+            port (int): The port the server listens on; 0 picks a free one.
+        """
+        self.config = config or SiteConfig()
+        self.site = SyntheticSite(self.config)
+        self.host = host
+        self.port = port
+        self.latencies: list[float] = []  # seconds from reading a request to sending its response
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._rng = random.Random(self.config.seed)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._servers: list[asyncio.Server] = []
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def page_url(self, number: int) -> str:
+        return f"{self.url}/pages/{number}.html"
+
+    def image_url(self, number: int) -> str:
+        return f"{self.url}/images/{number}.png"
+
+    def __enter__(self) -> "SyntheticServer":
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            # several hosts are served by listening on each of their loopback addresses, on the same port
+            hosts = [f"127.0.0.{i + 1}" for i in range(self.config.hosts)] if self.config.hosts > 1 else [self.host]
+            for host in hosts:
+                server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, self.port, backlog=1024))
+                self.port = server.sockets[0].getsockname()[1]
+                self._servers.append(server)
+            started.set()
+            self._loop.run_forever()
+            for server in self._servers: server.close()
+            self._loop.run_until_complete(self._close_connections())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _close_connections(self) -> None:
+        """Stops the handlers of open keep-alive connections, which are still waiting for requests."""
+        handlers = asyncio.all_tasks() - {asyncio.current_task()}
+        for handler in handlers: handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                start = time.perf_counter()
+                method, path, _version = request_line.decode("latin-1").split(" ", 2)
+                status, response_headers, body = self._respond(path, headers)
+                config = self.config
+                delay = config.latency + self._rng.uniform(-config.jitter, config.jitter)
+                if delay > 0: await asyncio.sleep(delay)
+
+                head = f"HTTP/1.1 {status}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+                writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode("latin-1"))
+                if method != "HEAD": writer.write(body)
+                await writer.drain()
+                self.latencies.append(time.perf_counter() - start)
+                self.requests += 1
+                self.bytes_sent += len(body) if method != "HEAD" else 0
+                if headers.get("connection", "").lower() == "close": break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, path: str, headers: dict[str, str]) -> tuple[str, dict[str, str], bytes]:
+        """The status, headers and body of the response to a request."""
+        config = self.config
+        if config.error_rate and self._rng.random() < config.error_rate:
+            self.errors += 1
+            return "500 Internal Server Error", {}, b""
+        kind, _, name = path.lstrip("/").partition("/")
+        number = name.split(".", 1)[0]
+        if kind == "pages" and number.isdigit() and int(number) < config.pages:
+            return "200 OK", {"Content-Type": "text/html; charset=utf-8"}, self.site.page(int(number), self.port)
+        if kind == "images" and number.isdigit() and int(number) < config.distinct_images:
+            body = self.site.image
+            response_headers = {"Content-Type": "image/png", "Accept-Ranges": "bytes", "ETag": f'"{number}"'}
+            byte_range = headers.get("range")
+            if byte_range is None or not byte_range.startswith("bytes="): return "200 OK", response_headers, body
+            first, _, last = byte_range.removeprefix("bytes=").partition("-")
+            first, last = int(first or 0), min(int(last or len(body) - 1), len(body) - 1)
+            response_headers["Content-Range"] = f"bytes {first}-{last}/{len(body)}"
+            return "206 Partial Content", response_headers, body[first:last + 1]
+        return "404 Not Found", {}, b""
@@ -1,11 +1,18 @@
-import requests
+from src.probe import probe_many
 
 
-def confirm(to_download: list[str], num_sites_visited: int, min_on_page: int, max_on_page: int) -> bool:
-    download_size = 0
-    for url in to_download:
-        resp = requests.head(url)
-        download_size += int(resp.headers.get("Content-Length"))
+def confirm(
+        to_download: list[str], 
+        num_sites_visited: int, 
+        min_on_page: int, 
+        max_on_page: int, 
+        workers: int = 16, 
+        timeout: float = 10.0
+    ) -> bool:
+    infos = probe_many(to_download, workers=workers, timeout=timeout)
+    sizes = [infos[url].size for url in to_download]
+    download_size = sum(size for size in sizes if size is not None)
+    num_unknown = sizes.count(None)
     
     conversion: dict[int, str] = {
         2 ** 40: "TiB",
@@ -21,8 +28,9 @@ def confirm(to_download: list[str], num_sites_visited: int, min_on_page: int, ma
         unit = unit_name
         break
     val = "\n\t"
+    unknown = f" ({num_unknown} of the files have an unknown size)" if num_unknown else ""
     msg = f'''\
-Found {len(to_download)} files to download with a total download size of {size:.3f} {unit} after visiting {num_sites_visited} pages. 
+Found {len(to_download)} files to download with a total download size of {size:.3f} {unit}{unknown} after visiting {num_sites_visited} pages. 
         {val.join(to_download[0:2] + ["..."] + to_download[-2:] if len(to_download) > 5 else to_download)}
 The minimum number of elements matching the CSS selector on the visited pages is {min_on_page:,} and the maximum is {max_on_page:,}.
 Proceed to download (yes, no, y, n)? '''
@@ -0,0 +1,158 @@
+"""
+This module keeps a persistent index of downloaded files, so recurring
+downloads do not transfer or store the same content twice.
+
+- `files` maps the content hash of every downloaded file to where it is
+    stored. A file which was changed or removed since it was indexed (its size
+    or modification time differs) is ignored and dropped from the index.
+- `urls` maps every downloaded url to the validators (`ETag`,
+    `Last-Modified`), size and hash of its last response, which lets an
+    unchanged file be skipped before its body is transferred.
+"""
+
+
+import hashlib
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Mapping
+
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def new_hash() -> hashlib.blake2b:
+    return hashlib.blake2b()
+
+
+def hash_file(path: str) -> str:
+    """The content hash of a file on disk, as used by the index."""
+    digest = new_hash()
+    with open(path, "rb") as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class UrlRecord:
+    """
+    The last download of a url.
+
+    attributes:
+        etag: The `ETag` of the response, if any.
+        last_modified: The `Last-Modified` date of the response, if any.
+        size: The number of bytes of the file.
+        hash: The content hash of the file.
+        path: Where the file was stored.
+    """
+    etag: str | None
+    last_modified: str | None
+    size: int
+    hash: str
+    path: str
+
+    def validators(self) -> dict[str, str]:
+        """The headers which make a request conditional on the file having changed."""
+        headers = {}
+        if self.etag is not None: headers["If-None-Match"] = self.etag
+        if self.last_modified is not None: headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def unchanged(self, headers: Mapping[str, str]) -> bool:
+        """Checks if a response has the same validators and size as the recorded one, i.e. serves the same file."""
+        if self.etag is None and self.last_modified is None: return False
+        size = headers.get("content-length")
+        return (
+            headers.get("etag") == self.etag
+            and headers.get("last-modified") == self.last_modified
+            and size is not None and size.isdigit() and int(size) == self.size
+        )
+
+
+class ContentIndex:
+    def __init__(self, path: str) -> None:
+        """Opens (or creates) the index. It can be shared by parallel downloads.
+
+        Args:
+            path (str): The location of the database file.
+        """
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS content ON files (hash);
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                path TEXT NOT NULL
+            );
+        """)
+        self.lock = threading.Lock()
+
+    def _valid(self, path: str, size: int, mtime: int) -> bool:
+        """Checks if the file at `path` is still the indexed one, dropping it from the index if it is not."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is not None and stat.st_size == size and stat.st_mtime_ns == mtime: return True
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        return False
+
+    def get(self, url: str) -> UrlRecord | None:
+        """The last download of the url, or None if there is none or its file was changed since."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT u.etag, u.last_modified, u.size, u.hash, u.path, f.size, f.mtime FROM urls u "
+                "JOIN files f ON f.path = u.path AND f.hash = u.hash WHERE u.url = ?", (url,)
+            ).fetchone()
+            if row is None or not self._valid(row[4], row[5], row[6]): return None
+            return UrlRecord(*row[:5])
+
+    def path_of(self, hash: str) -> str | None:
+        """The location of a file with the given content hash, or None if there is none."""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, size, mtime FROM files WHERE hash = ?", (hash,)).fetchall()
+            for path, size, mtime in rows:
+                if self._valid(path, size, mtime): return path
+        return None
+
+    def hash_of(self, path: str) -> str:
+        """The content hash of the file at `path`, taken from the index if it is up to date."""
+        with self.lock:
+            row = self.conn.execute("SELECT hash, size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and self._valid(path, row[1], row[2]): return row[0]
+        hash = hash_file(path)
+        self.add_file(path, hash)
+        return hash
+
+    def add_file(self, path: str, hash: str) -> None:
+        stat = os.stat(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, hash, size, mtime) VALUES (?, ?, ?, ?)",
+                (path, hash, stat.st_size, stat.st_mtime_ns),
+            )
+
+    def record(self, url: str, headers: Mapping[str, str], hash: str, path: str) -> None:
+        """Stores that the url was downloaded to `path` with the given content hash."""
+        self.add_file(path, hash)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls (url, etag, last_modified, size, hash, path) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, headers.get("etag"), headers.get("last-modified"), os.path.getsize(path), hash, path),
+            )
+
+    def close(self) -> None:
+        self.conn.close()
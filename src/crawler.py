@@ -2,17 +2,8 @@
 This module implements an asynchronous crawler.
 
 TODO:
-- Respect robots.txt
-- Find all links in sitemap.xml
 - Provide a user agent
-- Normalize urls (www.example.com and www.example.com/ are the same)
 - Skip filetypes (jpg, pdf, webp) or include only filetypes (html, php, NONE)
-- Max concurrent connections per domain
-- Rate limiting
-- Rate limiting per domain
-- Store connections as graph
-- Store results to database
-- Scale
 
 URI schemes: https://www.iana.org/assignments/uri-schemes/uri-schemes.xhtml
 IP ranges for the google bots: https://developers.google.com/static/search/apis/ipranges/googlebot.json
@@ -23,12 +14,28 @@ import asyncio
 import pathlib
 import time
 import urllib.parse
-from typing import Callable, Iterable
+from typing import AsyncIterable, Callable, Iterable, MutableSet
 from warnings import warn
 
-from bs4 import BeautifulSoup
 import httpx
 
+from src.graph import LinkGraph
+from src.health import RETRY_ERRORS, RETRY_STATUSES, HostHealth, RetryableStatus, is_retryable
+from src.http_cache import ResponseCache
+from src.metrics import NULL_METRICS, HttpTrace, Metrics
+from src.parsing import Parser
+from src.pipeline import DownloadQueue
+from src.robots import RobotsCache
+from src.scheduler import HostScheduler, host_of, retry_after
+from src.sitemap import SitemapUrl
+from src.state import CrawlState
+from src.traps import TrapDetector
+from src.urls import canonicalize
+
+
+CHECKPOINT_INTERVAL = 5.0  # seconds between checkpoints of the crawl state
+FRONTIER_BATCH = 1_000  # urls moved from the crawl state to memory at once
+
 
 class UrlFilterer:
     def __init__(
@@ -36,9 +43,13 @@ class UrlFilterer:
         is_allowed_domain: Callable[[str], bool],
         is_allowed_scheme: Callable[[str], bool], 
         is_allowed_file_type: Callable[[str], bool],
+        sort_query: bool = False,
+        strip_params: Iterable[str] = (),
+        robots: RobotsCache | None = None,
     ) -> None:
         """Creates a UrlFilterer instance which is used by the crawler to check
-        if a link should be accessed.
+        if a link should be accessed. Urls are canonicalized (see
+        `src.urls.canonicalize`) before they are checked.
 
         Args:
             is_allowed_domain (Callable[[str], bool]): Checks if the domain of
@@ -47,10 +58,23 @@ class UrlFilterer:
                 the url is fine to be searched.
             is_allowed_file_type (Callable[[str], bool]): Checks if the file
                 type of the url is fine to be searched.
+            sort_query (bool): Sort the parameters of query strings, so urls
+                only differing in the order of their parameters are the same.
+            strip_params (Iterable[str]): Query parameters to remove from
+                urls, e.g. `src.urls.TRACKING_PARAMS`.
+            robots (RobotsCache | None): The robots.txt rules urls have to
+                follow; urls of hosts whose rules are not fetched yet pass
+                `check_url`, the crawler waits for them with `check_robots`.
         """
         self.is_allowed_domain = is_allowed_domain
         self.is_allowed_scheme = is_allowed_scheme
         self.is_allowed_file_type = is_allowed_file_type
+        self.sort_query = sort_query
+        self.strip_params = frozenset(strip_params)
+        self.robots = robots
+
+    def canonicalize(self, url: str) -> str:
+        return canonicalize(url, self.sort_query, self.strip_params)
     
     def check_url(self, base: str, path: str) -> str | None:
         """_summary_
@@ -63,15 +87,26 @@ class UrlFilterer:
         Returns:
             str | None: The url or None if the url should not be searched
         """
-        url = urllib.parse.urljoin(base, path)
-        url, _frag = urllib.parse.urldefrag(url)
+        url = self.canonicalize(urllib.parse.urljoin(base, path))
         parsed = urllib.parse.urlparse(url)
         ending = pathlib.Path(parsed.path).suffix
         if (self.is_allowed_domain(parsed.netloc) 
             and self.is_allowed_scheme(parsed.scheme) 
-            and self.is_allowed_file_type(ending)):
+            and self.is_allowed_file_type(ending)
+            and (self.robots is None or self.robots.allowed(url) is not False)):
+            if self.robots is not None: self.robots.prefetch(url)
             return url
 
+    async def check_robots(self, url: str) -> bool:
+        """Checks if robots.txt allows crawling the url, fetching it for the
+        host of the url if needed.
+
+        Returns:
+            bool: True if the url may be crawled
+        """
+        if self.robots is None: return True
+        return (await self.robots.rules(url)).allowed(url)
+
 
 class Crawler:
     """
@@ -80,45 +115,125 @@ class Crawler:
     Downloader: downloads info from the downloads queue 
     """
 
-    def __init__(self, client: httpx.AsyncClient, urls: Iterable[str], filter: UrlFilterer, workers: int, max_depth: int, max_sites: int) -> None:
+    def __init__(
+        self, 
+        client: httpx.AsyncClient, 
+        urls: Iterable[str], 
+        filter: UrlFilterer, 
+        workers: int, 
+        max_depth: int, 
+        max_sites: int,
+        host_rate: float = 1.0,
+        max_per_host: int = 2,
+        score: Callable[[str, int], float] | None = None,
+        parser: Parser | None = None,
+        state: str | None = None,
+        seen: MutableSet[str] | None = None,
+        cache: ResponseCache | None = None,
+        downloads: DownloadQueue | None = None,
+        metrics: Metrics | None = None,
+        traps: TrapDetector | None = None,
+        graph: LinkGraph | None = None,
+        health: HostHealth | None = None,
+    ) -> None:
         self.client = client
-        self.initial_urls = set(urls)
-        self.crawling = asyncio.Queue()
-        self.to_crawl = set()
-        self.seen = set()
-        self.selected = set()  # TODO: add an additional filter for URLs to select and go through further processing
+        self.initial_urls = {filter.canonicalize(url) for url in urls}
+        self.crawling = HostScheduler(rate=host_rate, max_in_flight=max_per_host)
+        self.score = score or (lambda url, depth: 0.0)
+        # with a state database the seen and selected urls and the frontier are kept in it
+        # instead of in memory, which also allows stopping the crawl and resuming it later; `close` closes it
+        self.state = CrawlState(state) if state is not None else None
+        # `seen` can be a compact set from `src.seen` for crawls finding too many urls to keep as strings
+        self.seen = self.state.seen if self.state is not None else seen if seen is not None else set()
+        self.selected = self.state.selected if self.state is not None else set()
+        self.last_checkpoint = time.monotonic()
+        self.cache = cache
+        self.not_modified = 0
+        # selected urls are downloaded while the crawl continues
+        self.downloads = downloads
+        self.metrics = metrics or NULL_METRICS
+        self.enqueued_at: dict[str, float] = {}  # when urls were put into the scheduler, if metrics are collected
+        # near-duplicate pages are not followed, and urls of templates which keep producing them are dropped or
+        # crawled last; a given parser has to be created with `fingerprint=True` for this
+        self.traps = traps
+        self.duplicates = 0
+        # the links between the crawled pages, if they are recorded
+        self.graph = graph
+        # failed requests are retried and failing hosts are parked, if the health of hosts is tracked
+        self.health = health
+        self.attempts: dict[str, int] = {}  # failed attempts of urls which are retried
+        self.owns_parser = parser is None
+        self.parser = parser or Parser(fingerprint=traps is not None)
         self.filter = filter
         self.workers = workers
         self.max_depth = max_depth
         self.max_sites = max_sites
         
         self.total = 0
+        self.parsed = 0
     
-    async def run(self) -> None:
-        [await self.crawling.put(url) for url in self.initial_urls]
-        self.total += len(self.initial_urls)
-        
-        for depth in range(self.max_depth):
-            start_time = time.perf_counter()
-            start_total = self.total
-            workers = [
-                asyncio.create_task(self.worker())
-                for _ in range(self.workers)
-            ]
+    async def run(self, seeds: AsyncIterable[SitemapUrl] | None = None) -> None:
+        """Crawls until the frontier is empty.
 
-            await self.crawling.join()
+        Args:
+            seeds (AsyncIterable[SitemapUrl] | None): Further urls to start
+                from which are admitted while the crawl runs, e.g.
+                `src.sitemap.sitemap_urls`.
+        """
+        start_time = time.perf_counter()
+        if self.state is not None and not self.state.is_new():
+            self.total = self.state.total()
+            print(f"Resuming the crawl after {self.total} admitted website{'' if self.total == 1 else 's'}")
+        else:
+            for url in self.initial_urls:
+                if not await self.filter.check_robots(url): continue
+                self.enqueue(url, 0)
+                self.total += 1
+        self.refill()
+        seeding = None
+        if seeds is not None:
+            # the crawl is not finished before all seeds are admitted
+            self.crawling.hold()
+            seeding = asyncio.create_task(self.seed(seeds))
+            seeding.add_done_callback(self._seeded)
 
+        workers = [
+            asyncio.create_task(self.worker())
+            for _ in range(self.workers)
+        ]
+        try:
+            while True:
+                await self.crawling.join()
+                if not self.refill(): break
+        finally:
             [worker.cancel() for worker in workers]
+            if seeding is not None: seeding.cancel()
+            try:
+                # the last batch of writes is stored even if the crawl was stopped
+                if self.state is not None: self.state.checkpoint(self.total)
+            finally:
+                if self.owns_parser: self.parser.close()
 
-            time_used = time.perf_counter() - start_time
-            num_parsed = self.total - start_total
+        time_used = time.perf_counter() - start_time
+        print(f"Crawl finished in {time_used:.3f} sec after parsing " +
+              f"{self.parsed} website{'' if self.parsed == 1 else 's'}" +
+              (f" ({self.not_modified} unchanged since the last crawl)" if self.cache is not None else "") +
+              (f" ({self.duplicates} near-duplicates)" if self.traps is not None else ""))
+    
+    async def seed(self, seeds: AsyncIterable[SitemapUrl]) -> None:
+        """Admits urls to the frontier at depth 0 as they arrive; urls with a
+        more recent lastmod date are crawled first."""
+        async for item in seeds:
+            url = self.filter.check_url(item.loc, "")
+            if url is None: continue
+            await self.admit(url, 0, item.timestamp())
+            self.refill()
 
-            print(f"Depth {depth + 1} finished in {time_used:.3f} sec after parsing " +
-                  f"{num_parsed} website{'' if num_parsed == 1 else 's'}")
+    def _seeded(self, task: asyncio.Task) -> None:
+        self.crawling.release()
+        if not task.cancelled() and task.exception() is not None:
+            print(f"There was an error in reading the seeds: {task.exception()}")
 
-            [await self.crawling.put(url) for url in self.to_crawl]
-            self.to_crawl = set()
-    
     async def worker(self) -> None:
         while True:
             try:
@@ -127,33 +242,154 @@ class Crawler:
                 return
 
     async def process_one(self) -> None:
-        url = await self.crawling.get()
+        url, depth = await self.crawling.get()
+        if (queued := self.enqueued_at.pop(url, None)) is not None:
+            self.metrics.observe("queue_wait_seconds", time.monotonic() - queued)
+            self.metrics.set("frontier_size", self.crawling.qsize())
+        host = host_of(url)
+        if self.health is not None and (wait := self.health.acquire(host)) > 0:
+            # the circuit breaker of the host is open, so its urls wait in the scheduler while other hosts are crawled
+            self.crawling.delay_host(url, wait)
+            self.schedule(url, depth, self.score(url, depth))
+            self.crawling.task_done(url)
+            return
+        status = -1
+        retrying = False
         try:
-            await self.crawl(url)
+            status = await self.crawl(url, depth)
+            self.attempts.pop(url, None)
         except Exception as e:
-            print(f"There was an error in processing the request: {e}")
-            # TODO: add retry handling here
+            self.metrics.inc("errors", host=host)
+            attempt = self.attempts.get(url, 0) + 1
+            if self.health is not None and is_retryable(e) and attempt < self.health.retry.max_attempts:
+                # the host is backed off, which also spaces out the requests to a host that is struggling
+                self.attempts[url] = attempt
+                self.metrics.inc("retries", host=host)
+                self.crawling.delay_host(url, self.health.retry.delay(attempt, getattr(e, "retry_after", None)))
+                self.schedule(url, depth, self.score(url, depth))
+                retrying = True
+            else:
+                self.attempts.pop(url, None)
+                print(f"There was an error in processing the request: {e}")
         finally:
-            self.crawling.task_done()
+            self.crawling.task_done(url)
+            if self.state is not None and not retrying:
+                self.state.finish(url, status)
+                self.refill()
+                if time.monotonic() - self.last_checkpoint > CHECKPOINT_INTERVAL:
+                    self.state.checkpoint(self.total)
+                    self.last_checkpoint = time.monotonic()
 
-    async def crawl(self, url: str) -> None:
-        await asyncio.sleep(1)
-        resp = await self.client.get(url, follow_redirects=True)
+    async def crawl(self, url: str, depth: int) -> int:
+        """Crawls a single page and admits the links found on it.
+
+        Returns:
+            int: The HTTP status of the response, or 0 if the url turned out
+                to be part of a crawl trap while it was waiting
+        """
+        host = host_of(url)
+        if self.traps is not None and self.traps.drops(url):
+            self.metrics.inc("trap_urls", host=host)
+            return 0
+        cached = self.cache.get(url) if self.cache is not None else None
+        headers = cached.validators() if cached is not None else None
+        trace = HttpTrace() if self.metrics.enabled else None
+        start = time.monotonic()
+        try:
+            resp = await self.client.get(url, headers=headers, follow_redirects=True, extensions={"trace": trace} if trace else None)
+        except RETRY_ERRORS:
+            if self.health is not None: self.health.record(host, False)
+            raise
+        if self.health is not None:
+            self.health.record(host, resp.status_code not in RETRY_STATUSES, time.monotonic() - start)
+        self.metrics.inc("requests", host=host, status=resp.status_code)
+        self.metrics.inc("bytes_in", len(resp.content), host=host)
+        if trace is not None: trace.record(self.metrics, host=host)
+        if (delay := retry_after(resp.headers)) is not None:
+            self.crawling.delay_host(url, delay)
+        if (self.health is not None and resp.status_code in RETRY_STATUSES
+                and self.attempts.get(url, 0) + 1 < self.health.retry.max_attempts):
+            raise RetryableStatus(resp.status_code, resp.headers)
     
-        soup = BeautifulSoup(resp, features="html.parser")
+        if resp.status_code == 304 and cached is not None:
+            # the page did not change since the last crawl, so its links are taken from the cache
+            result, base = cached.result, cached.base_url
+            self.not_modified += 1
+        else:
+            with self.metrics.time("parse_seconds"):
+                result = await self.parser.parse(resp.content, resp.charset_encoding)
+            base = str(resp.url)
+            if self.cache is not None and resp.is_success: self.cache.store(url, base, resp.headers, result)
+
+        if self.traps is not None and result.fingerprint is not None and self.traps.check_page(url, result.fingerprint) is not None:
+            # the links of a near-duplicate are those of the page it duplicates, or variations of them leading further into a trap
+            self.duplicates += 1
+            self.metrics.inc("duplicates", host=host)
+            self.parsed += 1
+            return resp.status_code
         
-        for tag in soup.select("a"):
-            link = self.filter.check_url(str(resp.url), tag.attrs["href"])
-            if link is None or link in self.seen: continue
-            await self.add_url(link)
+        # the robots.txt of every new host is fetched concurrently while the links are checked
+        links = [link for href in result.links if (link := self.filter.check_url(base, href)) is not None]
+        if self.graph is not None: self.graph.add_edges(url, dict.fromkeys(links))
+        for link in links:
+            await self.admit(link, depth + 1)
+        selected = [file for file in dict.fromkeys(urllib.parse.urljoin(base, src) for src in result.selected) if file not in self.selected]
+        self.selected.update(selected)
+        if self.downloads is not None:
+            for file in selected: await self.downloads.put(file)
+        self.parsed += 1
+        return resp.status_code
     
-    async def add_url(self, url: str) -> None:
+    async def admit(self, url: str, depth: int, score: float | None = None) -> None:
+        """Admits a url found on a page or given as a seed unless it was seen before or robots.txt disallows it."""
+        if url in self.seen or not await self.filter.check_robots(url): return
+        await self.add_url(url, depth, score)
+
+    async def add_url(self, url: str, depth: int, score: float | None = None) -> None:
+        """Admits a newly found url to the frontier if it is within the depth
+        and site limits of the crawl. `score` replaces the score function of
+        the crawl if given."""
         self.seen.add(url)
+        if self.filter.robots is not None:
+            rules = await self.filter.robots.rules(url)
+            if rules.crawl_delay is not None: self.crawling.set_crawl_delay(host_of(url), rules.crawl_delay)
+        if self.traps is not None and self.traps.drops(url):
+            self.metrics.inc("trap_urls", host=host_of(url))
+            return
         if self.total >= self.max_sites and self.max_sites != -1: 
             warn("Max sites reached")  # TODO: find a better solution here
             return
         self.total += 1
-        self.to_crawl.add(url)
+        if depth >= self.max_depth: return
+        self.enqueue(url, depth, score)
+
+    def enqueue(self, url: str, depth: int, score: float | None = None) -> None:
+        if score is None: score = self.score(url, depth)
+        if self.traps is not None: score = self.traps.adjust_score(url, score)
+        if self.state is None: self.schedule(url, depth, score)
+        else: self.state.enqueue(url, depth, score)
+
+    def schedule(self, url: str, depth: int, score: float) -> None:
+        """Puts a url into the scheduler, noting when it was put there if metrics are collected."""
+        self.crawling.put_nowait(url, depth, score)
+        if self.metrics.enabled: self.enqueued_at[url] = time.monotonic()
+
+    def refill(self) -> bool:
+        """Moves urls from the frontier in the state database to the
+        scheduler once it is running low.
+
+        Returns:
+            bool: True if any urls were moved
+        """
+        if self.state is None or self.crawling.qsize() >= FRONTIER_BATCH // 2: return False
+        rows = self.state.lease(FRONTIER_BATCH)
+        for url, depth, score in rows:
+            self.schedule(url, depth, score)
+        return bool(rows)
+
+    def close(self) -> None:
+        """Closes the state database, if the crawl has one; its seen and selected urls can not be read afterwards."""
+        if self.state is not None: self.state.close()
 
 
 async def main():
@@ -3,18 +3,239 @@ This module downloads files.
 """
 
 
+import hashlib
+import json
 import os
+import queue
+import re
+import threading
+import time
+import urllib.parse
+import uuid
 import warnings
 import requests
-from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, Literal
 from tqdm import tqdm
 
+from src.content_index import ContentIndex, hash_file, new_hash
+from src.health import HostHealth
+from src.metrics import NULL_METRICS, Metrics
+from src.probe import probe
+from src.scheduler import host_of
 
-BLOCK_SIZE = 2 ** 15  # TODO: make this a dynamic value to maximize the speed of the download
 
+MIN_BLOCK_SIZE = 2 ** 15
+MAX_BLOCK_SIZE = 2 ** 22
+TARGET_BLOCK_TIME = 0.05  # seconds; the block size grows while blocks arrive faster than this and shrinks when slower
+WRITE_QUEUE_SIZE = 16  # blocks that can wait for the disk before reading from the network is paused
+SEGMENT_SAVE_INTERVAL = 1.0  # seconds between saves of the progress of a segmented download
+TIMEOUT = (10.0, 60.0)  # seconds to wait for a connection and for the next bytes of a response
 
 
-def check_override(full_path: str, override: Literal["Edit name", "Skip", "Strict", "Write over"], verbose: bool = False) -> None | str:
+@dataclass
+class DownloadResult:
+    """
+    The outcome of downloading a single url.
+
+    attributes:
+        url: The remote source of the file.
+        status: `downloaded`, `skipped` or `failed`.
+        path: The location the file was written to, or None if nothing was written.
+        error: The exception that caused a failure, if any.
+        size: The number of bytes received.
+        seconds: The time spent receiving and writing the file.
+    """
+    url: str
+    status: Literal["downloaded", "skipped", "failed"]
+    path: str | None = None
+    error: BaseException | None = None
+    size: int = 0
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status != "failed"
+
+    @property
+    def mb_per_s(self) -> float:
+        """The achieved download speed in MB/s."""
+        return self.size / self.seconds / 1e6 if self.seconds else 0.0
+
+
+class _BackgroundWriter:
+    """
+    Writes blocks to a file from a separate thread, so that reading from the network does not wait on the disk
+    unless `WRITE_QUEUE_SIZE` blocks are already waiting to be written.
+    """
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.blocks: queue.Queue[bytes | None] = queue.Queue(WRITE_QUEUE_SIZE)
+        self.error: BaseException | None = None
+        self.seconds = 0.0  # time spent writing
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while (block := self.blocks.get()) is not None:
+            if self.error is not None: continue
+            try:
+                start = time.perf_counter()
+                self.file.write(block)
+                self.seconds += time.perf_counter() - start
+            except BaseException as e:
+                self.error = e
+
+    def write(self, block: bytes) -> None:
+        if self.error is not None: raise self.error
+        self.blocks.put(block)
+
+    def close(self) -> None:
+        self.blocks.put(None)
+        self.thread.join()
+        if self.error is not None: raise self.error
+
+
+def _adaptive_blocks(response: requests.Response, block_size: tuple[int, int]) -> Iterator[bytes]:
+    """
+    Reads the body of a streamed response in blocks whose size adapts to the measured throughput; the size doubles
+    while blocks arrive quickly and halves when they arrive slowly, staying within `block_size`.
+    """
+    min_size, max_size = block_size
+    size = min_size
+    while True:
+        start = time.perf_counter()
+        block = response.raw.read(size, decode_content=True)
+        if not block: return
+        elapsed = time.perf_counter() - start
+        if elapsed < TARGET_BLOCK_TIME / 2 and len(block) == size: size = min(size * 2, max_size)
+        elif elapsed > TARGET_BLOCK_TIME: size = max(size // 2, min_size)
+        yield block
+
+_COPY_NAME = re.compile(r"(.*) \((\d+)\)(\.[^.]*)")
+
+
+class DirectoryIndex:
+    """
+    The names of the files in a download directory, which is scanned once (if `scan` is set), together with the next
+    suffix to try for every name, so finding a free `name (N).ext` does not need a stat call per existing file. Names
+    are claimed in memory while their file is downloaded, so downloads running in parallel never end up with the same name, and
+    nothing is written to a claimed path before the download is complete. Candidates which are not known to be taken
+    are checked against the disk, which finds files created by other programs since the scan; files removed since the
+    scan are not noticed, so an index only lives as long as the downloads using it (see `directory_index`).
+    """
+    def __init__(self, directory: str, scan: bool = True) -> None:
+        self.directory = directory
+        self.names = set(os.listdir(directory)) if scan and os.path.isdir(directory) else set()
+        self.claimed: set[str] = set()
+        self.next_suffix: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+
+    def _candidates(self, name: str) -> Iterator[tuple[str, int]]:
+        """The names `name (1).ext`, `name (2).ext`, ... starting at the first one that may be free."""
+        stem, extension = os.path.splitext(name)
+        if not extension: raise ValueError("No File extension")
+        suffix = self.next_suffix.get(name, 1)
+        while True:
+            yield f"{stem} ({suffix}){extension}", suffix
+            suffix += 1
+
+    def _taken(self, name: str) -> bool:
+        if name in self.names or name in self.claimed: return True
+        if os.path.lexists(os.path.join(self.directory, name)):
+            self.names.add(name)
+            return True
+        return False
+
+    def _free_name(self, name: str) -> str:
+        for candidate, suffix in self._candidates(name):
+            if self._taken(candidate): continue
+            self.next_suffix[name] = suffix
+            return candidate
+
+    def free_name(self, name: str) -> str:
+        """The first name for a copy of `name` which is not in use, without claiming it."""
+        with self.lock:
+            return self._free_name(name)
+
+    def claim(self, name: str) -> bool:
+        """Claims a name for a download; False if a file with that name exists or the name is claimed already."""
+        with self.lock:
+            if name in self.claimed or os.path.lexists(os.path.join(self.directory, name)): return False
+            self.claimed.add(name)
+            return True
+
+    def claim_turn(self, name: str) -> bool:
+        """
+        Claims a name once no other download holds it, so downloads writing over the same file take turns.
+
+        returns:
+            Whether a file with that name exists.
+        """
+        with self.released:
+            while name in self.claimed: self.released.wait()
+            self.claimed.add(name)
+            return os.path.lexists(os.path.join(self.directory, name))
+
+    def claim_copy(self, name: str) -> str:
+        """Claims the first free name for a copy of `name`."""
+        with self.lock:
+            candidate = self._free_name(name)
+            self.claimed.add(candidate)
+            return candidate
+
+    def release(self, name: str, written: bool = False) -> None:
+        """Gives up a claimed name once its file is written, or makes it available again if the download did not happen."""
+        with self.lock:
+            self.claimed.discard(name)
+            self.released.notify_all()
+            if written:
+                self.names.add(name)
+            elif (match := _COPY_NAME.fullmatch(name)) is not None:
+                original = match.group(1) + match.group(3)
+                self.next_suffix[original] = min(self.next_suffix.get(original, 1), int(match.group(2)))
+
+
+_directories: dict[str, tuple[DirectoryIndex, int]] = {}  # the index of every directory being downloaded to, and its users
+_directories_lock = threading.Lock()
+
+
+def directory_index(directory: str) -> DirectoryIndex:
+    """
+    The `DirectoryIndex` shared by the downloads to a directory which are running, or a new one that is not shared if
+    there are none.
+    """
+    key = os.path.abspath(directory)
+    with _directories_lock:
+        if key in _directories: return _directories[key][0]
+    return DirectoryIndex(key, scan=False)
+
+
+@contextmanager
+def _use_directory(directory: str, scan: bool) -> Iterator[DirectoryIndex]:
+    """
+    Shares the `DirectoryIndex` of a directory while downloads to it run; it is created by the first one, scanning
+    the directory if `scan` is set (which pays off for a batch of downloads), and dropped once the last one ended.
+    """
+    key = os.path.abspath(directory)
+    with _directories_lock:
+        index, users = _directories.get(key, (None, 0))
+        if index is None: index = DirectoryIndex(key, scan)
+        _directories[key] = index, users + 1
+    try:
+        yield index
+    finally:
+        with _directories_lock:
+            index, users = _directories[key]
+            if users == 1: del _directories[key]
+            else: _directories[key] = index, users - 1
+
+
+def check_override(full_path: str, override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"], verbose: bool = False) -> None | str:
     """
     Checks if there will be a collision and changes where the file will be downloaded, if necessary.
 
@@ -40,23 +261,62 @@ def check_override(full_path: str, override: Literal["Edit name", "Skip", "Stric
     if override == "Write over":
         warnings.warn(f"Overriding a file at the following path: \"{full_path}\".")
         return full_path
-    replace_num = 1
-    original_full_path = full_path[:]
-    i = original_full_path.rfind(".")
-    while os.path.isfile(full_path) and override == "Edit name":
-        if i == -1: raise ValueError("No File extension")
-        full_path = f"{original_full_path[:i]} ({replace_num}){original_full_path[i:]}"
-        replace_num += 1
-    if verbose: print(f"A file exists at {original_full_path}; writing to {full_path}.")
-    return full_path
+    directory, name = os.path.split(full_path)
+    new_path = os.path.join(directory, directory_index(directory).free_name(name))
+    if verbose: print(f"A file exists at {full_path}; writing to {new_path}.")
+    return new_path
+
+
+def _release_path(full_path: str, written: bool = False) -> None:
+    """Gives up the claim `_claim_path` made on a path, see `DirectoryIndex.release`."""
+    directory, name = os.path.split(full_path)
+    directory_index(directory).release(name, written)
+
+
+def _claim_path(full_path: str, override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"], verbose: bool = False) -> tuple[None | str, bool]:
+    """
+    Thread safe version of `check_override` which also claims the returned path until `_release_path` is called. A
+    name claimed by a parallel download counts as an existing file, so the downloads are handled as if they ran one
+    after another: `Edit name` picks a different name, `Skip` skips, `Strict` raises and `Write over` waits for the
+    other download to finish. Nothing is written to the path, so a download that is interrupted never leaves a file
+    there which looks complete.
+
+    returns:
+        The location where the file will be downloaded or None if it should not be downloaded, and whether the
+        location was claimed.
+    """
+    directory, name = os.path.split(full_path)
+    index = directory_index(directory)
+    if override == "Write over":
+        if index.claim_turn(name): warnings.warn(f"Overriding a file at the following path: \"{full_path}\".")
+        elif verbose: print(f"A file does not exist at {full_path}; downloading to that location.")
+        return full_path, True
+    if index.claim(name):
+        if verbose: print(f"A file does not exist at {full_path}; downloading to that location.")
+        return full_path, True
+    if override in ("Edit name", "Skip if same"):
+        new_path = os.path.join(directory, index.claim_copy(name))
+        if verbose: print(f"A file exists at {full_path}; writing to {new_path}.")
+        return new_path, True
+    if override == "Skip":
+        if verbose: print(f"A file exists at {full_path}, skipping the download.")
+        return None, False
+    raise FileExistsError(f"A file exists at {full_path}.")
 
 
 def download(
         url: str, 
         path: str, 
         file_name: str = None, 
-        override: Literal["Edit name", "Skip", "Strict", "Write over"] = "Edit name",  # TODO: add "Skip if same" which will check that the file being downloaded and the pre-existing file have the same file sizes
-        verbose: bool = False
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"] = "Edit name",
+        verbose: bool = False,
+        session: requests.Session = None,
+        segments: int = 1,
+        block_size: tuple[int, int] = (MIN_BLOCK_SIZE, MAX_BLOCK_SIZE),
+        index: ContentIndex | None = None,
+        metrics: Metrics | None = None,
+        health: HostHealth | None = None,
+        timeout: float | tuple[float, float] | None = TIMEOUT,
     ) -> bool:
     """
     Downloads a file from a remote source to a specified location using html packets.
@@ -68,9 +328,29 @@ def download(
         override: Settings regarding what to do if the downloaded file matches the name of a pre-existing file in the download directory.
             `Edit name`: Change the name of the downloaded file by adding a number at the end (chooses the first one that prevents an overlap) such that it will not match the name of the pre-existing file(s).
             `Skip`: Do not download the file and do not throw an error.
+            `Skip if same`: Do not download the file if the pre-existing file has the same content, otherwise the same
+                as `Edit name`. The body is always downloaded; the pre-existing file is only hashed if it has the same size.
             `Strict`: Do not download the file and throw an error.
             `Write over`: Write over the pre-existing file.
         verbose: If set to true, the function will produce more detailed output
+        session: The session used to send the request; if left empty, a new connection is made.
+        segments: If greater than 1 and the server supports range requests, the file is split into this many byte
+            ranges which are downloaded in parallel into a `.part` file (see `part_path`). The progress is stored next
+            to it in a `.part.json` file so that an interrupted download only fetches the missing ranges when it is
+            restarted.
+        block_size: The minimum and maximum number of bytes read from the connection at once; the size used adapts
+            to the speed of the download.
+        index: An index of the downloaded files. Urls whose file is unchanged since the last download (same size and
+            validators) are skipped before the body is transferred, and content which is already stored elsewhere
+            is hardlinked instead of being written again (or skipped if override is set to `Skip if same`).
+        metrics: Where the time to the first byte, the transfer and disk write times and the bytes received and
+            written are recorded, see `src.metrics`.
+        health: The health of the hosts, see `src.health`. Timeouts, connection errors, 429 and 5xx responses are
+            retried with backoff, and hosts which keep failing are not contacted for a while (the download fails with
+            `HostUnavailable` instead).
+        timeout: The number of seconds to wait for a connection and for the next bytes of a response, as a
+            `(connect, read)` tuple or one number for both, or None to wait forever. A request that times out fails,
+            or is retried if `health` is given.
     
     raises:
         FileExistsError: If there is a pre-existing file and override is set to `Strict`.
@@ -79,21 +359,20 @@ def download(
     returns:
         True if the file is successfully downloaded or has been skipped.
     """
-    if verbose: print(f"Getting response from \"{url}\"...")
-    response = requests.get(url, stream=True)
-    if verbose: print(f"Response headers: {response.headers}")
+    return download_file(url, path, file_name, override, verbose, session, segments, block_size, index, metrics, health, timeout).ok
 
-    if not response.ok:
-        warnings.warn(f"Response was not ok: \"{response}\"")
-        return False
 
+def _file_name(url: str, file_name: str | None, headers: dict[str, str], verbose: bool = False) -> str:
+    """
+    Finds the name the file downloaded from `url` will be saved under.
+    """
     if file_name is not None:
         if verbose: print("No file name specified, using the filename of the file on the website's side.")
         file_type = ""
         i = url.rfind(".")
         if i == -1:
             warnings.warn(f"File type not found from url, using \"content-type\" from the html response.")
-            file_type = response.headers.get("content-type")
+            file_type = headers.get("content-type")
             file_type = "." + file_type[file_type.rfind("/") + 1:]
         else:
             file_type = url[i:]
@@ -103,18 +382,470 @@ def download(
         if verbose: print("Finding the name of the file...")
         file_name = url[url.rfind("/") + 1:]
         if verbose: print(f"Found \"{file_name}\".")
-    
-    full_path = os.path.join(path, file_name)
+    return file_name
+
+
+def download_file(
+        url: str, 
+        path: str, 
+        file_name: str = None, 
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"] = "Edit name",
+        verbose: bool = False,
+        session: requests.Session = None,
+        segments: int = 1,
+        block_size: tuple[int, int] = (MIN_BLOCK_SIZE, MAX_BLOCK_SIZE),
+        index: ContentIndex | None = None,
+        metrics: Metrics | None = None,
+        health: HostHealth | None = None,
+        timeout: float | tuple[float, float] | None = TIMEOUT,
+    ) -> DownloadResult:
+    """
+    Same as `download`, but returns a `DownloadResult` describing what happened instead of a bool.
+
+    raises:
+        FileExistsError: If there is a pre-existing file and override is set to `Strict`.
+        ValueError: If the file extension could not be retrieved.
+    """
+    metrics = metrics or NULL_METRICS
+    host = urllib.parse.urlsplit(url).netloc
+    try:
+        with _use_directory(path, scan=False):
+            result = _download_file(url, path, file_name, override, verbose, session, segments, block_size, index, metrics, health, timeout)
+    except Exception:
+        metrics.inc("downloads", status="failed", host=host)
+        raise
+    metrics.inc("downloads", status=result.status, host=host)
+    if result.status == "downloaded": metrics.inc("bytes_written", result.size, host=host)
+    return result
+
+
+def _download_file(
+        url: str,
+        path: str,
+        file_name: str | None,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"],
+        verbose: bool,
+        session: requests.Session | None,
+        segments: int,
+        block_size: tuple[int, int],
+        index: ContentIndex | None,
+        metrics: Metrics,
+        health: HostHealth | None,
+        timeout: float | tuple[float, float] | None,
+    ) -> DownloadResult:
+    host = urllib.parse.urlsplit(url).netloc
+    requester = session or requests
+    if segments > 1:
+        if verbose: print(f"Checking if \"{url}\" supports range requests...")
+        info = probe(url, session)
+        if info.accept_ranges and info.size:
+            headers = {"content-type": info.content_type} if info.content_type else {}
+            full_path = os.path.join(path, _file_name(url, file_name, headers, verbose))
+            return _download_segmented(url, full_path, override, info.size, info.validator, segments, requester, block_size, verbose, index, metrics, health, timeout)
+        if verbose: print("Range requests are not supported, downloading over a single connection.")
+
+    record = index.get(url) if index is not None else None
+    if verbose: print(f"Getting response from \"{url}\"...")
+    response = _get(requester, url, health, timeout, stream=True, headers=record.validators() if record is not None else None)
+    if verbose: print(f"Response headers: {response.headers}")
+    metrics.inc("requests", host=host, status=response.status_code)
+    metrics.observe("ttfb_seconds", response.elapsed.total_seconds(), host=host)
+
+    if record is not None and (response.status_code == 304 or record.unchanged(response.headers)):
+        if verbose: print(f"The file is unchanged since it was downloaded to {record.path}, skipping the download.")
+        response.close()
+        return DownloadResult(url, "skipped", record.path)
+
+    if not response.ok:
+        warnings.warn(f"Response was not ok: \"{response}\"")
+        return DownloadResult(url, "failed")
+
+    full_path = os.path.join(path, _file_name(url, file_name, response.headers, verbose))
     if verbose: print(f"The full path of where the file will be downloaded is {full_path}...")
 
-    ret = check_override(full_path, override, verbose=verbose)
-    if ret is None: return True  # skipped
+    original_path = full_path
+    ret, reserved = _claim_path(full_path, override, verbose=verbose)
+    if ret is None: return DownloadResult(url, "skipped")
     full_path = ret
 
     if verbose: print(f"Downloading...")
 
-    with open(full_path, 'wb') as file:
-        for block in response.iter_content(BLOCK_SIZE):
-            if not block: break
-            file.write(block)
-    return True
+    # write to a temporary file first, so an interrupted download never looks complete and parallel downloads
+    # writing over the same file replace it atomically instead of interleaving their writes
+    temp_path = f"{full_path}.{uuid.uuid4().hex[:8]}.part"
+    received = 0
+    # the content is only hashed if something compares it with other files
+    digest = new_hash() if index is not None or override == "Skip if same" else None
+    start = time.perf_counter()
+    try:
+        with open(temp_path, 'xb') as file:
+            writer = _BackgroundWriter(file)
+            try:
+                for block in _adaptive_blocks(response, block_size):
+                    writer.write(block)
+                    if digest is not None: digest.update(block)
+                    received += len(block)
+            finally:
+                writer.close()
+                metrics.observe("body_seconds", time.perf_counter() - start, host=host)
+                metrics.observe("write_seconds", writer.seconds, host=host)
+                metrics.inc("bytes_in", received, host=host)
+        hash = digest.hexdigest() if digest is not None else None
+        same = _same_content(original_path, received, hash, override, index) if hash is not None else None
+        if same is not None and override == "Skip if same":
+            os.remove(temp_path)
+            if reserved: _release_path(full_path)
+            if index is not None: index.record(url, response.headers, hash, same)
+            if verbose: print(f"The same file exists at {same}, skipping the download.")
+            return DownloadResult(url, "skipped", same, size=received, seconds=time.perf_counter() - start)
+        if same is not None: _link(same, temp_path)
+        saved = _publish(temp_path, original_path, full_path, override, verbose)
+        if reserved: _release_path(full_path, written=saved == full_path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        if reserved: _release_path(full_path)
+        raise
+    if saved is None: return DownloadResult(url, "skipped")
+    full_path = saved
+    if index is not None: index.record(url, response.headers, hash, full_path)
+    result = DownloadResult(url, "downloaded", full_path, size=received, seconds=time.perf_counter() - start)
+    if verbose: print(f"Downloaded {received:,} bytes at {result.mb_per_s:.2f} MB/s.")
+    return result
+
+
+def _same_content(
+        original_path: str,
+        size: int,
+        hash: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"],
+        index: ContentIndex | None,
+    ) -> str | None:
+    """
+    Finds a stored file with the same content as a downloaded one: the pre-existing file at the path it was meant to
+    be saved to (if override is set to `Skip if same`) or any file in the index.
+
+    returns:
+        The location of the file or None if there is none.
+    """
+    if override == "Skip if same" and os.path.isfile(original_path) and os.path.getsize(original_path) == size:
+        if (index.hash_of(original_path) if index is not None else hash_file(original_path)) == hash: return original_path
+    return index.path_of(hash) if index is not None else None
+
+
+def _link(source: str, temp_path: str) -> None:
+    """
+    Replaces a downloaded temporary file with a hardlink to a file with the same content, so the content is only
+    stored once. The downloaded copy is kept if the file system does not support hardlinks.
+    """
+    link_path = temp_path + ".link"
+    try:
+        os.link(source, link_path)
+    except OSError:
+        return
+    os.replace(link_path, temp_path)
+
+
+def _publish(
+        temp_path: str,
+        original_path: str,
+        full_path: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"],
+        verbose: bool,
+    ) -> str | None:
+    """
+    Moves a finished download from its temporary file to the path claimed for it. Unless override is set to
+    `Write over`, the file is hardlinked into place, which fails instead of replacing a file that another program
+    created at the path since it was claimed; that file is then handled as if it existed before the download, and
+    copies are saved to the next free name (which is claimed until the file is there).
+
+    raises:
+        FileExistsError: If the path was taken and override is set to `Strict`
+
+    returns:
+        The location of the file or None if it was skipped.
+    """
+    if override == "Write over":
+        os.replace(temp_path, full_path)
+        return full_path
+    directory, name = os.path.split(original_path)
+    index = directory_index(directory)
+    target = full_path
+    try:
+        while True:
+            try:
+                os.link(temp_path, target)
+                os.remove(temp_path)
+                break
+            except FileExistsError:
+                pass
+            except OSError:
+                # the file system does not support hardlinks
+                if not os.path.lexists(target):
+                    os.replace(temp_path, target)
+                    break
+            if override == "Skip":
+                if verbose: print(f"A file was created at {target} during the download, skipping it.")
+                os.remove(temp_path)
+                return None
+            if override == "Strict": raise FileExistsError(f"A file exists at {target}.")
+            new_path = os.path.join(directory, index.claim_copy(name))
+            if verbose: print(f"A file was created at {target} during the download; writing to {new_path}.")
+            if target != full_path: index.release(os.path.basename(target), written=True)
+            target = new_path
+    except BaseException:
+        if target != full_path: index.release(os.path.basename(target))
+        raise
+    if target != full_path: index.release(os.path.basename(target), written=True)
+    return target
+
+
+def _load_segments(state_path: str, url: str, size: int, validator: str | None) -> list[list[int]] | None:
+    """
+    Loads the progress of an interrupted segmented download, if it belongs to the same version of the same file.
+
+    returns:
+        A list of `[start, end, done]` segments or None if there is nothing to resume.
+    """
+    try:
+        with open(state_path) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if (state.get("url"), state.get("size"), state.get("validator")) != (url, size, validator): return None
+    return state["segments"]
+
+
+def _save_segments(state_path: str, url: str, size: int, validator: str | None, segments: list[list[int]]) -> None:
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump({"url": url, "size": size, "validator": validator, "segments": segments}, file)
+    os.replace(temp_path, state_path)
+
+
+def _download_segmented(
+        url: str,
+        full_path: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"],
+        size: int,
+        validator: str | None,
+        num_segments: int,
+        requester: requests.Session,
+        block_size: tuple[int, int],
+        verbose: bool = False,
+        index: ContentIndex | None = None,
+        metrics: Metrics = NULL_METRICS,
+        health: HostHealth | None = None,
+        timeout: float | tuple[float, float] | None = TIMEOUT,
+    ) -> DownloadResult:
+    """
+    Downloads a file from a server supporting range requests using `num_segments` parallel connections, resuming
+    from a previous attempt if one was interrupted.
+    """
+    record = index.get(url) if index is not None else None
+    if record is not None and record.size == size and validator is not None and validator in (record.etag, record.last_modified):
+        if verbose: print(f"The file is unchanged since it was downloaded to {record.path}, skipping the download.")
+        return DownloadResult(url, "skipped", record.path)
+
+    # the progress is kept next to the original path, where it is found again when the download is resumed;
+    # parallel downloads of the same url take turns with it
+    part = part_path(full_path, url)
+    directories = directory_index(os.path.dirname(part))
+    directories.claim_turn(os.path.basename(part))
+    try:
+        # the target is resolved once, before anything is downloaded
+        target, reserved = _claim_path(full_path, override, verbose=verbose)
+        if target is None: return DownloadResult(url, "skipped")
+        written = False
+        try:
+            result = _fetch_segments(url, full_path, part, target, override, size, validator, num_segments, requester, block_size, verbose, index, metrics, health, timeout)
+            written = result.status == "downloaded" and result.path == target
+            return result
+        finally:
+            if reserved: _release_path(target, written)
+    finally:
+        directories.release(os.path.basename(part))
+
+
+def part_path(full_path: str, url: str) -> str:
+    """
+    The file a segmented download of `url` to `full_path` is written to; its progress is stored next to it with
+    `.json` appended. The name includes a hash of the url, so files of different urls with the same name do not
+    share it.
+    """
+    return f"{full_path}.{hashlib.blake2b(url.encode(), digest_size=4).hexdigest()}.part"
+
+
+def _fetch_segments(
+        url: str,
+        full_path: str,
+        part_path: str,
+        target: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"],
+        size: int,
+        validator: str | None,
+        num_segments: int,
+        requester: requests.Session,
+        block_size: tuple[int, int],
+        verbose: bool,
+        index: ContentIndex | None,
+        metrics: Metrics,
+        health: HostHealth | None,
+        timeout: float | tuple[float, float] | None,
+    ) -> DownloadResult:
+    """
+    Downloads the segments of `full_path` into `part_path` and moves it to `target` once they are complete.
+    """
+    state_path = part_path + ".json"
+    segments = _load_segments(state_path, url, size, validator) if os.path.isfile(part_path) else None
+    if segments is None:
+        segment_size = -(-size // num_segments)
+        segments = [[start, min(start + segment_size, size) - 1, 0] for start in range(0, size, segment_size)]
+        with open(part_path, "wb") as file:
+            file.truncate(size)
+        _save_segments(state_path, url, size, validator, segments)
+    elif verbose:
+        remaining = sum(end - start + 1 - done for start, end, done in segments)
+        print(f"Resuming the download of \"{full_path}\" with {remaining:,} of {size:,} bytes left.")
+
+    lock = threading.Lock()
+    last_save = time.monotonic()
+    received = 0
+
+    def fetch(segment: list[int]) -> None:
+        nonlocal last_save, received
+        start, end, done = segment
+        if start + done > end: return
+        response = _get(requester, url, health, timeout, headers={"Range": f"bytes={start + done}-{end}"}, stream=True)
+        host = urllib.parse.urlsplit(url).netloc
+        metrics.inc("requests", host=host, status=response.status_code)
+        metrics.observe("ttfb_seconds", response.elapsed.total_seconds(), host=host)
+        if response.status_code != 206:
+            raise ConnectionError(f"Expected a partial response for bytes {start + done}-{end}, got \"{response}\"")
+        with open(part_path, "r+b") as file:
+            file.seek(start + done)
+            for block in _adaptive_blocks(response, block_size):
+                block = block[:end + 1 - start - segment[2]]
+                file.write(block)
+                file.flush()
+                metrics.inc("bytes_in", len(block), host=host)
+                with lock:
+                    segment[2] += len(block)
+                    received += len(block)
+                    if time.monotonic() - last_save > SEGMENT_SAVE_INTERVAL:
+                        _save_segments(state_path, url, size, validator, segments)
+                        last_save = time.monotonic()
+                if start + segment[2] > end: break
+
+    if verbose: print(f"Downloading using {len(segments)} segments...")
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            list(executor.map(fetch, segments))
+    finally:
+        with lock:
+            _save_segments(state_path, url, size, validator, segments)
+    seconds = time.perf_counter() - start
+    if any(first + done <= last for first, last, done in segments):
+        warnings.warn(f"The download of \"{url}\" ended early; run it again to resume.")
+        return DownloadResult(url, "failed")
+
+    hash = hash_file(part_path) if index is not None or override == "Skip if same" else None
+    same = _same_content(full_path, size, hash, override, index) if hash is not None else None
+    if same is not None and override == "Skip if same":
+        os.remove(part_path)
+        os.remove(state_path)
+        if index is not None: index.record(url, _validator_headers(validator), hash, same)
+        if verbose: print(f"The same file exists at {same}, skipping the download.")
+        return DownloadResult(url, "skipped", same, size=received, seconds=seconds)
+    if same is not None: _link(same, part_path)
+
+    target = _publish(part_path, full_path, target, override, verbose)
+    os.remove(state_path)
+    if target is None: return DownloadResult(url, "skipped")
+    if index is not None: index.record(url, _validator_headers(validator), hash, target)
+    result = DownloadResult(url, "downloaded", target, size=received, seconds=seconds)
+    if verbose: print(f"Downloaded {received:,} bytes at {result.mb_per_s:.2f} MB/s.")
+    return result
+
+
+def _get(
+        requester: requests.Session,
+        url: str,
+        health: HostHealth | None,
+        timeout: float | tuple[float, float] | None,
+        **kwargs,
+    ) -> requests.Response:
+    """Sends a GET request, retried and recorded by `health` if it is given."""
+    if health is None: return requester.get(url, timeout=timeout, **kwargs)
+    return health.call(host_of(url), lambda: requester.get(url, timeout=timeout, **kwargs))
+
+
+def _validator_headers(validator: str | None) -> dict[str, str]:
+    """Converts the validator of a `FileInfo` back to the header it was taken from."""
+    if validator is None: return {}
+    return {"etag" if validator.startswith(('"', 'W/')) else "last-modified": validator}
+
+
+def download_many(
+        urls: Iterable[str],
+        path: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"] = "Edit name",
+        workers: int = 16,
+        per_host: int = 4,
+        verbose: bool = False,
+        segments: int = 1,
+        block_size: tuple[int, int] = (MIN_BLOCK_SIZE, MAX_BLOCK_SIZE),
+        index: ContentIndex | None = None,
+        metrics: Metrics | None = None,
+        health: HostHealth | None = None,
+        timeout: float | tuple[float, float] | None = TIMEOUT,
+    ) -> list[DownloadResult]:
+    """
+    Downloads many files concurrently using a pool of threads sharing one pooled session.
+
+    params:
+        urls: The remote sources which the files will be downloaded from.
+        path: The location of the directory which is used to store the downloaded files.
+        override: Same as in `download`; parallel downloads that resolve to the same file name are handled as if they
+            were downloaded one after another.
+        workers: The maximum number of downloads running at once.
+        per_host: The maximum number of downloads running at once from the same host.
+        verbose: If set to true, the function will produce more detailed output
+        segments: Same as in `download`.
+        block_size: Same as in `download`.
+        index: Same as in `download`.
+        metrics: Same as in `download`.
+        health: Same as in `download`.
+        timeout: Same as in `download`.
+
+    returns:
+        A `DownloadResult` for every url, in the same order as `urls`. Errors (including `FileExistsError` when
+        override is set to `Strict`) are stored in the result instead of being raised.
+    """
+    urls = list(urls)
+    host_limits: dict[str, threading.BoundedSemaphore] = {}
+    host_limits_lock = threading.Lock()
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def host_limit(url: str) -> threading.BoundedSemaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        with host_limits_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(per_host)
+            return host_limits[host]
+
+    def task(url: str) -> DownloadResult:
+        with host_limit(url):
+            try:
+                return download_file(url, path, None, override, verbose, session, segments, block_size, index, metrics, health, timeout)
+            except Exception as e:
+                if verbose: print(f"Failed to download \"{url}\": {e}")
+                return DownloadResult(url, "failed", error=e)
+
+    with session, _use_directory(path, scan=True), ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(executor.map(task, urls), total=len(urls), disable=not verbose))
+    return results
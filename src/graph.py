@@ -0,0 +1,300 @@
+"""
+This module stores the link graph of a crawl compactly.
+
+Urls are interned to consecutive integer ids: their bytes are appended to a
+single buffer, and an array-backed open addressing table maps the 64-bit
+hash of a url to its id (two urls only collide with a probability of about
+n / 2^64). Edges are appended to two arrays of 32-bit ids as they are found,
+about 8 bytes per edge, and sorted into the compressed sparse row (CSR) form
+when the out-links of pages are queried or the graph is exported.
+
+`LinkGraph.export` writes the graph to a binary file section by section, and
+`MappedGraph` memory-maps such a file, so the graph can be queried without
+reading it into memory. The file consists of a header of 8 magic bytes and
+4 unsigned 64-bit integers (nodes, edges, table size, url bytes), followed by
+the sections
+- `offsets`: nodes + 1 unsigned 64-bit integers; the out-links of node i
+    are `targets[offsets[i]:offsets[i + 1]]`.
+- `url_offsets`: nodes + 1 unsigned 64-bit integers; the url of node i is
+    `urls[url_offsets[i]:url_offsets[i + 1]]`.
+- `hashes`: table size unsigned 64-bit integers, the url hash table.
+- `targets`: edges unsigned 32-bit integers.
+- `in_degrees`: nodes unsigned 32-bit integers.
+- `ids`: table size unsigned 32-bit integers, the ids of the url hash table.
+- `urls`: url bytes bytes, the urls encoded as UTF-8.
+Numbers are stored in the byte order of the machine that wrote the file.
+"""
+
+
+import hashlib
+import mmap
+import struct
+from abc import ABC, abstractmethod
+from array import array
+from typing import BinaryIO, Iterable, Sequence
+
+
+MAGIC = b"LINKGRF1"
+_HEADER = struct.Struct("=8s4Q")
+
+
+def _hash(url: str) -> int:
+    # 0 marks an empty slot, so it can not be used as a hash
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "little") or 1
+
+
+def _find(hashes: Sequence[int], ids: Sequence[int], url: str) -> int | None:
+    """Looks up the id of a url in a hash table, using linear probing."""
+    hash, mask = _hash(url), len(hashes) - 1
+    i = hash & mask
+    while hashes[i] != 0:
+        if hashes[i] == hash: return ids[i]
+        i = (i + 1) & mask
+    return None
+
+
+def _bfs(offsets: Sequence[int], targets: Sequence[int], root: int) -> array:
+    """The number of links on the shortest path from the root to every node, -1 for unreachable nodes."""
+    depths = array("i", [-1]) * (len(offsets) - 1)
+    depths[root] = 0
+    frontier = [root]
+    depth = 0
+    while frontier:
+        depth += 1
+        next_frontier = []
+        for node in frontier:
+            for target in targets[offsets[node]:offsets[node + 1]]:
+                if depths[target] == -1:
+                    depths[target] = depth
+                    next_frontier.append(target)
+        frontier = next_frontier
+    return depths
+
+
+class _GraphQueries(ABC):
+    """The queries shared by `LinkGraph` and `MappedGraph`, which provide the arrays they work on."""
+
+    @abstractmethod
+    def _csr(self) -> tuple[Sequence[int], Sequence[int]]:
+        """The offsets and the targets of the edges in CSR form."""
+
+    @abstractmethod
+    def _in_degrees(self) -> Sequence[int]:
+        """The number of links to every node."""
+
+    @abstractmethod
+    def get_id(self, url: str) -> int | None:
+        """The id of a url, or None if it is not in the graph."""
+
+    @abstractmethod
+    def url(self, id: int) -> str:
+        """The url of an id."""
+
+    def _require_id(self, url: str) -> int:
+        id = self.get_id(url)
+        if id is None: raise KeyError(url)
+        return id
+
+    def out_links(self, url: str) -> list[str]:
+        offsets, targets = self._csr()
+        id = self._require_id(url)
+        return [self.url(target) for target in targets[offsets[id]:offsets[id + 1]]]
+
+    def out_degree(self, url: str) -> int:
+        offsets, _ = self._csr()
+        id = self._require_id(url)
+        return offsets[id + 1] - offsets[id]
+
+    def in_degree(self, url: str) -> int:
+        return self._in_degrees()[self._require_id(url)]
+
+    def depths(self, root: str) -> array:
+        """The BFS depth of every node (indexed by id) from the root, -1 for nodes it does not lead to."""
+        offsets, targets = self._csr()
+        return _bfs(offsets, targets, self._require_id(root))
+
+    def depth(self, url: str, root: str) -> int | None:
+        """The smallest number of links leading from the root to the url, or None if there is no path."""
+        depth = self.depths(root)[self._require_id(url)]
+        return depth if depth != -1 else None
+
+
+class LinkGraph(_GraphQueries):
+    def __init__(self, capacity: int = 1024) -> None:
+        """Creates an empty link graph.
+
+        Args:
+            capacity (int): The number of urls the graph is expected to
+                hold; the tables grow when needed.
+        """
+        size = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._hashes = array("Q", bytes(8 * size))
+        self._ids = array("I", bytes(4 * size))
+        self._urls = bytearray()
+        self._url_offsets = array("Q", [0])
+        self._sources = array("I")
+        self._targets = array("I")
+        self._out = array("I")
+        self._in = array("I")
+        self._csr_cache: tuple[array, array] | None = None
+
+    def __len__(self) -> int:
+        """The number of urls in the graph."""
+        return len(self._url_offsets) - 1
+
+    @property
+    def edges(self) -> int:
+        return len(self._sources)
+
+    def get_id(self, url: str) -> int | None:
+        return _find(self._hashes, self._ids, url)
+
+    def id(self, url: str) -> int:
+        """The id of a url, which is added to the graph if it is new."""
+        hash, mask = _hash(url), len(self._hashes) - 1
+        i = hash & mask
+        while self._hashes[i] != 0:
+            if self._hashes[i] == hash: return self._ids[i]
+            i = (i + 1) & mask
+        id = len(self)
+        self._hashes[i] = hash
+        self._ids[i] = id
+        self._urls += url.encode()
+        self._url_offsets.append(len(self._urls))
+        self._out.append(0)
+        self._in.append(0)
+        if 2 * len(self) > len(self._hashes): self._grow()
+        return id
+
+    def _grow(self) -> None:
+        hashes, ids = self._hashes, self._ids
+        self._hashes = array("Q", bytes(16 * len(hashes)))
+        self._ids = array("I", bytes(8 * len(ids)))
+        mask = len(self._hashes) - 1
+        for hash, id in zip(hashes, ids):
+            if hash == 0: continue
+            i = hash & mask
+            while self._hashes[i] != 0:
+                i = (i + 1) & mask
+            self._hashes[i] = hash
+            self._ids[i] = id
+
+    def url(self, id: int) -> str:
+        return self._urls[self._url_offsets[id]:self._url_offsets[id + 1]].decode()
+
+    def add_edges(self, source: str, targets: Iterable[str]) -> None:
+        """Adds the links from a page to other pages."""
+        source_id = self.id(source)
+        for target in targets:
+            target_id = self.id(target)
+            self._sources.append(source_id)
+            self._targets.append(target_id)
+            self._out[source_id] += 1
+            self._in[target_id] += 1
+        self._csr_cache = None
+
+    def _in_degrees(self) -> array:
+        return self._in
+
+    def _csr(self) -> tuple[array, array]:
+        """Sorts the edges by their source with a counting sort; the result is kept until edges are added."""
+        if self._csr_cache is not None: return self._csr_cache
+        offsets = array("Q", bytes(8 * (len(self) + 1)))
+        total = 0
+        for i, count in enumerate(self._out):
+            offsets[i] = total
+            total += count
+        offsets[len(self)] = total
+        positions = array("Q", offsets)
+        targets = array("I", bytes(4 * total))
+        for source, target in zip(self._sources, self._targets):
+            targets[positions[source]] = target
+            positions[source] += 1
+        self._csr_cache = offsets, targets
+        return self._csr_cache
+
+    def export(self, path: str) -> None:
+        """Writes the graph to a file which can be opened with `MappedGraph`, see the module documentation."""
+        offsets, targets = self._csr()
+        with open(path, "wb") as file:
+            file.write(_HEADER.pack(MAGIC, len(self), self.edges, len(self._hashes), len(self._urls)))
+            for section in (offsets, self._url_offsets, self._hashes, targets, self._in, self._ids):
+                _write(file, section)
+            file.write(self._urls)
+
+
+def _write(file: BinaryIO, values: array, chunk: int = 1 << 20) -> None:
+    """Writes an array in chunks, so no copy of the whole array is made."""
+    view = memoryview(values).cast("B")
+    for start in range(0, len(view), chunk):
+        file.write(view[start:start + chunk])
+
+
+class MappedGraph(_GraphQueries):
+    def __init__(self, path: str) -> None:
+        """Opens a graph exported by `LinkGraph.export` without reading it
+        into memory. It is closed with `close` or by using it as a context
+        manager.
+
+        Args:
+            path (str): The file the graph was exported to.
+
+        Raises:
+            ValueError: If the file is not an exported graph.
+        """
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            self._mmap.close()
+            raise ValueError(f"\"{path}\" is not a link graph")
+        magic, nodes, edges, table_size, url_bytes = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"\"{path}\" is not a link graph")
+        self.nodes, self.edges = nodes, edges
+
+        view = memoryview(self._mmap)
+        self._views = [view]
+        position = _HEADER.size
+
+        def section(format: str, length: int) -> memoryview:
+            nonlocal position
+            size = length * (8 if format == "Q" else 4 if format == "I" else 1)
+            part = view[position:position + size].cast(format)
+            self._views.append(part)
+            position += size
+            return part
+
+        self._offsets = section("Q", nodes + 1)
+        self._url_offsets = section("Q", nodes + 1)
+        self._hashes = section("Q", table_size)
+        self._targets = section("I", edges)
+        self._in = section("I", nodes)
+        self._ids = section("I", table_size)
+        self._urls = section("B", url_bytes)
+
+    def __len__(self) -> int:
+        return self.nodes
+
+    def get_id(self, url: str) -> int | None:
+        return _find(self._hashes, self._ids, url)
+
+    def url(self, id: int) -> str:
+        return bytes(self._urls[self._url_offsets[id]:self._url_offsets[id + 1]]).decode()
+
+    def _csr(self) -> tuple[memoryview, memoryview]:
+        return self._offsets, self._targets
+
+    def _in_degrees(self) -> memoryview:
+        return self._in
+
+    def close(self) -> None:
+        # the views have to be released before the map can be closed
+        for view in reversed(self._views): view.release()
+        self._mmap.close()
+
+    def __enter__(self) -> "MappedGraph":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,249 @@
+"""
+This module tracks the health of hosts, shared by the crawler and the
+downloader.
+
+Every response updates an exponentially weighted moving average (EWMA) of the
+error rate and of the latency of its host. Idempotent failures (timeouts,
+connection errors, 429 and 5xx responses) are retried with exponential
+backoff and full jitter; a `Retry-After` longer than the largest delay opens
+the circuit breaker of the host for that long instead. A circuit breaker opens for a host after several
+failures in a row or a high error rate: requests to it wait (the crawler
+and the download queue park its urls and serve other hosts) or fail fast
+(`download_file`) until the breaker lets a single probe request through;
+the breaker closes if the probe succeeds and stays open twice as long if it
+fails.
+"""
+
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Literal, Mapping, TypeVar
+
+import httpx
+import requests
+
+from src.scheduler import retry_after
+
+
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+RETRY_ERRORS = (
+    requests.ConnectionError, requests.Timeout,
+    httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError,
+    ConnectionError, TimeoutError,
+)
+
+R = TypeVar("R")
+
+
+class RetryableStatus(Exception):
+    """A response with a status that is worth retrying, raised so it is handled like a failed request."""
+
+    def __init__(self, status: int, headers: Mapping[str, str]) -> None:
+        super().__init__(f"The server responded with {status}")
+        self.status = status
+        self.retry_after = retry_after(headers)
+
+
+class HostUnavailable(Exception):
+    """Raised instead of sending a request to a host whose circuit breaker is open."""
+
+    def __init__(self, host: str, seconds: float) -> None:
+        super().__init__(f"\"{host}\" is failing, it is not contacted for {seconds:.1f} more seconds")
+        self.host = host
+        self.seconds = seconds
+
+
+def is_retryable(error: BaseException) -> bool:
+    return isinstance(error, RETRY_ERRORS + (RetryableStatus,))
+
+
+@dataclass
+class RetryPolicy:
+    """
+    attributes:
+        max_attempts: The number of times a request is sent before giving up.
+        base_delay: The upper bound of the delay before the first retry in seconds; it doubles with every attempt.
+        max_delay: The largest upper bound of the delay in seconds; `HostHealth.call` does not wait longer than
+            this for a `Retry-After` either, the host is held back instead.
+    """
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """The seconds to wait before the next attempt after `attempt` failed ones; `Retry-After` is a lower bound."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after) if retry_after is not None else delay
+
+
+@dataclass
+class HostStats:
+    """
+    attributes:
+        error_rate: The EWMA of the share of failed requests.
+        latency: The EWMA of the response time in seconds, or None before the first response.
+        state: `closed` while requests are sent normally, `open` while they are held back and `half-open` while
+            a single probe request is allowed.
+    """
+    error_rate: float = 0.0
+    latency: float | None = None
+    state: Literal["closed", "open", "half-open"] = "closed"
+
+
+class _Host:
+    def __init__(self) -> None:
+        self.stats = HostStats()
+        self.requests = 0
+        self.failures = 0  # in a row
+        self.open_until = 0.0
+        self.open_seconds = 0.0  # length of the last open period
+        self.probe_started: float | None = None
+
+
+class HostHealth:
+    def __init__(
+        self,
+        retry: RetryPolicy | None = None,
+        alpha: float = 0.2,
+        failure_threshold: int = 5,
+        error_rate_threshold: float = 0.5,
+        min_requests: int = 10,
+        open_seconds: float = 10.0,
+        max_open_seconds: float = 300.0,
+    ) -> None:
+        """Creates the health state of hosts. It can be shared by threads
+        and by the crawler and the downloader.
+
+        Args:
+            retry (RetryPolicy | None): How failed requests are retried.
+            alpha (float): The weight of the newest response in the moving
+                averages.
+            failure_threshold (int): The number of failures in a row which
+                opens the circuit breaker of a host.
+            error_rate_threshold (float): The error rate which opens the
+                circuit breaker of a host that got at least `min_requests`
+                requests.
+            min_requests (int): See `error_rate_threshold`.
+            open_seconds (float): How long the circuit breaker stays open at
+                first.
+            max_open_seconds (float): How long the circuit breaker stays open
+                at most after failed probes.
+        """
+        self.retry = retry or RetryPolicy()
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.hosts: dict[str, _Host] = {}
+        self.lock = threading.Lock()
+
+    def _host(self, host: str) -> _Host:
+        if host not in self.hosts: self.hosts[host] = _Host()
+        return self.hosts[host]
+
+    def stats(self, host: str) -> HostStats:
+        with self.lock:
+            stats = self._host(host).stats
+            return HostStats(stats.error_rate, stats.latency, stats.state)
+
+    def _wait(self, state: _Host, now: float) -> float:
+        if state.stats.state == "closed": return 0.0
+        if now < state.open_until: return state.open_until - now
+        if state.probe_started is not None and now - state.probe_started < self.open_seconds:
+            return self.open_seconds - (now - state.probe_started)
+        return 0.0
+
+    def wait_time(self, host: str) -> float:
+        """The number of seconds until a request may be sent to the host, without asking to send one."""
+        with self.lock:
+            return self._wait(self._host(host), time.monotonic())
+
+    def acquire(self, host: str) -> float:
+        """
+        Asks to send a request to the host.
+
+        Returns:
+            float: 0 if the request may be sent, otherwise the number of
+                seconds to wait before asking again
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self._host(host)
+            if (wait := self._wait(state, now)) > 0 or state.stats.state == "closed": return wait
+            # the first request after the breaker was open probes whether the host recovered
+            state.stats.state = "half-open"
+            state.probe_started = now
+            return 0.0
+
+    def record(self, host: str, ok: bool, seconds: float | None = None) -> None:
+        """Updates the health of the host with the outcome of a request and the time its response took."""
+        now = time.monotonic()
+        with self.lock:
+            state = self._host(host)
+            stats = state.stats
+            state.requests += 1
+            stats.error_rate += self.alpha * ((0.0 if ok else 1.0) - stats.error_rate)
+            if seconds is not None:
+                stats.latency = seconds if stats.latency is None else stats.latency + self.alpha * (seconds - stats.latency)
+            if ok:
+                state.failures = 0
+                if stats.state != "closed":
+                    stats.state = "closed"
+                    state.open_seconds = 0.0
+                    state.probe_started = None
+                return
+            state.failures += 1
+            if stats.state == "open" and now < state.open_until: return  # requests sent before the breaker opened
+            if (stats.state == "half-open" or state.failures >= self.failure_threshold
+                    or (state.requests >= self.min_requests and stats.error_rate >= self.error_rate_threshold)):
+                state.open_seconds = min(self.max_open_seconds, 2 * state.open_seconds or self.open_seconds)
+                state.open_until = now + state.open_seconds
+                state.probe_started = None
+                stats.state = "open"
+
+    def open_for(self, host: str, seconds: float) -> None:
+        """Opens the circuit breaker of the host for at least `seconds`, as asked for by a long `Retry-After`."""
+        now = time.monotonic()
+        with self.lock:
+            state = self._host(host)
+            state.open_until = max(state.open_until, now + seconds)
+            state.probe_started = None
+            state.stats.state = "open"
+
+    def call(self, host: str, send: Callable[[], R]) -> R:
+        """
+        Sends a blocking request with `send`, retrying idempotent failures and
+        recording their outcome. The response is returned once its status is
+        not worth retrying or the attempts are used up.
+
+        Raises:
+            HostUnavailable: If the circuit breaker of the host is open, or
+                the server asked to wait longer than `max_delay` of the
+                retry policy (which opens it for that long).
+        """
+        attempt = 0
+        while True:
+            if (wait := self.acquire(host)) > 0: raise HostUnavailable(host, wait)
+            attempt += 1
+            start = time.monotonic()
+            try:
+                response = send()
+            except RETRY_ERRORS:
+                self.record(host, False)
+                if attempt >= self.retry.max_attempts: raise
+                time.sleep(self.retry.delay(attempt))
+                continue
+            ok = response.status_code not in RETRY_STATUSES
+            self.record(host, ok, time.monotonic() - start)
+            if ok or attempt >= self.retry.max_attempts: return response
+            delay = self.retry.delay(attempt, retry_after(response.headers))
+            response.close()
+            if delay > self.retry.max_delay:
+                # the thread does not sleep through a long Retry-After, callers park the request instead
+                self.open_for(host, delay)
+                raise HostUnavailable(host, delay)
+            time.sleep(delay)
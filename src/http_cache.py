@@ -0,0 +1,109 @@
+"""
+This module implements an on-disk cache of crawled pages for crawls which
+visit the same sites again.
+
+For every page the validators of the response (`ETag`, `Last-Modified`) and
+the links extracted from it are stored. The next crawl sends them as
+`If-None-Match` / `If-Modified-Since`; when the server answers with
+`304 Not Modified` the cached links are reused without downloading or
+parsing the page again. The cache is bounded in size and evicts the least
+recently used pages first.
+"""
+
+
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Mapping
+
+from src.parsing import ParseResult
+
+
+@dataclass
+class CachedPage:
+    """
+    attributes:
+        base_url: The url the page was served from after redirects, used to resolve its links.
+        etag: The `ETag` of the response, if any.
+        last_modified: The `Last-Modified` date of the response, if any.
+        result: The links and selector matches found on the page.
+    """
+    base_url: str
+    etag: str | None
+    last_modified: str | None
+    result: ParseResult
+
+    def validators(self) -> dict[str, str]:
+        """The headers which make a request conditional on the page having changed."""
+        headers = {}
+        if self.etag is not None: headers["If-None-Match"] = self.etag
+        if self.last_modified is not None: headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int = 256 * 2 ** 20) -> None:
+        """Opens (or creates) the cache.
+
+        Args:
+            path (str): The location of the database file.
+            max_bytes (int): The maximum size of the stored links; the least
+                recently used pages are evicted when it is exceeded.
+        """
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                base_url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS lru ON pages (accessed);
+        """)
+        self.max_bytes = max_bytes
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url: str) -> CachedPage | None:
+        row = self.conn.execute(
+            "SELECT base_url, etag, last_modified, result FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None: return None
+        base_url, etag, last_modified, result = row
+        with self.conn:
+            self.conn.execute("UPDATE pages SET accessed = ? WHERE url = ?", (time.time(), url))
+        return CachedPage(base_url, etag, last_modified, ParseResult(**json.loads(result)))
+
+    def store(self, url: str, base_url: str, headers: Mapping[str, str], result: ParseResult) -> None:
+        """Stores the links found on a page, if the response has validators that allow checking it for changes."""
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is None and last_modified is None: return
+        data = json.dumps({"links": result.links, "selected": result.selected, "fingerprint": result.fingerprint})
+        size = len(data) + len(url) + len(base_url)
+        with self.conn:
+            old = self.conn.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (url, base_url, etag, last_modified, result, size, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, base_url, etag, last_modified, data, size, time.time()),
+            )
+        self.size += size - (old[0] if old else 0)
+        if self.size > self.max_bytes: self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used pages until the cache is at most 90% full."""
+        removed = []
+        for url, size in self.conn.execute("SELECT url, size FROM pages ORDER BY accessed"):
+            if self.size <= 0.9 * self.max_bytes: break
+            removed.append((url,))
+            self.size -= size
+        with self.conn:
+            self.conn.executemany("DELETE FROM pages WHERE url = ?", removed)
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,295 @@
+"""
+This module collects metrics of the crawler and the downloader: counters,
+latency histograms and gauges, each of which can be labelled (e.g. by host).
+
+The stages which are timed are:
+- `connect`: opening the connection, including the DNS lookup and the TLS
+    handshake (httpx does not report the DNS lookup separately).
+- `ttfb`: from sending the request to receiving the response headers.
+- `body`: receiving the response body.
+- `parse`: extracting the links of a page.
+- `queue_wait`: the time a url waits in the frontier of the crawler.
+- `write`: writing downloaded blocks to the disk.
+
+Metrics are sent to sinks: `JsonLinesSink` appends snapshots to a file,
+`SummarySink` prints a short summary, and `serve_prometheus` serves the
+Prometheus text format over HTTP. `Reporter` writes to sinks periodically.
+Code that is given no `Metrics` uses `NULL_METRICS`, whose methods do
+nothing, so collecting metrics costs (almost) nothing when it is disabled.
+"""
+
+
+import bisect
+import contextlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterable, Iterator, TextIO
+
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float | None:
+        """Estimates a quantile by interpolating within the bucket it falls into."""
+        if not self.count: return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if BUCKETS[i] != float("inf") else lower * 2 or 1.0
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-2]
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self) -> None:
+        """Creates an empty set of metrics. It can be shared by threads."""
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.gauges: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict[str, Any]) -> tuple[str, Labels]:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Adds to a counter, e.g. `metrics.inc("bytes_in", len(body), host=host)`."""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """Sets a gauge, e.g. the size of a queue."""
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        """Adds a duration to a histogram."""
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms: self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: Any) -> Iterator[None]:
+        """Observes how long the body of a `with` block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name: str) -> float:
+        """The sum of a counter over all labels."""
+        with self.lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def histogram(self, name: str) -> Histogram:
+        """A histogram merged over all labels."""
+        merged = Histogram()
+        with self.lock:
+            for (key, _), histogram in self.histograms.items():
+                if key == name: merged.merge(histogram)
+        return merged
+
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        """The current values of all metrics, in a form which can be serialized as JSON."""
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.gauges.items()],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum, "buckets": h.counts}
+                    for (name, labels), h in self.histograms.items()
+                ],
+            }
+
+    def prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        def labels_text(labels: Labels, extra: str = "") -> str:
+            # label values are escaped the same way as strings in JSON
+            parts = [f"{key}={json.dumps(value)}" for key, value in labels] + ([extra] if extra else [])
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines += [f"{name}{labels_text(labels)} {value}" for (key, labels), value in values.items() if key == name]
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (key, labels), h in self.histograms.items():
+                    if key != name: continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, h.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f'{name}_bucket{labels_text(labels, f"le={json.dumps(le)}")} {cumulative}')
+                    lines.append(f"{name}_sum{labels_text(labels)} {h.sum}")
+                    lines.append(f"{name}_count{labels_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics(Metrics):
+    """Metrics which are not collected."""
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        pass
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        pass
+
+    def time(self, name: str, **labels: Any) -> contextlib.nullcontext:
+        return contextlib.nullcontext()
+
+
+NULL_METRICS = NullMetrics()
+
+
+class HttpTrace:
+    """
+    Times the stages of an httpx request, passed to it as `extensions={"trace": trace}`.
+    """
+    def __init__(self) -> None:
+        self.started: dict[str, float] = {}
+        self.durations: dict[str, float] = {}
+
+    async def __call__(self, event: str, info: dict) -> None:
+        # events are named like "connection.connect_tcp.started" and "http11.receive_response_body.complete"
+        step, _, state = event.rpartition(".")
+        step = step.partition(".")[2]
+        now = time.perf_counter()
+        if state == "started": self.started[step] = now
+        elif state == "complete" and step in self.started: self.durations[step] = now - self.started[step]
+
+    def record(self, metrics: Metrics, **labels: Any) -> None:
+        """Adds the stages of the request to the histograms of `metrics`."""
+        durations = self.durations
+        connect = durations.get("connect_tcp", 0.0) + durations.get("start_tls", 0.0)
+        if "connect_tcp" in durations: metrics.observe("connect_seconds", connect, **labels)
+        if "receive_response_headers" in durations:
+            metrics.observe("ttfb_seconds", durations.get("send_request_headers", 0.0) + durations.get("send_request_body", 0.0) + durations["receive_response_headers"], **labels)
+        if "receive_response_body" in durations: metrics.observe("body_seconds", durations["receive_response_body"], **labels)
+
+
+class JsonLinesSink:
+    def __init__(self, path: str) -> None:
+        """Appends a snapshot of the metrics as a line of JSON to a file on every write."""
+        self.path = path
+
+    def write(self, metrics: Metrics) -> None:
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"time": time.time(), **metrics.snapshot()}) + "\n")
+
+
+class SummarySink:
+    def __init__(self, file: TextIO | None = None, stages: Iterable[str] = ("connect", "ttfb", "body", "parse", "queue_wait", "write")) -> None:
+        """Prints the throughput and the latency of every stage on every write."""
+        self.file = file
+        self.stages = tuple(stages)
+        self.last: tuple[float, float, float] | None = None  # time, requests and bytes of the last write
+
+    def write(self, metrics: Metrics) -> None:
+        now, requests, received = time.monotonic(), metrics.total("requests"), metrics.total("bytes_in")
+        parts = [f"{int(requests)} requests", f"{received / 1e6:.1f} MB in"]
+        if self.last is not None and now > self.last[0]:
+            seconds = now - self.last[0]
+            parts.append(f"{(requests - self.last[1]) / seconds:.1f} req/s")
+            parts.append(f"{(received - self.last[2]) / seconds / 1e6:.2f} MB/s")
+        self.last = (now, requests, received)
+        for stage in self.stages:
+            histogram = metrics.histogram(f"{stage}_seconds")
+            if histogram.count:
+                parts.append(f"{stage} p50 {histogram.quantile(0.5) * 1000:.1f} ms p99 {histogram.quantile(0.99) * 1000:.1f} ms")
+        with metrics.lock:
+            parts += [f"{name}{dict(labels) if labels else ''} {value:g}" for (name, labels), value in metrics.gauges.items()]
+        print(" | ".join(parts), file=self.file or sys.stdout)
+
+
+class Reporter:
+    def __init__(self, metrics: Metrics, sinks: Iterable[JsonLinesSink | SummarySink], interval: float = 10.0) -> None:
+        """Writes the metrics to the sinks every `interval` seconds in a
+        background thread while it is used as a context manager, and once more
+        when it stops.
+
+        Args:
+            metrics (Metrics): The metrics which are written.
+            sinks (Iterable): Objects with a `write(metrics)` method.
+            interval (float): The number of seconds between writes.
+        """
+        self.metrics = metrics
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "Reporter":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def write(self) -> None:
+        for sink in self.sinks: sink.write(self.metrics)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+
+def serve_prometheus(metrics: Metrics, port: int = 9100, host: str = "") -> ThreadingHTTPServer:
+    """Serves the metrics at `/metrics` in a background thread; stop it with `server.shutdown()`."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,171 @@
+"""
+This module implements the parse stage of the crawler.
+
+Pages are parsed in a process pool so that parsing large pages does not block
+the event loop of the crawler, and only the extracted links and selector
+matches are sent back. Two backends are available:
+- `bs4`: BeautifulSoup with any CSS selector.
+- `links`: a streaming tokenizer (`html.parser.HTMLParser`) which is a lot
+    faster but only supports selectors made of tag names, e.g. `img` or `img, video`.
+
+Both backends can also fingerprint the pages for near-duplicate detection
+(see `src.traps`), which is done in the parse stage because it needs the text
+of the page.
+"""
+
+
+import asyncio
+import multiprocessing
+import os
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Callable, Literal
+
+from bs4 import BeautifulSoup
+
+from src.traps import page_features, simhash
+
+
+@dataclass
+class ParseResult:
+    """
+    attributes:
+        links: The `href` of every link on the page, as written on the page.
+        selected: The `src` (or `href` if there is no `src`) of every element matching the selector.
+        fingerprint: The SimHash of the text and the links of the page, if it was requested.
+    """
+    links: list[str] = field(default_factory=list)
+    selected: list[str] = field(default_factory=list)
+    fingerprint: int | None = None
+
+
+def _element_url(attrs: dict[str, str | None], attributes: tuple[str, ...] = ("src", "href")) -> str | None:
+    """The value of the first of `attributes` the element has."""
+    for attribute in attributes:
+        if url := attrs.get(attribute): return url
+    return None
+
+
+def parse_bs4(
+        body: bytes,
+        encoding: str | None,
+        selector: str | None,
+        fingerprint: bool = False,
+        attributes: tuple[str, ...] = ("src", "href"),
+    ) -> ParseResult:
+    """`attributes` are the attributes of selected elements which are looked at, the first one present is used."""
+    soup = BeautifulSoup(body, features="html.parser", from_encoding=encoding)
+    result = ParseResult()
+    result.links = [href for tag in soup.select("a") if (href := tag.attrs.get("href"))]
+    if selector:
+        result.selected = [url for tag in soup.select(selector) if (url := _element_url(tag.attrs, attributes))]
+    if fingerprint: result.fingerprint = simhash(page_features(soup.get_text(" "), result.links))
+    return result
+
+
+class _LinkExtractor(HTMLParser):
+    def __init__(self, tags: frozenset[str], text: bool = False) -> None:
+        super().__init__(convert_charrefs=True)
+        self.tags = tags
+        self.result = ParseResult()
+        self.text: list[str] | None = [] if text else None
+        self.in_script = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag in ("script", "style"): self.in_script = True
+        if tag != "a" and tag not in self.tags: return
+        attrs = dict(attrs)
+        if tag == "a" and (href := attrs.get("href")):
+            self.result.links.append(href)
+        if tag in self.tags and (url := _element_url(attrs)):
+            self.result.selected.append(url)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in ("script", "style"): self.in_script = False
+
+    def handle_data(self, data: str) -> None:
+        # like `BeautifulSoup.get_text`, the text leaves out scripts and styles
+        if self.text is not None and not self.in_script: self.text.append(data)
+
+
+_TAG_SELECTOR = re.compile(r"^\s*[a-zA-Z][a-zA-Z0-9-]*\s*(,\s*[a-zA-Z][a-zA-Z0-9-]*\s*)*$")
+
+
+def selector_tags(selector: str | None) -> frozenset[str]:
+    """
+    Converts a selector made of tag names to the set of those names.
+
+    raises:
+        ValueError: If the selector uses anything other than tag names.
+    """
+    if not selector: return frozenset()
+    if not _TAG_SELECTOR.match(selector):
+        raise ValueError(f"The \"links\" backend only supports selectors made of tag names, not \"{selector}\"")
+    return frozenset(tag.strip().lower() for tag in selector.split(","))
+
+
+def parse_links(body: bytes, encoding: str | None, selector: str | None, fingerprint: bool = False) -> ParseResult:
+    extractor = _LinkExtractor(selector_tags(selector), fingerprint)
+    extractor.feed(body.decode(encoding or "utf-8", errors="replace"))
+    extractor.close()
+    result = extractor.result
+    if fingerprint: result.fingerprint = simhash(page_features(" ".join(extractor.text), result.links))
+    return result
+
+
+BACKENDS: dict[str, Callable[[bytes, str | None, str | None, bool], ParseResult]] = {
+    "bs4": parse_bs4,
+    "links": parse_links,
+}
+
+
+class Parser:
+    def __init__(
+        self,
+        backend: Literal["bs4", "links"] = "bs4",
+        selector: str | None = None,
+        processes: int | None = None,
+        max_in_flight: int | None = None,
+        fingerprint: bool = False,
+    ) -> None:
+        """Creates the parse stage used by the crawler.
+
+        Args:
+            backend (Literal["bs4", "links"]): The parser that is used, see
+                the module documentation.
+            selector (str | None): A CSS selector for elements whose urls
+                are selected for further processing.
+            processes (int | None): The number of processes parsing pages;
+                defaults to the number of CPUs, 0 parses pages on the event
+                loop.
+            max_in_flight (int | None): The maximum number of pages waiting
+                to be parsed or being parsed; callers of `parse` wait when it
+                is reached. Defaults to twice the number of processes.
+            fingerprint (bool): Compute the `fingerprint` of every page,
+                which is needed by `src.traps.TrapDetector`.
+        """
+        self.parse_func = BACKENDS[backend]
+        if backend == "links": selector_tags(selector)  # fail early on selectors the backend can not handle
+        self.selector = selector
+        self.fingerprint = fingerprint
+        if processes is None: processes = os.cpu_count() or 1
+        self.executor: Executor | None = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) if processes else None
+        if max_in_flight is None: max_in_flight = 2 * max(processes, 1)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def parse(self, body: bytes, encoding: str | None = None) -> ParseResult:
+        async with self.in_flight:
+            if self.executor is None: return self.parse_func(body, encoding, self.selector, self.fingerprint)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.parse_func, body, encoding, self.selector, self.fingerprint)
+
+    def close(self) -> None:
+        if self.executor is not None: self.executor.shutdown()
+
+    def __enter__(self) -> "Parser":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
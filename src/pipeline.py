@@ -0,0 +1,210 @@
+"""
+This module downloads the files selected by a crawl while the crawl is still
+running, so the total time is about the longer of crawling and downloading
+instead of their sum.
+
+The crawler puts every selected url into a bounded `DownloadQueue`, which is
+emptied by a pool of download workers. Each stage limits itself: the crawler
+waits for the parser when too many pages are being parsed, and for the
+download queue when it is full. Since there is no point at which the whole
+list of files is known, a `Budget` decided up front replaces the confirmation
+prompt.
+"""
+
+
+import asyncio
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Literal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.content_index import ContentIndex
+from src.file_downloader import MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, TIMEOUT, DownloadResult, download_file
+from src.health import HostHealth, HostUnavailable
+from src.metrics import NULL_METRICS, Metrics
+from src.probe import probe
+from src.scheduler import host_of
+
+
+@dataclass
+class Budget:
+    """
+    Limits on what a pipelined crawl downloads; urls selected after a limit is reached are skipped.
+
+    attributes:
+        max_files: The maximum number of files to download, or None for no limit.
+        max_bytes: The maximum total size of the downloaded files, or None for no limit. The size of every file is
+            probed before it is downloaded; files of unknown size are downloaded while the budget is not used up.
+    """
+    max_files: int | None = None
+    max_bytes: int | None = None
+
+
+class DownloadQueue:
+    def __init__(
+        self,
+        path: str,
+        override: Literal["Edit name", "Skip", "Skip if same", "Strict", "Write over"] = "Edit name",
+        workers: int = 16,
+        per_host: int = 4,
+        maxsize: int = 1_000,
+        budget: Budget | None = None,
+        verbose: bool = False,
+        segments: int = 1,
+        block_size: tuple[int, int] = (MIN_BLOCK_SIZE, MAX_BLOCK_SIZE),
+        index: ContentIndex | None = None,
+        metrics: Metrics | None = None,
+        health: HostHealth | None = None,
+        timeout: float | tuple[float, float] | None = TIMEOUT,
+    ) -> None:
+        """Creates a queue of urls which are downloaded by a pool of workers
+        as soon as they are put into it. It is used as an async context
+        manager; leaving the context waits for all downloads to finish.
+
+        Args:
+            path (str): The directory the files are downloaded to.
+            override (str): What to do if a file already exists, see
+                `src.file_downloader.download`.
+            workers (int): The maximum number of downloads running at once.
+            per_host (int): The maximum number of downloads running at once
+                from the same host.
+            maxsize (int): The number of urls that can wait for a worker;
+                `put` waits while the queue is full.
+            budget (Budget | None): Limits on the number and size of the
+                downloaded files.
+            verbose (bool): Print the outcome of every download.
+            segments (int): See `src.file_downloader.download`.
+            block_size (tuple[int, int]): See `src.file_downloader.download`.
+            index (ContentIndex | None): See `src.file_downloader.download`.
+            metrics (Metrics | None): Where the downloads and the size of
+                the queue are recorded, see `src.metrics`.
+            health (HostHealth | None): See `src.file_downloader.download`;
+                urls of hosts whose circuit breaker is open wait until it
+                lets requests through again instead of failing.
+            timeout (float | tuple[float, float] | None): See
+                `src.file_downloader.download`.
+        """
+        self.path = path
+        self.override = override
+        self.workers = workers
+        self.per_host = per_host
+        self.budget = budget or Budget()
+        self.verbose = verbose
+        self.segments = segments
+        self.block_size = block_size
+        self.index = index
+        self.metrics = metrics or NULL_METRICS
+        self.health = health
+        self.timeout = timeout
+
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize)
+        self.results: list[DownloadResult] = []
+        self.files = 0  # downloads started
+        self.bytes = 0  # bytes downloaded, or expected for running downloads
+        self.host_limits: dict[str, asyncio.Semaphore] = {}
+        self.tasks: list[asyncio.Task] = []
+        self.parked: set[asyncio.Task] = set()
+        self.executor: ThreadPoolExecutor | None = None
+        self.session: requests.Session | None = None
+
+    async def __aenter__(self) -> "DownloadQueue":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if exc_info[0] is None: await self.queue.join()
+        await self.close()
+
+    def start(self) -> None:
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def put(self, url: str) -> None:
+        """Adds a url to the queue, waiting while it is full."""
+        await self.queue.put(url)
+        self.metrics.set("download_queue_size", self.queue.qsize())
+
+    async def join(self) -> None:
+        """Waits until every url put into the queue is downloaded or skipped."""
+        await self.queue.join()
+
+    async def close(self) -> None:
+        """Stops the workers; urls still waiting in the queue are not downloaded."""
+        for task in self.tasks + list(self.parked): task.cancel()
+        await asyncio.gather(*self.tasks, *self.parked, return_exceptions=True)
+        self.tasks = []
+        if self.executor is not None: self.executor.shutdown()
+        if self.session is not None: self.session.close()
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self.host_limits[host]
+
+    async def _worker(self) -> None:
+        while True:
+            url = await self.queue.get()
+            self.metrics.set("download_queue_size", self.queue.qsize())
+            if self.health is not None and (wait := self.health.wait_time(host_of(url))) > 0:
+                self._park(url, wait)
+                continue
+            parked = False
+            try:
+                async with self._host_limit(url):
+                    result = await self._download(url)
+                if isinstance(result.error, HostUnavailable):
+                    # the circuit breaker opened while the url waited for a worker
+                    self._park(url, result.error.seconds)
+                    parked = True
+                    continue
+                self.results.append(result)
+                if self.verbose: print(f"{result.status.capitalize()} \"{url}\"" + (f": {result.error}" if result.error else ""))
+            finally:
+                if not parked: self.queue.task_done()
+
+    def _park(self, url: str, seconds: float) -> None:
+        """Puts the url of a failing host back into the queue once it waited. It keeps its place in the count of
+        unfinished urls meanwhile, so `join` waits for it."""
+        async def requeue() -> None:
+            await asyncio.sleep(seconds)
+            await self.queue.put(url)
+            self.queue.task_done()
+
+        task = asyncio.create_task(requeue())
+        self.parked.add(task)
+        task.add_done_callback(self.parked.discard)
+
+    async def _download(self, url: str) -> DownloadResult:
+        loop = asyncio.get_running_loop()
+        budget = self.budget
+        if budget.max_files is not None and self.files >= budget.max_files: return DownloadResult(url, "skipped")
+        if budget.max_bytes is not None and self.bytes >= budget.max_bytes: return DownloadResult(url, "skipped")
+        self.files += 1
+
+        expected = 0
+        if budget.max_bytes is not None:
+            info = await loop.run_in_executor(self.executor, probe, url, self.session)
+            expected = info.size or 0
+            if self.bytes + expected > budget.max_bytes:
+                self.files -= 1
+                return DownloadResult(url, "skipped")
+        # the expected size is reserved while the file downloads, so parallel downloads do not overrun the budget
+        self.bytes += expected
+        try:
+            result = await loop.run_in_executor(
+                self.executor, download_file,
+                url, self.path, None, self.override, False, self.session, self.segments, self.block_size, self.index, self.metrics, self.health, self.timeout,
+            )
+        except Exception as e:
+            result = DownloadResult(url, "failed", error=e)
+        self.bytes += result.size - expected
+        if result.status != "downloaded": self.files -= 1
+        return result
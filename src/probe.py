@@ -0,0 +1,150 @@
+"""
+This module finds the size and type of remote files without downloading them.
+
+Probed results are cached, so the download step can reuse what was found while
+confirming the download instead of asking the server again. Only successful
+probes are cached, for `CACHE_TTL` seconds, and the oldest results are dropped
+once `CACHE_SIZE` files are cached.
+"""
+
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@dataclass(frozen=True)
+class FileInfo:
+    """
+    What is known about a remote file.
+
+    attributes:
+        size: The size of the file in bytes, or None if the server did not say.
+        content_type: The `Content-Type` of the file, if known.
+        accept_ranges: True if the server accepts byte range requests for the file.
+        validator: The `ETag` of the file, or its `Last-Modified` date if there is no ETag.
+    """
+    size: int | None
+    content_type: str | None = None
+    accept_ranges: bool = False
+    validator: str | None = None
+
+
+CACHE_SIZE = 10_000  # the most probed files that are cached
+CACHE_TTL = 5 * 60.0  # seconds a probed result is used for
+
+
+_cache: OrderedDict[str, tuple[float, FileInfo]] = OrderedDict()  # url -> (expiry, info), the oldest first
+_cache_lock = threading.Lock()
+
+
+def cached(url: str) -> FileInfo | None:
+    """
+    returns:
+        The result of a previous successful probe of the url or None if there is none or it expired.
+    """
+    with _cache_lock:
+        entry = _cache.get(url)
+        if entry is None: return None
+        if entry[0] < time.monotonic():
+            del _cache[url]
+            return None
+        return entry[1]
+
+
+def _store(url: str, info: FileInfo) -> None:
+    with _cache_lock:
+        _cache[url] = (time.monotonic() + CACHE_TTL, info)
+        _cache.move_to_end(url)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def _content_range_size(content_range: str | None) -> int | None:
+    """
+    Reads the complete length from a header such as `bytes 0-0/1234`.
+    """
+    if not content_range: return None
+    total = content_range[content_range.rfind("/") + 1:].strip()
+    return int(total) if total.isdigit() else None
+
+
+def probe(url: str, session: requests.Session = None, timeout: float = 10.0) -> FileInfo:
+    """
+    Finds the size and type of a remote file, using a cached result if the url was probed before.
+
+    A HEAD request is sent first; if it does not report a size, a GET request for the first byte of the file is
+    sent and the size is read from its `Content-Range` header.
+
+    params:
+        url: The remote file.
+        session: The session used to send the requests; if left empty, a new connection is made.
+        timeout: The number of seconds to wait for the server before giving up.
+
+    returns:
+        What could be found about the file; failed requests and error responses result in an unknown size and are
+        not cached.
+    """
+    if (info := cached(url)) is not None: return info
+    requester = session or requests
+    try:
+        head = requester.head(url, allow_redirects=True, timeout=timeout)
+        ok = head.ok
+        headers = head.headers if ok else {}
+        size = headers.get("Content-Length")
+        size = int(size) if size and size.isdigit() else None
+        accept_ranges = headers.get("Accept-Ranges", "").lower() == "bytes"
+        if size is None:
+            with requester.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout) as resp:
+                if resp.status_code == 206:
+                    accept_ranges = True
+                    size = _content_range_size(resp.headers.get("Content-Range"))
+                elif resp.ok and resp.headers.get("Content-Length", "").isdigit():
+                    size = int(resp.headers["Content-Length"])
+                if resp.ok:
+                    ok = True
+                    headers = headers or resp.headers
+    except requests.RequestException:
+        return FileInfo(None)
+    if not ok: return FileInfo(None)
+    info = FileInfo(
+        size,
+        headers.get("Content-Type"),
+        accept_ranges,
+        headers.get("ETag") or headers.get("Last-Modified"),
+    )
+    _store(url, info)
+    return info
+
+
+def probe_many(urls: Iterable[str], workers: int = 16, timeout: float = 10.0) -> dict[str, FileInfo]:
+    """
+    Probes many remote files concurrently, see `probe`.
+
+    params:
+        urls: The remote files.
+        workers: The maximum number of probes running at once.
+        timeout: The number of seconds to wait for the server before giving up on a file.
+
+    returns:
+        The information found for every distinct url.
+    """
+    urls = list(dict.fromkeys(urls))
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = executor.map(lambda url: probe(url, session, timeout), urls)
+        return dict(zip(urls, infos))
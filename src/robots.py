@@ -0,0 +1,168 @@
+"""
+This module implements a per-host cache of robots.txt rules for the crawler.
+
+The robots.txt of a host is fetched once, the first time the host is seen,
+and its rules are compiled to regular expressions so checking a url does not
+need another request. Rules expire after a time to live; hosts without a
+robots.txt (4xx) allow everything and hosts whose robots.txt can not be
+fetched (5xx, network errors) are not crawled until a shorter time to live
+expires. See https://www.rfc-editor.org/rfc/rfc9309 for the format.
+"""
+
+
+import asyncio
+import re
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+
+import httpx
+
+
+@dataclass
+class RobotsRules:
+    """
+    The rules of a robots.txt that apply to one user agent.
+
+    attributes:
+        rules: (allow, pattern) pairs, sorted from the longest pattern to the shortest.
+        crawl_delay: The number of seconds to wait between requests, if given.
+        sitemaps: The urls of the sitemaps listed in the file.
+    """
+    rules: list[tuple[bool, re.Pattern]] = field(default_factory=list)
+    crawl_delay: float | None = None
+    sitemaps: list[str] = field(default_factory=list)
+
+    def allowed(self, url: str) -> bool:
+        """The longest matching pattern decides; urls matching no pattern are allowed."""
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        for allow, pattern in self.rules:
+            if pattern.match(path): return allow
+        return True
+
+
+ALLOW_ALL = RobotsRules()
+DISALLOW_ALL = RobotsRules([(False, re.compile(""))])
+
+
+def compile_pattern(pattern: str) -> re.Pattern:
+    """Converts a robots.txt path pattern, which may use `*` wildcards and a `$` end anchor, to a regex."""
+    anchored = pattern.endswith("$")
+    if anchored: pattern = pattern[:-1]
+    regex = ".*".join(re.escape(part) for part in pattern.split("*"))
+    return re.compile(regex + ("$" if anchored else ""))
+
+
+def parse_robots(text: str, user_agent: str) -> RobotsRules:
+    """
+    Parses a robots.txt, keeping the rules of the group that matches `user_agent` most specifically
+    (or the `*` group if there is none).
+    """
+    user_agent = user_agent.lower()
+    groups: dict[str, list[tuple[str, str]]] = {}
+    sitemaps = []
+    agents: list[str] = []
+    in_rules = False
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        key, colon, value = line.partition(":")
+        if not colon: continue
+        key, value = key.strip().lower(), value.strip()
+        if key == "sitemap":
+            sitemaps.append(value)
+        elif key == "user-agent":
+            if in_rules: agents = []  # a user-agent line after rules starts a new group
+            in_rules = False
+            agents.append(value.lower())
+            groups.setdefault(value.lower(), [])
+        elif key in ("allow", "disallow", "crawl-delay"):
+            in_rules = True
+            for agent in agents: groups[agent].append((key, value))
+
+    matching = [agent for agent in groups if agent != "*" and agent in user_agent]
+    group = groups.get(max(matching, key=len) if matching else "*", [])
+    rules = RobotsRules(sitemaps=sitemaps)
+    patterns = []
+    for key, value in group:
+        if key == "crawl-delay":
+            try:
+                rules.crawl_delay = float(value)
+            except ValueError:
+                pass
+        elif value:  # an empty disallow allows everything
+            patterns.append((len(value), key == "allow", value))
+    # longest pattern first; allow wins ties
+    patterns.sort(reverse=True)
+    rules.rules = [(allow, compile_pattern(pattern)) for _length, allow, pattern in patterns]
+    return rules
+
+
+class RobotsCache:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        user_agent: str = "*",
+        ttl: float = 24 * 60 * 60,
+        error_ttl: float = 60 * 60,
+    ) -> None:
+        """Creates an empty cache of robots.txt rules.
+
+        Args:
+            client (httpx.AsyncClient): The client used to fetch robots.txt.
+            user_agent (str): The user agent whose rules are followed.
+            ttl (float): The number of seconds rules are kept.
+            error_ttl (float): The number of seconds a host whose robots.txt
+                could not be fetched is not crawled.
+        """
+        self.client = client
+        self.user_agent = user_agent
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.hosts: dict[str, tuple[RobotsRules, float]] = {}
+        self.fetching: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urllib.parse.urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def cached(self, url: str) -> RobotsRules | None:
+        """The rules for the host of the url, or None if they are not known (anymore)."""
+        entry = self.hosts.get(self._origin(url))
+        if entry is None or entry[1] < time.monotonic(): return None
+        return entry[0]
+
+    def allowed(self, url: str) -> bool | None:
+        """True or False if the url may (not) be crawled, or None if the rules for its host are not known yet."""
+        rules = self.cached(url)
+        return None if rules is None else rules.allowed(url)
+
+    def prefetch(self, url: str) -> None:
+        """Starts fetching the robots.txt of the host of the url in the background, if needed."""
+        origin = self._origin(url)
+        if origin in self.fetching or self.cached(url) is not None: return
+        self.fetching[origin] = asyncio.create_task(self._fetch(origin))
+
+    async def rules(self, url: str) -> RobotsRules:
+        """The rules for the host of the url, fetching its robots.txt if they are not known."""
+        if (rules := self.cached(url)) is not None: return rules
+        self.prefetch(url)
+        return await self.fetching[self._origin(url)]
+
+    async def _fetch(self, origin: str) -> RobotsRules:
+        try:
+            resp = await self.client.get(origin + "/robots.txt", follow_redirects=True)
+            if resp.is_success:
+                rules, ttl = parse_robots(resp.text, self.user_agent), self.ttl
+            elif resp.status_code < 500:
+                rules, ttl = ALLOW_ALL, self.ttl
+            else:
+                rules, ttl = DISALLOW_ALL, self.error_ttl
+        except httpx.HTTPError:
+            rules, ttl = DISALLOW_ALL, self.error_ttl
+        finally:
+            # other errors reach the callers waiting for the rules, and the next lookup fetches them again
+            del self.fetching[origin]
+        self.hosts[origin] = (rules, time.monotonic() + ttl)
+        return rules
@@ -0,0 +1,221 @@
+"""
+This module implements the per-host politeness scheduler used by the crawler.
+
+Every host gets a token bucket which limits how often it is contacted and a
+limit on the number of requests to it which may be in flight at once. Workers
+are handed the url of whichever host is ready next, so a crawl over many hosts
+runs at full speed while each single host is only contacted politely. Among
+the hosts that are ready, the url with the lowest (depth, -score) is handed
+out first, which makes the scheduler the priority frontier of the crawl.
+"""
+
+
+import asyncio
+import email.utils
+import heapq
+import itertools
+import time
+import urllib.parse
+from typing import Mapping
+
+
+def host_of(url: str) -> str:
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def retry_after(headers: Mapping[str, str]) -> float | None:
+    """
+    Reads the `Retry-After` header, which is either a number of seconds or an HTTP date.
+
+    Returns:
+        float | None: The number of seconds to wait or None if there is no
+            (valid) header
+    """
+    value = headers.get("Retry-After")
+    if value is None: return None
+    value = value.strip()
+    if value.isdigit(): return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class _Host:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.urls: list[tuple[int, float, int, str]] = []  # heap of (depth, -score, order, url)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.not_before = 0.0
+        self.entry: tuple | None = None  # the entry of the host in the scheduler's heaps, older entries are ignored
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """The time at which a request to the host can be sent, ignoring the in flight limit."""
+        self.refill(now)
+        ready = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(ready, self.not_before)
+
+
+class HostScheduler:
+    def __init__(self, rate: float = 1.0, burst: int = 1, max_in_flight: int = 2) -> None:
+        """Creates a queue of urls which hands out urls per host at a polite
+        rate. It is used like an `asyncio.Queue`: every url returned by `get`
+        has to be followed by a call to `task_done`.
+
+        Args:
+            rate (float): The number of requests per second allowed to a
+                single host.
+            burst (int): The number of requests that can be sent to a host at
+                once after it has been left alone for a while.
+            max_in_flight (int): The maximum number of unfinished requests to
+                a single host.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.hosts: dict[str, _Host] = {}
+        self._heap: list[tuple[float, int, str]] = []  # hosts waiting for their turn, by the time they are ready
+        self._ready: list[tuple[int, float, int, str]] = []  # hosts that are ready, by the priority of their best url
+        self._counter = itertools.count()
+        self._getters: list[asyncio.Future] = []
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self._size = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    @property
+    def unfinished(self) -> int:
+        """The number of urls (and holds) which were not marked as done yet."""
+        return self._unfinished
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def _host(self, host: str) -> _Host:
+        if host not in self.hosts:
+            self.hosts[host] = _Host(self.rate, self.burst)
+        return self.hosts[host]
+
+    def _schedule(self, host: str) -> None:
+        """Adds the host to the heap of ready hosts or of hosts waiting for their turn."""
+        state = self.hosts[host]
+        if state.entry is not None or not state.urls or state.in_flight >= self.max_in_flight: return
+        now = time.monotonic()
+        ready_at = state.ready_at(now)
+        if ready_at <= now:
+            depth, neg_score, *_ = state.urls[0]
+            state.entry = (depth, neg_score, next(self._counter), host)
+            heapq.heappush(self._ready, state.entry)
+        else:
+            state.entry = (ready_at, next(self._counter), host)
+            heapq.heappush(self._heap, state.entry)
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        for getter in self._getters:
+            if not getter.done(): getter.set_result(None)
+        self._getters.clear()
+
+    def put_nowait(self, url: str, depth: int = 0, score: float = 0.0) -> None:
+        """Adds a url to the queue; urls with a lower depth and then a higher score are handed out first."""
+        host = host_of(url)
+        state = self._host(host)
+        heapq.heappush(state.urls, (depth, -score, next(self._counter), url))
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        if state.entry is not None and len(state.entry) == 4 and (depth, -score) < state.entry[:2]:
+            state.entry = None  # the host is ready and its best url changed, so it is pushed again with the new priority
+        self._schedule(host)
+
+    async def put(self, url: str, depth: int = 0, score: float = 0.0) -> None:
+        self.put_nowait(url, depth, score)
+
+    def _pop_ready(self) -> tuple[str, int] | None:
+        """Takes the best url from the hosts that may be contacted now, if there is one."""
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            state = self.hosts[entry[-1]]
+            if entry is not state.entry: continue
+            state.entry = None
+            self._schedule(entry[-1])
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            host = entry[-1]
+            state = self.hosts[host]
+            if entry is not state.entry: continue
+            state.entry = None
+            if not state.urls or state.in_flight >= self.max_in_flight: continue
+            now = time.monotonic()
+            if state.ready_at(now) > now:
+                self._schedule(host)
+                continue
+            state.tokens -= 1
+            state.in_flight += 1
+            self._size -= 1
+            depth, _neg_score, _, url = heapq.heappop(state.urls)
+            self._schedule(host)
+            return url, depth
+        return None
+
+    async def get(self) -> tuple[str, int]:
+        """Waits until some host may be contacted and returns one of its urls with its depth."""
+        loop = asyncio.get_running_loop()
+        while (item := self._pop_ready()) is None:
+            timeout = max(0.0, self._heap[0][0] - time.monotonic()) if self._heap else None
+            getter = loop.create_future()
+            self._getters.append(getter)
+            try:
+                await asyncio.wait_for(getter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if getter in self._getters: self._getters.remove(getter)
+        return item
+
+    def task_done(self, url: str) -> None:
+        """Marks a url returned by `get` as finished, which frees a slot for its host."""
+        host = host_of(url)
+        self.hosts[host].in_flight -= 1
+        self._unfinished -= 1
+        if self._unfinished == 0: self._finished.set()
+        self._schedule(host)
+
+    def hold(self) -> None:
+        """Keeps `join` waiting until `release` is called, e.g. while urls are added by something other than the workers."""
+        self._unfinished += 1
+        self._finished.clear()
+
+    def release(self) -> None:
+        self._unfinished -= 1
+        if self._unfinished == 0: self._finished.set()
+
+    async def join(self) -> None:
+        """Waits until every url that was put in the queue has been marked as done."""
+        while self._unfinished:
+            await self._finished.wait()
+
+    def delay_host(self, url: str, seconds: float) -> None:
+        """Prevents requests to the host of the url for the given number of seconds, e.g. because of `Retry-After`."""
+        state = self._host(host_of(url))
+        state.not_before = max(state.not_before, time.monotonic() + seconds)
+
+    def set_crawl_delay(self, host: str, seconds: float) -> None:
+        """Limits the host to one request every `seconds`, as asked for by a `Crawl-delay` rule."""
+        if seconds <= 0: return
+        state = self._host(host.lower())
+        state.rate = min(state.rate, 1 / seconds)
+        state.burst = 1
+        state.tokens = min(state.tokens, 1)
@@ -0,0 +1,150 @@
+"""
+This module implements compact sets of seen urls for crawls that find too
+many urls to keep them all in a `set[str]`.
+
+- `HashSet64` stores a 64-bit hash of every url in an array-backed open
+    addressing table (about 16 bytes per url). Two urls only collide with a
+    probability of about n / 2^64.
+- `BloomFilter` is a scalable Bloom filter (about 2 bytes per url at a false
+    positive rate of 1e-4) which grows by adding larger filters with tighter
+    error rates, so the configured false positive rate holds however many
+    urls are added.
+
+Neither of them can list the urls they contain; both support `in`, `add`
+and `len` like the set they replace.
+"""
+
+
+import hashlib
+import math
+from array import array
+from typing import Iterable
+
+
+def _hash128(url: str) -> int:
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=16).digest(), "little")
+
+
+class HashSet64:
+    def __init__(self, capacity: int = 1024) -> None:
+        """Creates an empty set of url hashes.
+
+        Args:
+            capacity (int): The number of urls the set is expected to hold;
+                the table grows when needed.
+        """
+        size = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._table = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._len = 0
+
+    @staticmethod
+    def _hash(url: str) -> int:
+        # 0 marks an empty slot, so it can not be used as a hash
+        return (_hash128(url) & 0xFFFF_FFFF_FFFF_FFFF) or 1
+
+    def _slot(self, hash: int) -> int:
+        """Finds the slot holding the hash or the empty slot where it belongs, using linear probing."""
+        table, mask = self._table, self._mask
+        i = hash & mask
+        while table[i] != 0 and table[i] != hash:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, url: str) -> bool:
+        return self._table[self._slot(self._hash(url))] != 0
+
+    def add(self, url: str) -> None:
+        hash = self._hash(url)
+        i = self._slot(hash)
+        if self._table[i] != 0: return
+        self._table[i] = hash
+        self._len += 1
+        if 2 * self._len > len(self._table): self._grow()
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls: self.add(url)
+
+    def _grow(self) -> None:
+        old = self._table
+        self._table = array("Q", bytes(16 * len(old)))
+        self._mask = len(self._table) - 1
+        for hash in old:
+            if hash != 0: self._table[self._slot(hash)] = hash
+
+    def __len__(self) -> int:
+        return self._len
+
+
+class _Filter:
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, hash: int) -> list[int]:
+        # double hashing: the i-th position is h1 + i * h2
+        h1, h2 = hash & 0xFFFF_FFFF_FFFF_FFFF, hash >> 64 | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, hash: int) -> bool:
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._positions(hash))
+
+    def add(self, hash: int) -> None:
+        for i in self._positions(hash):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+
+class BloomFilter:
+    def __init__(
+        self,
+        error_rate: float = 1e-4,
+        initial_capacity: int = 100_000,
+        growth: int = 2,
+        tightening: float = 0.5,
+    ) -> None:
+        """Creates an empty scalable Bloom filter.
+
+        Args:
+            error_rate (float): The maximum probability that a url which was
+                never added is reported as seen.
+            initial_capacity (int): The number of urls the first filter
+                holds before a larger one is added.
+            growth (int): How many times larger each new filter is than
+                the previous one.
+            tightening (float): How much smaller the error rate of each new
+                filter is than that of the previous one.
+        """
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        # the error rates of the filters form a geometric series which adds up to `error_rate`
+        self._filters = [_Filter(initial_capacity, error_rate * (1 - tightening))]
+        self._len = 0
+
+    def __contains__(self, url: str) -> bool:
+        hash = _hash128(url)
+        return any(hash in bloom for bloom in self._filters)
+
+    def add(self, url: str) -> None:
+        hash = _hash128(url)
+        if any(hash in bloom for bloom in self._filters): return
+        last = self._filters[-1]
+        if last.count >= last.capacity:
+            last = _Filter(last.capacity * self.growth, self.error_rate * (1 - self.tightening) * self.tightening ** len(self._filters))
+            self._filters.append(last)
+        last.add(hash)
+        self._len += 1
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls: self.add(url)
+
+    def __len__(self) -> int:
+        """The number of added urls, not counting urls that were wrongly reported as seen when they were added."""
+        return self._len
+
+    def size_in_bytes(self) -> int:
+        return sum(len(bloom.bits) for bloom in self._filters)
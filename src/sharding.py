@@ -0,0 +1,470 @@
+"""
+This module runs a crawl on several processes, which may run on several
+machines.
+
+Hosts are hashed to N shards, each crawled by its own process with its own
+`Crawler`, event loop, seen set and frontier. A coordinator connects the
+shards over Unix sockets or TCP: links found by a shard for hosts of other
+shards are batched per shard and forwarded by the coordinator, which also
+enforces the global `max_sites` (by granting shards blocks of admissions) and
+detects the end of the crawl. `max_depth` is global without coordination,
+since the depth of every url travels with it; as the shards run at their own
+pace, a url can be found over a longer path before its shortest one, so close
+to `max_depth` a sharded crawl may miss a few pages a single crawler finds.
+
+The crawl is over once every shard has run out of work and has processed
+every batch forwarded to it. A shard reports to the coordinator whenever it
+runs out of work, after the batches it sent, with the number of batches it
+processed; as a shard only gets new work through batches, the crawl is over
+when every shard's last report counts all the batches forwarded to it.
+
+Every message is a frame: a header with the length of the payload, the kind
+of the message and a shard (the sender or the receiver of links), followed
+by the payload. Links are sent as lines of `<depth>\\t<url>`.
+
+`crawl_sharded` runs a crawl with the coordinator in the current process and
+the shards in processes it starts; shards on other machines are started with
+`run_shard` pointed at the TCP address of a `Coordinator`.
+"""
+
+
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+from warnings import warn
+
+import httpx
+
+from src.crawler import Crawler, UrlFilterer
+from src.parsing import Parser
+from src.scheduler import host_of
+
+
+BATCH_SIZE = 256  # links sent to another shard at once
+FLUSH_INTERVAL = 0.01  # seconds between sends of partial batches and checks whether a shard ran out of work
+QUOTA_BLOCK = 64  # the most admissions granted to a shard at once
+
+Address = str | tuple[str, int]  # the path of a Unix socket or a TCP host and port
+
+_FRAME = struct.Struct("!IBH")  # payload length, kind, shard
+HELLO, LINKS, QUOTA, GRANT, IDLE, STOP, DONE = range(7)
+
+
+def shard_of(url: str, shards: int) -> int:
+    """The shard owning the host of the url."""
+    return int.from_bytes(hashlib.blake2b(host_of(url).encode(), digest_size=8).digest(), "little") % shards
+
+
+class _Channel:
+    """A connection which sends and receives frames."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, kind: int, shard: int, payload: bytes = b"") -> None:
+        self.writer.write(_FRAME.pack(len(payload), kind, shard) + payload)
+
+    async def recv(self) -> tuple[int, int, bytes] | None:
+        """The next frame as (kind, shard, payload), or None once the connection is closed."""
+        try:
+            length, kind, shard = _FRAME.unpack(await self.reader.readexactly(_FRAME.size))
+            return kind, shard, await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def _connect(address: Address) -> _Channel:
+    if isinstance(address, str): return _Channel(*await asyncio.open_unix_connection(address))
+    return _Channel(*await asyncio.open_connection(*address))
+
+
+@dataclass
+class ShardedResult:
+    """
+    The outcome of a sharded crawl.
+
+    attributes:
+        parsed: The number of parsed pages.
+        admitted: The number of admitted urls, including the start urls.
+        urls: The admitted urls.
+        selected: The urls matching the selector.
+        seconds: The time from starting the coordinator to the end of the crawl.
+        shards: The `parsed` and `admitted` counts of every shard.
+    """
+    parsed: int = 0
+    admitted: int = 0
+    urls: set[str] = field(default_factory=set)
+    selected: set[str] = field(default_factory=set)
+    seconds: float = 0.0
+    shards: list[dict[str, int]] = field(default_factory=list)
+
+
+class Coordinator:
+    def __init__(self, shards: int, max_sites: int = -1, start_urls: int = 0) -> None:
+        """Creates the coordinator of a sharded crawl; start it with `start`
+        and wait for the crawl with `wait`.
+
+        Args:
+            shards (int): The number of shards.
+            max_sites (int): The maximum number of admitted urls over all
+                shards, -1 for no limit.
+            start_urls (int): The number of start urls, which are admitted
+                by the shards without asking for admissions.
+        """
+        self.shards = shards
+        self.remaining = max_sites - start_urls if max_sites != -1 else None
+        self.channels: dict[int, _Channel] = {}
+        self.pending: dict[int, list[bytes]] = {}  # frames for shards which did not connect yet
+        self.forwarded = [0] * shards  # batches forwarded to every shard
+        self.idle: list[int | None] = [None] * shards  # batches processed by every shard when it last ran out of work
+        self.stopping = False
+        self.results: dict[int, dict[str, Any]] = {}
+        self.finished = asyncio.Event()
+        self.server: asyncio.Server | None = None
+        self.address: Address | None = None
+
+    async def start(self, address: Address) -> Address:
+        """Starts listening for shards; a TCP port of 0 picks a free port.
+
+        Returns:
+            Address: The address shards connect to
+        """
+        if isinstance(address, str):
+            self.server = await asyncio.start_unix_server(self._serve, address)
+            self.address = address
+        else:
+            self.server = await asyncio.start_server(self._serve, *address)
+            self.address = address[0], self.server.sockets[0].getsockname()[1]
+        return self.address
+
+    async def wait(self) -> dict[int, dict[str, Any]]:
+        """Waits until every shard finished and returns their results by shard."""
+        await self.finished.wait()
+        return self.results
+
+    async def close(self) -> None:
+        for channel in self.channels.values(): await channel.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def _send(self, shard: int, frame: bytes) -> None:
+        if shard in self.channels: self.channels[shard].writer.write(frame)
+        else: self.pending.setdefault(shard, []).append(frame)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        channel = _Channel(reader, writer)
+        hello = await channel.recv()
+        if hello is None or hello[0] != HELLO: return await channel.close()
+        shard = hello[1]
+        self.channels[shard] = channel
+        for frame in self.pending.pop(shard, []): writer.write(frame)
+        while (message := await channel.recv()) is not None:
+            kind, other, payload = message
+            if kind == LINKS:
+                self.forwarded[other] += 1
+                self._send(other, _FRAME.pack(len(payload), LINKS, shard) + payload)
+                if other in self.channels: await self.channels[other].writer.drain()
+            elif kind == QUOTA:
+                grant = 0
+                if self.remaining is None: grant = QUOTA_BLOCK
+                elif self.remaining > 0: grant = min(QUOTA_BLOCK, max(1, self.remaining // self.shards))
+                if self.remaining is not None: self.remaining -= grant
+                channel.send(GRANT, shard, str(grant).encode())
+            elif kind == IDLE:
+                self.idle[shard] = int(payload)
+                self._check_finished()
+            elif kind == DONE:
+                self.results[shard] = json.loads(payload)
+                if len(self.results) == self.shards: self.finished.set()
+            await writer.drain()
+
+    def _check_finished(self) -> None:
+        if self.stopping or len(self.channels) < self.shards: return
+        if all(processed == forwarded for processed, forwarded in zip(self.idle, self.forwarded)):
+            self.stopping = True
+            for channel in self.channels.values(): channel.send(STOP, 0)
+
+
+class ShardCrawler(Crawler):
+    def __init__(self, shard: int, shards: int, channel: _Channel, *args, limited: bool = False, **kwargs) -> None:
+        """Creates the crawler of a single shard, which sends the urls of
+        other shards' hosts to the coordinator instead of crawling them. It
+        takes the arguments of `Crawler` after the ones below; its own
+        `max_sites` should be -1.
+
+        Args:
+            shard (int): The index of the shard.
+            shards (int): The number of shards.
+            channel (_Channel): The connection to the coordinator.
+            limited (bool): Ask the coordinator before admitting every url,
+                which enforces a global `max_sites`.
+        """
+        super().__init__(*args, **kwargs)
+        self.shard = shard
+        self.shards = shards
+        self.channel = channel
+        self.limited = limited
+        self.outboxes: dict[int, list[str]] = {}
+        self.processed = 0  # batches received from the coordinator and admitted
+        self.quota = 0
+        self.quota_exhausted = False
+        self.quota_waiter: asyncio.Future | None = None
+        self.admitted: list[str] = []
+        self.stopped = asyncio.Event()
+        # the start urls are admitted by `serve` instead of `run`, so the shard can not look out of work before
+        self.start_urls, self.initial_urls = self.initial_urls, set()
+
+    async def admit(self, url: str, depth: int, score: float | None = None) -> None:
+        owner = shard_of(url, self.shards)
+        if owner == self.shard: return await super().admit(url, depth, score)
+        # urls of other shards are remembered too, so they are only sent once
+        if url in self.seen: return
+        self.seen.add(url)
+        outbox = self.outboxes.setdefault(owner, [])
+        outbox.append(f"{depth}\t{url}")
+        if len(outbox) >= BATCH_SIZE: self.flush(owner)
+
+    async def add_url(self, url: str, depth: int, score: float | None = None) -> None:
+        # the url is seen before waiting for an admission, so it is not admitted twice meanwhile
+        self.seen.add(url)
+        if self.limited and not await self.take_quota():
+            warn("Max sites reached")
+            return
+        self.admitted.append(url)
+        await super().add_url(url, depth, score)
+
+    async def take_quota(self) -> bool:
+        """Takes one admission, asking the coordinator for more when they are used up."""
+        while self.quota == 0:
+            if self.quota_exhausted: return False
+            if self.quota_waiter is None:
+                self.quota_waiter = asyncio.get_running_loop().create_future()
+                self.channel.send(QUOTA, self.shard)
+            await asyncio.shield(self.quota_waiter)
+        self.quota -= 1
+        return True
+
+    def flush(self, shard: int | None = None) -> None:
+        """Sends the waiting links of one shard, or of every shard."""
+        for owner in [shard] if shard is not None else list(self.outboxes):
+            lines = self.outboxes.pop(owner, None)
+            if lines: self.channel.send(LINKS, owner, "\n".join(lines).encode())
+
+    async def receive(self, payload: bytes) -> None:
+        try:
+            for line in payload.decode().split("\n"):
+                depth, _, url = line.partition("\t")
+                await self.admit(url, int(depth))
+        finally:
+            self.processed += 1
+            self.crawling.release()
+
+    async def admit_start_urls(self) -> None:
+        try:
+            for url in self.start_urls:
+                if url in self.seen or not await self.filter.check_robots(url): continue
+                self.seen.add(url)
+                self.enqueue(url, 0)
+                self.total += 1
+                self.admitted.append(url)
+        finally:
+            self.crawling.release()
+
+    async def read(self) -> None:
+        """Handles the messages of the coordinator."""
+        tasks = set()
+        while (message := await self.channel.recv()) is not None:
+            kind, _, payload = message
+            if kind == LINKS:
+                # the scheduler is held until the links are admitted, so the shard does not look out of work meanwhile
+                self.crawling.hold()
+                task = asyncio.create_task(self.receive(payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif kind == GRANT:
+                self.quota += int(payload)
+                if int(payload) == 0: self.quota_exhausted = True
+                waiter, self.quota_waiter = self.quota_waiter, None
+                if waiter is not None and not waiter.done(): waiter.set_result(None)
+            elif kind == STOP:
+                break
+        self.stopped.set()
+
+    async def serve(self) -> dict[str, Any]:
+        """Crawls until the coordinator stops the shard.
+
+        Returns:
+            dict[str, Any]: The counts, admitted urls and selected urls of
+                the shard
+        """
+        # the scheduler is held for the whole crawl, so `run` only returns once the shard is stopped
+        self.crawling.hold()
+        self.crawling.hold()
+        starting = asyncio.create_task(self.admit_start_urls())
+        crawl = asyncio.create_task(self.run())
+        reader = asyncio.create_task(self.read())
+        reported = None
+        try:
+            while not self.stopped.is_set():
+                self.flush()
+                # out of work when only the hold is left; the report follows the links sent before it
+                if self.crawling.unfinished == 1 and reported != self.processed:
+                    reported = self.processed
+                    self.channel.send(IDLE, self.shard, str(reported).encode())
+                await self.channel.writer.drain()
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            starting.cancel()
+            self.crawling.release()
+            await crawl
+            reader.cancel()
+        return {"parsed": self.parsed, "admitted": self.total, "urls": self.admitted, "selected": sorted(self.selected)}
+
+
+async def run_shard(
+    address: Address,
+    shard: int,
+    shards: int,
+    urls: Iterable[str],
+    make_filter: Callable[[], UrlFilterer],
+    workers: int = 16,
+    max_depth: int = 3,
+    limited: bool = False,
+    host_rate: float = 1.0,
+    max_per_host: int = 2,
+    backend: str = "bs4",
+    selector: str | None = None,
+) -> None:
+    """
+    Runs a single shard of a crawl, connected to the coordinator at `address`.
+
+    Args:
+        address (Address): The address of the coordinator.
+        shard (int): The index of the shard.
+        shards (int): The number of shards.
+        urls (Iterable[str]): The start urls of the whole crawl; the shard
+            starts from those of its own hosts.
+        make_filter (Callable[[], UrlFilterer]): Creates the filter of the
+            shard. It has to be picklable, e.g. a module level function.
+        workers (int): The number of workers of the shard.
+        max_depth (int): The depth the crawl searches to.
+        limited (bool): See `ShardCrawler`.
+        host_rate (float): See `Crawler`.
+        max_per_host (int): See `Crawler`.
+        backend (str): See `src.parsing.Parser`; pages are parsed in the
+            process of the shard.
+        selector (str | None): See `src.parsing.Parser`.
+    """
+    channel = await _connect(address)
+    channel.send(HELLO, shard)
+    filter = make_filter()
+    own = [url for url in urls if shard_of(filter.canonicalize(url), shards) == shard]
+    try:
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=workers)) as client:
+            with Parser(backend, selector, processes=0) as parser:
+                crawler = ShardCrawler(
+                    shard, shards, channel, client, own, filter, workers, max_depth, -1,
+                    host_rate=host_rate, max_per_host=max_per_host, parser=parser, limited=limited,
+                )
+                result = await crawler.serve()
+        channel.send(DONE, shard, json.dumps(result).encode())
+        await channel.writer.drain()
+    finally:
+        await channel.close()
+
+
+def _shard_process(address: Address, shard: int, shards: int, urls: list[str], make_filter: Callable[[], UrlFilterer], options: dict) -> None:
+    asyncio.run(run_shard(address, shard, shards, urls, make_filter, **options))
+
+
+async def run_sharded(
+    urls: Iterable[str],
+    make_filter: Callable[[], UrlFilterer],
+    shards: int | None = None,
+    workers: int = 16,
+    max_depth: int = 3,
+    max_sites: int = -1,
+    address: Address | None = None,
+    **options: Any,
+) -> ShardedResult:
+    """
+    Crawls with a shard process per core, coordinated by the current process.
+
+    Args:
+        urls (Iterable[str]): The urls to start from.
+        make_filter (Callable[[], UrlFilterer]): See `run_shard`.
+        shards (int | None): The number of shard processes; defaults to the
+            number of CPUs.
+        workers (int): The number of workers of every shard.
+        max_depth (int): The depth the crawl searches to.
+        max_sites (int): The maximum number of admitted urls over all shards,
+            -1 for no limit.
+        address (Address | None): Where the coordinator listens; defaults to
+            a Unix socket in a temporary directory.
+        **options: `host_rate`, `max_per_host`, `backend` and `selector`,
+            see `run_shard`.
+
+    Raises:
+        RuntimeError: If a shard process exits before the crawl is over.
+    """
+    urls = list(dict.fromkeys(urls))
+    shards = shards or os.cpu_count() or 1
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        coordinator = Coordinator(shards, max_sites, len(urls))
+        address = await coordinator.start(address or os.path.join(directory, "coordinator.sock"))
+        options = {"workers": workers, "max_depth": max_depth, "limited": max_sites != -1, **options}
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_shard_process, args=(address, shard, shards, urls, make_filter, options), daemon=True)
+            for shard in range(shards)
+        ]
+        for process in processes: process.start()
+        try:
+            waiting = asyncio.create_task(coordinator.wait())
+            while not waiting.done():
+                await asyncio.wait([waiting], timeout=0.5)
+                failed = [process for process in processes if process.exitcode not in (None, 0)]
+                if failed and not waiting.done():
+                    raise RuntimeError(f"Shard process {processes.index(failed[0])} exited with code {failed[0].exitcode}")
+            shard_results = waiting.result()
+        finally:
+            if not waiting.done(): waiting.cancel()
+            await coordinator.close()
+            for process in processes:
+                process.join(5)
+                if process.is_alive(): process.terminate()
+
+    result = ShardedResult(seconds=time.perf_counter() - start)
+    for shard in range(shards):
+        shard_result = shard_results[shard]
+        result.parsed += shard_result["parsed"]
+        result.admitted += shard_result["admitted"]
+        result.urls.update(shard_result["urls"])
+        result.selected.update(shard_result["selected"])
+        result.shards.append({"parsed": shard_result["parsed"], "admitted": shard_result["admitted"]})
+    return result
+
+
+def crawl_sharded(*args, **kwargs) -> ShardedResult:
+    """Blocking version of `run_sharded`, which takes the same arguments."""
+    return asyncio.run(run_sharded(*args, **kwargs))
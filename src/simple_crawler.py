@@ -1,26 +1,29 @@
 """
 This module provides a web crawler that will search a web page
+
+The pages of every depth are fetched concurrently; `crawl` runs the
+asynchronous `crawl_async` to completion, so it can be called like a normal
+function from code without an event loop.
 """
 
 
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import urllib.parse
 import warnings
-import os
+
+import httpx
+
+from src.parsing import parse_bs4
 
 
 PREFIXES = ["http://", "https://"]
+WORKERS = 16  # the number of pages fetched at once
 
 
 def get_full_url(url: str, src: str) -> str:
+    """Resolves a (relative) link found on the page at `url`, without its fragment; "" for an empty link."""
     if not src: return ""
-    if src[0] != "/": full = url_previous_folder(url) + "/" + src
-    else: full = url_domain(url) + src
-    for pre in PREFIXES:
-        if pre not in full: continue
-        k = pre
-        full = full.removeprefix(pre)
-    return k + os.path.normpath(full).replace("\\", "/")
+    return urllib.parse.urldefrag(urllib.parse.urljoin(url, src)).url
 
 
 def crawl(
@@ -32,54 +35,106 @@ def crawl(
         verbose: bool = False,
         white_list: list[str] = None, 
         black_list: list[str] = None
-    ) -> tuple[set[str], int, int, int]:
+    ) -> tuple[list[str], int, int, int]:
+    """
+    Searches the pages reachable from `url` for elements matching `css_selector`. Can not be called from a running
+    event loop, use `crawl_async` there.
+
+    params:
+        url: The page the search starts at.
+        depth: The number of levels of links that are followed; 1 only searches `url`.
+        css_selector: Elements matching it are collected for downloading using their `src`.
+        max_sites: The maximum number of pages that are searched, or -1 for no limit.
+        allow_duplicate_to_download_links: If set to true, the same file is listed every time it is found.
+        verbose: If set to true, the function will produce more detailed output.
+        white_list: If not empty, only links to these domains (e.g. `https://example.com`) are followed.
+        black_list: Links to these domains are not followed.
+
+    returns:
+        The urls of the files to download in the order they were found, the number of visited pages and the minimum
+        and maximum number of collected elements on a single page.
+    """
+    return asyncio.run(crawl_async(url, depth, css_selector, max_sites, allow_duplicate_to_download_links, verbose, white_list, black_list))
+
+
+async def crawl_async(
+        url: str, 
+        depth: int, 
+        css_selector: str, 
+        max_sites: int =  -1,
+        allow_duplicate_to_download_links: bool = False,
+        verbose: bool = False,
+        white_list: list[str] = None, 
+        black_list: list[str] = None
+    ) -> tuple[list[str], int, int, int]:
+    """
+    Same as `crawl`.
+    """
     if white_list is None: white_list = []
     if black_list is None: black_list = []
-    visited = set()
-    visited.add(url)
-    visiting = set()
-    visiting.add(url)
-    to_visit = set()
+    visited = {url}
+    # dicts are used as sets which keep the order in which urls are found
+    visiting = {url: None}
+    to_visit: dict[str, None] = {}
     to_download = []
+    downloads = set()
     min_on_page = 1e9
     max_on_page = 0
+    fetched = 0
+    limit = asyncio.Semaphore(WORKERS)
+
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        async def fetch(page: str) -> httpx.Response | None:
+            async with limit:
+                if verbose: print(f"\tSearching: \"{page}\"...")
+                try:
+                    return await client.get(page)
+                except httpx.HTTPError as e:
+                    warnings.warn(f"Could not get \"{page}\": {e}")
+                    return None
 
-    for iter in range(depth):
-        if verbose: print(f"Searching at a depth of {iter}.")
-        for url in visiting:
-            if verbose: print(f"\tSearching: \"{url}\"...")
-            visited.add(url)
-            resp = requests.get(url)
-            soup = BeautifulSoup(resp.text, features="html.parser")
-            
-            num_a_tags = 0
-            for a_tag in soup.select("a"):
-                link = get_full_url(url, a_tag.attrs.get('href'))
-                if not link: continue
-                if white_list and url_domain(link) not in white_list or url_domain(link) in black_list: continue
-                if link in visited or link in to_visit or link in visiting: continue
-                to_visit.add(link)
-                num_a_tags += 1
-            if verbose: print(f"\t\tFound {num_a_tags} links on the page.")
-            
-            count = 0
-            for element in soup.select(css_selector):
-                down_url = get_full_url(url, element.attrs.get("src"))
-                if not down_url: continue
-                if down_url in to_download and not allow_duplicate_to_download_links: continue
-                to_download.append(down_url)
-                count += 1
-            min_on_page = min(min_on_page, count)
-            max_on_page = max(max_on_page, count)
-            if verbose: print(f"\t\tFound {count} elements to download.")
+        for iter in range(depth):
+            if verbose: print(f"Searching at a depth of {iter}.")
+            pages = list(visiting)
+            # pages after the maximum number of sites are not fetched
+            if max_sites != -1: pages = pages[:max_sites - fetched]
+            fetched += len(pages)
+            visited.update(pages)
+            responses = await asyncio.gather(*(fetch(page) for page in pages))
+
+            for page, resp in zip(pages, responses):
+                if resp is None: continue
+                result = parse_bs4(resp.content, resp.charset_encoding, css_selector, attributes=("src",))
+
+                num_a_tags = 0
+                for href in result.links:
+                    link = get_full_url(str(resp.url), href)
+                    if not link or urllib.parse.urlsplit(link).scheme not in ("http", "https"): continue
+                    if white_list and url_domain(link) not in white_list or url_domain(link) in black_list: continue
+                    if link in visited or link in to_visit or link in visiting: continue
+                    to_visit[link] = None
+                    num_a_tags += 1
+                if verbose: print(f"\t\tFound {num_a_tags} links on \"{page}\".")
+
+                count = 0
+                for src in result.selected:
+                    down_url = get_full_url(str(resp.url), src)
+                    if not down_url: continue
+                    if down_url in downloads and not allow_duplicate_to_download_links: continue
+                    to_download.append(down_url)
+                    downloads.add(down_url)
+                    count += 1
+                min_on_page = min(min_on_page, count)
+                max_on_page = max(max_on_page, count)
+                if verbose: print(f"\t\tFound {count} elements to download.")
 
             if len(visited) >= max_sites and max_sites != -1:
                 warnings.warn(f"Crawled to the maximum allowed number of sites; skipped over at least {len(to_visit)}")
                 return to_download, len(visited), min_on_page, max_on_page
-        if verbose: print(f"Found {len(to_visit)} links to visit; visited a total of {len(visited)} pages.")
-        if not len(to_visit): break
-        visiting = to_visit.copy()
-        to_visit = set()
+            if verbose: print(f"Found {len(to_visit)} links to visit; visited a total of {len(visited)} pages.")
+            if not len(to_visit): break
+            visiting = to_visit
+            to_visit = {}
     return to_download, len(visited), min_on_page, max_on_page
 
 
@@ -93,9 +148,3 @@ def url_domain(url: str) -> str:
     i = url.find('/')
     if i == -1: return url
     return prefix + url[:i]
-
-
-def url_previous_folder(url: str) -> str:
-    i = url.rfind("/")
-    if i == -1: raise ValueError(f"Url \"{url}\" does not have folder in the level above")
-    return url[:i]
@@ -0,0 +1,182 @@
+"""
+This module reads the sitemaps of a site to seed a crawl, see
+https://www.sitemaps.org/protocol.html for the format.
+
+Sitemaps are found through the `Sitemap:` lines of robots.txt, or at
+`/sitemap.xml` if there are none. A sitemap index lists further sitemaps,
+which are fetched concurrently. Every sitemap is parsed while it is
+downloaded (gzipped sitemaps are decompressed on the fly) and the parsed
+elements are discarded right away, so even sitemaps with 50,000 urls are read
+with a small, constant amount of memory.
+"""
+
+
+import asyncio
+import datetime
+import urllib.parse
+import xml.etree.ElementTree as ET
+import zlib
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator
+
+import httpx
+
+from src.robots import RobotsCache, parse_robots
+
+
+MAX_SITEMAP_SIZE = 50 * 2 ** 20  # the maximum uncompressed size of a sitemap allowed by the protocol
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass(frozen=True)
+class SitemapUrl:
+    """
+    attributes:
+        loc: The url of the page.
+        lastmod: The date the page was last modified (W3C datetime), if given.
+    """
+    loc: str
+    lastmod: str | None = None
+
+    def timestamp(self) -> float | None:
+        """The lastmod date as a unix timestamp, or None if it is missing or invalid."""
+        if self.lastmod is None: return None
+        try:
+            date = datetime.datetime.fromisoformat(self.lastmod)
+        except ValueError:
+            return None
+        if date.tzinfo is None: date = date.replace(tzinfo=datetime.timezone.utc)
+        return date.timestamp()
+
+
+class SitemapParser:
+    def __init__(self, max_size: int = MAX_SITEMAP_SIZE) -> None:
+        """Creates a parser which is fed a sitemap or sitemap index in chunks.
+        Gzipped sitemaps are recognized by their first bytes.
+
+        Args:
+            max_size (int): The number of (uncompressed) bytes after which
+                the rest of the sitemap is ignored.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._xml = ET.XMLPullParser(events=("start", "end"))
+        self._gzip = None  # a zlib decompressor for gzipped sitemaps
+        self._started = False
+        self._root: ET.Element | None = None
+        self._fields: dict[str, str] = {}
+
+    def feed(self, chunk: bytes) -> Iterator[tuple[str, SitemapUrl]]:
+        """Parses the next chunk of the sitemap.
+
+        Returns:
+            Iterator[tuple[str, SitemapUrl]]: ("url", page) for every page and
+                ("sitemap", sitemap) for every sitemap of an index which ended
+                in the chunk
+        """
+        if not self._started:
+            self._started = True
+            if chunk.startswith(GZIP_MAGIC): self._gzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._gzip is not None:
+            chunk = self._gzip.decompress(chunk, self.max_size - self.size + 1)
+        self.size += len(chunk)
+        if self.size > self.max_size: raise ValueError(f"The sitemap is larger than {self.max_size} bytes")
+        self._xml.feed(chunk)
+        for event, element in self._xml.read_events():
+            if self._root is None: self._root = element
+            if event == "start": continue
+            tag = element.tag.rpartition("}")[2]  # without the namespace
+            if tag in ("loc", "lastmod"):
+                self._fields[tag] = (element.text or "").strip()
+            elif tag in ("url", "sitemap"):
+                if self._fields.get("loc"): yield tag, SitemapUrl(self._fields["loc"], self._fields.get("lastmod") or None)
+                self._fields = {}
+                # the parsed elements are dropped, so the tree never grows
+                self._root.clear()
+
+    def close(self) -> None:
+        self._xml.close()
+
+
+def _origin(url: str) -> str:
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+async def discover(client: httpx.AsyncClient, site: str, robots: RobotsCache | None = None) -> list[str]:
+    """Finds the sitemaps of the site of the url, listed in its robots.txt or at `/sitemap.xml`.
+
+    Args:
+        client (httpx.AsyncClient): The client used for the requests.
+        site (str): Any url of the site.
+        robots (RobotsCache | None): The cache to take robots.txt from; it is
+            fetched directly if None.
+
+    Returns:
+        list[str]: The urls of the sitemaps
+    """
+    if robots is not None:
+        sitemaps = (await robots.rules(site)).sitemaps
+    else:
+        try:
+            resp = await client.get(_origin(site) + "/robots.txt", follow_redirects=True)
+            sitemaps = parse_robots(resp.text, "*").sitemaps if resp.is_success else []
+        except httpx.HTTPError:
+            sitemaps = []
+    # relative sitemap urls are not allowed, but they are resolved anyway
+    return [urllib.parse.urljoin(_origin(site), url) for url in sitemaps] or [_origin(site) + "/sitemap.xml"]
+
+
+async def sitemap_urls(
+    client: httpx.AsyncClient,
+    site: str,
+    robots: RobotsCache | None = None,
+    concurrency: int = 4,
+    buffer: int = 1_000,
+) -> AsyncIterator[SitemapUrl]:
+    """Yields the pages listed in the sitemaps of a site while they are downloaded.
+
+    Args:
+        client (httpx.AsyncClient): The client used for the requests.
+        site (str): Any url of the site.
+        robots (RobotsCache | None): The cache to take robots.txt from.
+        concurrency (int): The number of sitemaps fetched at once.
+        buffer (int): The number of parsed urls which are kept until they
+            are consumed; fetching pauses while the buffer is full.
+
+    Returns:
+        AsyncIterator[SitemapUrl]: The pages, in no particular order
+    """
+    queue: asyncio.Queue[SitemapUrl | None] = asyncio.Queue(buffer)
+    limit = asyncio.Semaphore(concurrency)
+    fetched: set[str] = set()
+    tasks: set[asyncio.Task] = set()
+
+    def schedule(url: str) -> None:
+        if url in fetched: return  # sitemap indexes can list each other
+        fetched.add(url)
+        tasks.add(asyncio.create_task(fetch(url)))
+
+    async def fetch(url: str) -> None:
+        parser = SitemapParser()
+        try:
+            async with limit, client.stream("GET", url, follow_redirects=True) as resp:
+                if not resp.is_success: return
+                async for chunk in resp.aiter_bytes():
+                    for kind, item in parser.feed(chunk):
+                        if kind == "sitemap": schedule(item.loc)
+                        else: await queue.put(item)
+            parser.close()
+        except (httpx.HTTPError, ET.ParseError, ValueError, zlib.error):
+            pass  # the urls parsed before the error are kept
+        finally:
+            # the child sitemaps of an index are scheduled before it finishes, so no tasks left means all are done
+            tasks.discard(asyncio.current_task())
+            if not tasks: await queue.put(None)
+
+    for url in await discover(client, site, robots): schedule(url)
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+    finally:
+        for task in list(tasks): task.cancel()
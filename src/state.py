@@ -0,0 +1,142 @@
+"""
+This module stores the state of a crawl in a SQLite database, so a crawl that
+is stopped can be resumed and crawls finding tens of millions of urls do not
+have to keep them all in memory.
+
+Every url the crawler has seen is a row of the `urls` table:
+- `state` is one of `SEEN` (found but not admitted to the frontier), `QUEUED`
+    (in the frontier), `LEASED` (handed to the crawler's in-memory queue) or
+    `DONE` (crawled).
+- `status` is the HTTP status of the response, or -1 if the request failed.
+Writes are buffered and sent to the database in batches.
+"""
+
+
+import sqlite3
+from typing import Iterable, Iterator
+
+
+SEEN, QUEUED, LEASED, DONE = range(4)
+
+
+class _UrlView:
+    """Set-like access to the urls of a table, used in place of the sets of the crawler."""
+    def __init__(self, state: "CrawlState", table: str) -> None:
+        self.state = state
+        self.table = table
+
+    def __contains__(self, url: str) -> bool:
+        return self.state._contains(self.table, url)
+
+    def add(self, url: str) -> None:
+        self.state._write(f"INSERT OR IGNORE INTO {self.table} (url) VALUES (?)", (url,), url, self.table)
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls: self.add(url)
+
+    def __len__(self) -> int:
+        self.state.flush()
+        return self.state.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        self.state.flush()
+        return (url for url, in self.state.conn.execute(f"SELECT url FROM {self.table}"))
+
+
+class CrawlState:
+    def __init__(self, path: str, batch_size: int = 1_000) -> None:
+        """Opens (or creates) the database storing the state of a crawl.
+
+        Args:
+            path (str): The location of the database file.
+            batch_size (int): The number of writes that are buffered before
+                they are sent to the database.
+        """
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                depth INTEGER,
+                score REAL NOT NULL DEFAULT 0,
+                state INTEGER NOT NULL DEFAULT 0,
+                status INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS frontier ON urls (state, depth, score DESC);
+            CREATE TABLE IF NOT EXISTS selected (url TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        """)
+        self.batch_size = batch_size
+        self._pending: list[tuple[str, tuple]] = []
+        self._pending_urls: dict[str, set[str]] = {"urls": set(), "selected": set()}
+        self.seen = _UrlView(self, "urls")
+        self.selected = _UrlView(self, "selected")
+        # urls handed out by an earlier run which never finished are crawled again
+        self.conn.execute("UPDATE urls SET state = ? WHERE state = ?", (QUEUED, LEASED))
+        self.conn.commit()
+
+    def _write(self, sql: str, params: tuple, url: str | None = None, table: str = "urls") -> None:
+        self._pending.append((sql, params))
+        if url is not None: self._pending_urls[table].add(url)
+        if len(self._pending) >= self.batch_size: self.flush()
+
+    def _contains(self, table: str, url: str) -> bool:
+        if url in self._pending_urls[table]: return True
+        return self.conn.execute(f"SELECT 1 FROM {table} WHERE url = ?", (url,)).fetchone() is not None
+
+    def flush(self) -> None:
+        """Sends the buffered writes to the database."""
+        if not self._pending: return
+        with self.conn:
+            for sql, params in self._pending:
+                self.conn.execute(sql, params)
+        self._pending.clear()
+        for urls in self._pending_urls.values(): urls.clear()
+
+    def checkpoint(self, total: int) -> None:
+        """Flushes all writes together with the number of admitted urls and checkpoints the write ahead log."""
+        self._write("INSERT OR REPLACE INTO meta (key, value) VALUES ('total', ?)", (total,))
+        self.flush()
+        self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def is_new(self) -> bool:
+        """True if nothing was stored yet, i.e. the crawl is not resumed."""
+        self.flush()
+        return self.conn.execute("SELECT 1 FROM urls LIMIT 1").fetchone() is None
+
+    def total(self) -> int:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'total'").fetchone()
+        return 0 if row is None else row[0]
+
+    def enqueue(self, url: str, depth: int, score: float = 0.0) -> None:
+        """Adds a url to the frontier."""
+        self._write(
+            "INSERT INTO urls (url, depth, score, state) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET depth = excluded.depth, score = excluded.score, state = excluded.state "
+            "WHERE urls.state = ?",
+            (url, depth, score, QUEUED, SEEN), url,
+        )
+
+    def lease(self, n: int) -> list[tuple[str, int, float]]:
+        """Takes up to `n` urls with the lowest depth (and then the highest score) from the frontier.
+
+        Returns:
+            list[tuple[str, int, float]]: The url, depth and score of every
+                taken url
+        """
+        self.flush()
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT url, depth, score FROM urls WHERE state = ? ORDER BY depth, score DESC LIMIT ?", (QUEUED, n)
+            ).fetchall()
+            self.conn.executemany("UPDATE urls SET state = ? WHERE url = ?", [(LEASED, url) for url, *_ in rows])
+        return rows
+
+    def finish(self, url: str, status: int) -> None:
+        """Marks a leased url as crawled with the HTTP status of the response (-1 if the request failed)."""
+        self._write("UPDATE urls SET state = ?, status = ? WHERE url = ?", (DONE, status, url))
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,161 @@
+"""
+This module detects near-duplicate pages and crawl traps.
+
+Every page is fingerprinted with a 64-bit SimHash of the word 3-grams of its
+text and of its links; pages whose fingerprints differ in at most a few bits
+are near-duplicates. The fingerprints are stored in a banded index: with a
+maximum distance of k the 64 bits are split into k + 1 bands, and two
+fingerprints within the distance agree on at least one band completely, so
+only fingerprints sharing a band have to be compared.
+
+Calendars, session ids and similar generate endless urls which all serve
+(nearly) the same page. Urls are grouped by their template (the url with
+numbers and ids in the path and the values of the query replaced), and a
+template whose pages are mostly near-duplicates is marked as a trap; urls
+matching it are then dropped or crawled last.
+"""
+
+
+import hashlib
+import re
+import urllib.parse
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, Literal
+
+
+_WORD = re.compile(r"\w+")
+_NUMBER = re.compile(r"\d+")
+_ID = re.compile(r"^(?=.*\d)[0-9a-zA-Z_-]{16,}$")  # long tokens with digits, e.g. hashes, uuids and session ids
+
+
+def page_features(text: str, links: Iterable[str], shingle: int = 3) -> list[str]:
+    """The features a page is fingerprinted by: the `shingle`-grams of the words of its text and its links."""
+    words = _WORD.findall(text.lower())
+    shingles = [" ".join(words[i:i + shingle]) for i in range(max(1, len(words) - shingle + 1))] if words else []
+    return shingles + ["\0" + link for link in links]
+
+
+def simhash(features: Iterable[str]) -> int:
+    """The 64-bit SimHash of the features; similar sets of features have fingerprints differing in few bits."""
+    digests = b"".join(hashlib.blake2b(feature.encode(), digest_size=8).digest() for feature in features)
+    total = len(digests) // 8
+    if not total: return 0
+    fingerprint = 0
+    # a bit of the fingerprint is set if it is set in the hashes of most features; the bits are counted per byte
+    # of the hashes, so the work per page does not depend on the number of features
+    for byte in range(8):
+        weights = [0] * 8
+        for value, count in Counter(digests[byte::8]).items():
+            for bit in range(8):
+                if value >> bit & 1: weights[bit] += count
+        for bit in range(8):
+            if 2 * weights[bit] > total: fingerprint |= 1 << (8 * byte + bit)
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class SimHashIndex:
+    def __init__(self, max_distance: int = 3) -> None:
+        """Creates an empty index of fingerprints.
+
+        Args:
+            max_distance (int): The maximum number of differing bits of two
+                near-duplicate fingerprints.
+        """
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = -(-64 // bands)
+        self._bands = [(i * width, (1 << min(width, 64 - i * width)) - 1) for i in range(bands)]
+        self._tables: list[dict[int, list[tuple[int, str]]]] = [{} for _ in range(bands)]
+        self._len = 0
+
+    def find(self, fingerprint: int) -> str | None:
+        """The url of a page whose fingerprint is within the maximum distance, or None if there is none."""
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for other, url in table.get(fingerprint >> shift & mask, ()):
+                if hamming_distance(fingerprint, other) <= self.max_distance: return url
+        return None
+
+    def add(self, fingerprint: int, url: str) -> None:
+        for (shift, mask), table in zip(self._bands, self._tables):
+            table.setdefault(fingerprint >> shift & mask, []).append((fingerprint, url))
+        self._len += 1
+
+    def __len__(self) -> int:
+        return self._len
+
+
+def url_template(url: str) -> str:
+    """
+    The template of a url: numbers in the path become `{n}`, segments looking like ids become `{id}` and the query
+    only keeps its sorted parameter names, e.g. `http://a.test/cal/2024/05?day=3&sid=x` -> `http://a.test/cal/{n}/{n}?day&sid`.
+    """
+    parts = urllib.parse.urlsplit(url)
+    segments = ["{id}" if _ID.match(segment) else _NUMBER.sub("{n}", segment) for segment in parts.path.split("/")]
+    names = sorted({param.partition("=")[0] for param in parts.query.split("&") if param})
+    query = "?" + "&".join(names) if names else ""
+    return f"{parts.scheme}://{parts.netloc}{'/'.join(segments)}{query}"
+
+
+@dataclass
+class _TemplateStats:
+    pages: int = 0
+    duplicates: int = 0
+
+
+class TrapDetector:
+    def __init__(
+        self,
+        max_distance: int = 3,
+        min_pages: int = 5,
+        trap_ratio: float = 0.5,
+        action: Literal["drop", "down-rank"] = "drop",
+        penalty: float = 1_000.0,
+    ) -> None:
+        """Creates a detector of near-duplicate pages and of url templates
+        which lead into crawl traps.
+
+        Args:
+            max_distance (int): The maximum number of differing bits of the
+                fingerprints of near-duplicate pages.
+            min_pages (int): The number of pages of a template which have to
+                be crawled before it can be marked as a trap.
+            trap_ratio (float): The share of near-duplicates among the pages
+                of a template above which it is a trap.
+            action (Literal["drop", "down-rank"]): Whether urls of traps are
+                not crawled at all or crawled after the other urls of the
+                same depth.
+            penalty (float): The amount subtracted from the score of
+                down-ranked urls.
+        """
+        self.index = SimHashIndex(max_distance)
+        self.min_pages = min_pages
+        self.trap_ratio = trap_ratio
+        self.action = action
+        self.penalty = penalty
+        self.templates: dict[str, _TemplateStats] = {}
+
+    def check_page(self, url: str, fingerprint: int) -> str | None:
+        """Adds a crawled page, returning the url of a page it is a near-duplicate of (None if it is new)."""
+        duplicate = self.index.find(fingerprint)
+        if duplicate is None: self.index.add(fingerprint, url)
+        stats = self.templates.setdefault(url_template(url), _TemplateStats())
+        stats.pages += 1
+        if duplicate is not None: stats.duplicates += 1
+        return duplicate
+
+    def is_trap(self, url: str) -> bool:
+        stats = self.templates.get(url_template(url))
+        return stats is not None and stats.pages >= self.min_pages and stats.duplicates > self.trap_ratio * stats.pages
+
+    def drops(self, url: str) -> bool:
+        """True if the url should not be crawled."""
+        return self.action == "drop" and self.is_trap(url)
+
+    def adjust_score(self, url: str, score: float) -> float:
+        """The score of a url, lowered if it is a down-ranked trap."""
+        return score - self.penalty if self.action == "down-rank" and self.is_trap(url) else score
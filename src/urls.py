@@ -0,0 +1,87 @@
+"""
+This module canonicalizes urls, so that different ways of writing the same
+url (`example.com`, `example.com/`, `EXAMPLE.com:80/`, ...) are only crawled
+once.
+"""
+
+
+import re
+import urllib.parse
+from typing import Iterable
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21, "ws": 80, "wss": 443}
+TRACKING_PARAMS = frozenset({
+    "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "utm_id",
+    "gclid", "dclid", "fbclid", "msclkid", "yclid", "mc_cid", "mc_eid", "_ga", "_hsenc", "_hsmi",
+})
+
+_UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+_PERCENT_ESCAPE = re.compile(r"%([0-9a-fA-F]{2})")
+
+
+def _normalize_escape(match: re.Match) -> str:
+    char = chr(int(match.group(1), 16))
+    return char if char in _UNRESERVED else "%" + match.group(1).upper()
+
+
+def normalize_percent_encoding(text: str) -> str:
+    """Decodes escaped unreserved characters and uppercases the hex digits of the remaining escapes."""
+    return _PERCENT_ESCAPE.sub(_normalize_escape, text)
+
+
+def remove_dot_segments(path: str) -> str:
+    """Resolves `.` and `..` segments of a path as described in RFC 3986, section 5.2.4."""
+    output: list[str] = []
+    segments = path.split("/")
+    for i, segment in enumerate(segments):
+        if segment == ".": continue
+        if segment == "..":
+            if len(output) > 1 or (output and output[0] != ""): output.pop()
+            continue
+        output.append(segment)
+    if segments[-1] in (".", ".."): output.append("")  # `/a/b/..` refers to the directory `/a/`
+    return "/".join(output)
+
+
+def canonicalize(url: str, sort_query: bool = False, strip_params: Iterable[str] = ()) -> str:
+    """
+    Converts a url to its canonical form: the scheme and host are lowercased, default ports,
+    dot segments and the fragment are removed, percent-encoding is normalized and an empty
+    path becomes `/`.
+
+    params:
+        url: An absolute url.
+        sort_query: If set to true, the parameters of the query string are sorted by name.
+        strip_params: Names of query parameters which are removed, e.g. `TRACKING_PARAMS`.
+
+    returns:
+        The canonical url.
+    """
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+
+    netloc = parts.netloc
+    userinfo, at, hostport = netloc.rpartition("@")
+    host, colon, port = hostport.rpartition(":")
+    if not colon or hostport.endswith("]") or (port and not port.isdigit()):
+        host, port = hostport, ""  # no port, or the colon is part of an IPv6 address
+    host = host.lower().rstrip(".")
+    if port == "" or DEFAULT_PORTS.get(scheme) == int(port): port = ""
+    netloc = f"{userinfo}{at}{host}{':' + port if port else ''}"
+
+    path = remove_dot_segments(normalize_percent_encoding(parts.path))
+    if not path and netloc: path = "/"
+
+    query = parts.query
+    strip_params = frozenset(strip_params)
+    if query and (sort_query or strip_params):
+        params = [param for param in query.split("&") if param]
+        if strip_params:
+            params = [param for param in params if urllib.parse.unquote_plus(param.partition("=")[0]) not in strip_params]
+        if sort_query:
+            params.sort(key=lambda param: param.partition("=")[0])
+        query = "&".join(params)
+    query = normalize_percent_encoding(query)
+
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, ""))
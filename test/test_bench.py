@@ -0,0 +1,56 @@
+"""
+This module contains smoke tests for the benchmark harness in `bench`.
+Run this module by running the following command in the `py-downloader` directory:
+`py -m unittest test.test_bench`
+"""
+
+
+import unittest
+
+import requests
+
+from bench.run import BENCHMARKS, Options, compare, run_benchmark
+from bench.server import SiteConfig, SyntheticServer
+
+
+class TestBench(unittest.TestCase):
+    def test_server(self):
+        config = SiteConfig(pages=10, fanout=3, page_size=2000, images=2, distinct_images=5, image_size=1000, latency=0, jitter=0)
+        with SyntheticServer(config) as server:
+            page = requests.get(server.page_url(3))
+            again = requests.get(server.page_url(3))
+            image = requests.get(server.image_url(1), headers={"Range": "bytes=10-19"})
+            missing = requests.get(server.page_url(10))
+
+        self.assertEqual(len(page.content), 2000)
+        self.assertEqual(page.content, again.content)
+        self.assertEqual(page.text.count("<a href="), 3)
+        self.assertEqual(page.text.count("<img src="), 2)
+        self.assertEqual(image.status_code, 206)
+        self.assertEqual(len(image.content), 10)
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(server.requests, 4)
+
+        with SyntheticServer(SiteConfig(pages=10, latency=0, jitter=0, error_rate=1)) as server:
+            self.assertEqual(requests.get(server.page_url(0)).status_code, 500)
+
+    def test_benchmarks(self):
+        config = SiteConfig(pages=20, fanout=3, page_size=2000, images=2, distinct_images=5, image_size=10_000, latency=0.001, jitter=0.001)
+        options = Options(depth=2, workers=4, downloads=5, shards=2)
+        results = {name: run_benchmark(name, config, options) for name in BENCHMARKS}
+
+        self.assertEqual(results["simple_crawler"]["pages"], 4)
+        self.assertEqual(results["crawler"]["pages"], 4)
+        self.assertEqual(results["sharded_crawler"]["pages"], 4)
+        self.assertEqual(results["download"]["files"], 5)
+        self.assertEqual(results["probe"]["files"], 5)
+        for result in results.values():
+            self.assertGreater(result["latency_p99"], 0)
+            self.assertGreater(result["peak_rss_mib"], 0)
+
+        slower = {"download": dict(results["download"], mb_per_s=results["download"]["mb_per_s"] / 2)}
+        self.assertEqual(compare({"results": slower}, {"results": results}, 0.1), ["download.mb_per_s"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,764 @@
+"""
+This module contains unit tests for the `crawler.py` module and the modules it uses.
+Run this module by running the following command in the `py-downloader` directory:
+`py -m unittest test.test_crawler`
+
+Like `test_download.py`, the crawler is tested against a local http server
+serving the `py-downloader` directory.
+"""
+
+
+import asyncio
+import gzip
+import io
+import json
+import os
+from os.path import join
+from tempfile import TemporaryDirectory
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import time
+import unittest
+
+import httpx
+
+from src.crawler import Crawler, UrlFilterer
+from src.graph import LinkGraph, MappedGraph
+from src.health import HostHealth, HostUnavailable, RetryPolicy
+from src.http_cache import ResponseCache
+from src.metrics import NULL_METRICS, JsonLinesSink, Metrics, Reporter, SummarySink, serve_prometheus
+from src.parsing import Parser, parse_bs4, parse_links
+from src.pipeline import Budget, DownloadQueue
+from src.robots import RobotsCache, parse_robots
+from src.scheduler import HostScheduler, retry_after
+from src.seen import BloomFilter, HashSet64
+from src.sharding import crawl_sharded, shard_of
+from src.sitemap import SitemapParser, SitemapUrl, sitemap_urls
+from src.state import DONE
+from src.traps import SimHashIndex, TrapDetector, hamming_distance, page_features, simhash, url_template
+from src.urls import TRACKING_PARAMS, canonicalize
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class RobotsHandler(QuietHandler):
+    """
+    Request handler serving a robots.txt which disallows `/test/websites/2*` and records the requested paths.
+    """
+    requested = []
+
+    def do_GET(self):
+        RobotsHandler.requested.append(self.path)
+        if self.path != "/robots.txt": return super().do_GET()
+        body = b"User-agent: *\nDisallow: /test/websites/2\nCrawl-delay: 0.01\n"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SitemapHandler(QuietHandler):
+    """
+    Request handler serving a robots.txt which lists a sitemap index with a plain and a gzipped sitemap.
+    """
+    sitemaps = {
+        "/robots.txt": b"User-agent: *\nSitemap: /sitemap_index.xml\n",
+        "/sitemap_index.xml": (
+            b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b"<sitemap><loc>/sitemap1.xml</loc></sitemap>"
+            b"<sitemap><loc>/sitemap2.xml.gz</loc></sitemap>"
+            b"<sitemap><loc>/sitemap_index.xml</loc></sitemap>"
+            b"</sitemapindex>"
+        ),
+        "/sitemap1.xml": (
+            b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b"<url><loc>/test/websites/3.html</loc><lastmod>2024-01-02</lastmod></url>"
+            b"<url><loc>/test/websites/loopback.html</loc></url>"
+            b"</urlset>"
+        ),
+        "/sitemap2.xml.gz": (
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b"<url><loc>/test/websites/2a.html</loc><lastmod>2024-01-01T12:00:00+00:00</lastmod></url>"
+            b"</urlset>"
+        ),
+    }
+
+    def do_GET(self):
+        body = SitemapHandler.sitemaps.get(self.path)
+        if body is None: return super().do_GET()
+        # the absolute urls are only known once the server runs
+        body = body.replace(b"<loc>/", f"<loc>http://localhost:{self.server.server_address[1]}/".encode())
+        if self.path.endswith(".gz"): body = gzip.compress(body)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FlakyHandler(QuietHandler):
+    """
+    Request handler which answers the first request for every path with 503 Service Unavailable.
+    """
+    failed = set()
+
+    def do_GET(self):
+        if self.path in FlakyHandler.failed: return super().do_GET()
+        FlakyHandler.failed.add(self.path)
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class CalendarHandler(QuietHandler):
+    """
+    Request handler serving an endless calendar: every day links to the next three and shows the same events.
+    """
+    events = " ".join(f"Event {i} takes place in room {i % 7} and is open to everyone." for i in range(10))
+
+    def do_GET(self):
+        day = self.path.removeprefix("/calendar/").removesuffix(".html")
+        if not day.isdigit(): return super().do_GET()
+        body = (
+            f'<html><body><h1>Day {day}</h1><p>{CalendarHandler.events}</p>'
+            + "".join(f'<a href="/calendar/{int(day) + i}.html">Day {int(day) + i}</a>' for i in range(1, 4))
+            + '<a href="/test/websites/1.html">Home</a></body></html>'
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HostsHandler(QuietHandler):
+    """
+    Request handler serving 8 hosts (127.0.0.1 to 127.0.0.8) of 5 pages each, which link to the next page of their
+    own host and to the same page of the next host.
+    """
+    hosts = 8
+    pages = 5
+
+    def do_GET(self):
+        host = int(self.headers["Host"].split(":")[0].rsplit(".", 1)[1]) - 1
+        page = int(self.path.removeprefix("/pages/").removesuffix(".html"))
+        port = self.server.server_address[1]
+        next_host = (host + 1) % HostsHandler.hosts
+        body = (
+            f'<a href="/pages/{(page + 1) % HostsHandler.pages}.html">next</a>'
+            f'<a href="http://127.0.0.{next_host + 1}:{port}/pages/{page}.html">next host</a>'
+            f'<img src="/images/{page}.png">'
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def any_host_filter() -> UrlFilterer:
+    """The filter of the sharded crawls, created in every shard process."""
+    return UrlFilterer(lambda x: True, lambda x: x in ["http", "https"], lambda x: x in [".html", ""])
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_hosts_are_rate_limited_separately(self):
+        scheduler = HostScheduler(rate=10, burst=1, max_in_flight=5)
+        for i in range(3):
+            scheduler.put_nowait(f"http://a.test/{i}")
+            scheduler.put_nowait(f"http://b.test/{i}")
+
+        start = time.monotonic()
+        order = []
+        for _ in range(6):
+            url, _depth = await scheduler.get()
+            order.append((url, time.monotonic() - start))
+            scheduler.task_done(url)
+        await scheduler.join()
+
+        # one request per host is allowed straight away, the rest are spaced 0.1 s apart per host
+        self.assertEqual({url[:13] for url, _ in order[:2]}, {"http://a.test", "http://b.test"})
+        self.assertLess(order[1][1], 0.05)
+        self.assertGreater(order[-1][1], 0.15)
+        self.assertLess(order[-1][1], 0.5)
+
+    async def test_max_in_flight(self):
+        scheduler = HostScheduler(rate=1000, burst=10, max_in_flight=2)
+        for i in range(3):
+            scheduler.put_nowait(f"http://a.test/{i}")
+        first, _depth = await scheduler.get()
+        await scheduler.get()
+        with self.assertRaises(TimeoutError):
+            await asyncio.wait_for(scheduler.get(), 0.05)
+        scheduler.task_done(first)
+        self.assertEqual(await asyncio.wait_for(scheduler.get(), 0.05), ("http://a.test/2", 0))
+
+    async def test_priority(self):
+        scheduler = HostScheduler(rate=1000, burst=10, max_in_flight=10)
+        scheduler.put_nowait("http://a.test/deep", depth=2)
+        scheduler.put_nowait("http://b.test/low", depth=1, score=0)
+        scheduler.put_nowait("http://a.test/high", depth=1, score=5)
+        scheduler.put_nowait("http://c.test/root", depth=0)
+        order = [await scheduler.get() for _ in range(4)]
+        self.assertEqual(order, [
+            ("http://c.test/root", 0), ("http://a.test/high", 1), ("http://b.test/low", 1), ("http://a.test/deep", 2),
+        ])
+
+    async def test_delay_host(self):
+        scheduler = HostScheduler(rate=1000, burst=10)
+        scheduler.put_nowait("http://a.test/")
+        scheduler.put_nowait("http://b.test/")
+        scheduler.delay_host("http://a.test/x", 10)
+        self.assertEqual(await scheduler.get(), ("http://b.test/", 0))
+        with self.assertRaises(TimeoutError):
+            await asyncio.wait_for(scheduler.get(), 0.05)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after({"Retry-After": "120"}), 120)
+        self.assertIsNone(retry_after({}))
+        self.assertIsNone(retry_after({"Retry-After": "soon"}))
+        self.assertEqual(retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}), 0)
+
+
+class TestHealth(unittest.TestCase):
+    def test_circuit_breaker(self):
+        health = HostHealth(failure_threshold=2, open_seconds=0.05)
+        health.record("a.test", True, 0.1)
+        health.record("a.test", False)
+        self.assertEqual(health.acquire("a.test"), 0)
+        health.record("a.test", False)
+        self.assertEqual(health.stats("a.test").state, "open")
+        self.assertGreater(health.acquire("a.test"), 0)
+        self.assertEqual(health.acquire("b.test"), 0)
+
+        time.sleep(0.05)
+        # a single probe is let through, which reopens the breaker for twice as long when it fails
+        self.assertEqual(health.acquire("a.test"), 0)
+        self.assertGreater(health.acquire("a.test"), 0)
+        health.record("a.test", False)
+        self.assertGreater(health.wait_time("a.test"), 0.05)
+        time.sleep(0.1)
+        self.assertEqual(health.acquire("a.test"), 0)
+        health.record("a.test", True, 0.2)
+        stats = health.stats("a.test")
+        self.assertEqual(stats.state, "closed")
+        self.assertAlmostEqual(stats.latency, 0.12)
+        self.assertGreater(stats.error_rate, 0)
+
+    def test_retries(self):
+        policy = RetryPolicy(base_delay=0.01, max_delay=0.02)
+        self.assertTrue(all(0 <= policy.delay(attempt) <= 0.02 for attempt in range(1, 10)))
+        self.assertEqual(policy.delay(1, retry_after=5), 5)
+
+        class Response:
+            def __init__(self, status_code, headers=None):
+                self.status_code = status_code
+                self.headers = headers or {}
+
+            def close(self):
+                pass
+
+        health = HostHealth(policy, failure_threshold=3)
+        statuses = iter([503, 429, 200])
+        self.assertEqual(health.call("a.test", lambda: Response(next(statuses))).status_code, 200)
+
+        def fail():
+            raise TimeoutError()
+
+        with self.assertRaises(TimeoutError):
+            health.call("a.test", fail)
+        # the three timeouts in a row opened the breaker
+        with self.assertRaises(HostUnavailable):
+            health.call("a.test", fail)
+
+        # a Retry-After longer than the largest delay opens the breaker for that long instead of sleeping
+        start = time.monotonic()
+        with self.assertRaises(HostUnavailable) as raised:
+            health.call("b.test", lambda: Response(503, {"Retry-After": "3600"}))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(raised.exception.seconds, 3600)
+        self.assertEqual(health.stats("b.test").state, "open")
+        self.assertGreater(health.wait_time("b.test"), 3500)
+
+
+class TestUrls(unittest.TestCase):
+    def test_canonicalize(self):
+        for url in ["http://example.com", "http://example.com/", "HTTP://EXAMPLE.com:80/", "http://example.com/a/../#top"]:
+            self.assertEqual(canonicalize(url), "http://example.com/")
+        self.assertEqual(canonicalize("https://a.com:443/x/./y/../%7ez%2f"), "https://a.com/x/~z%2F")
+        self.assertEqual(canonicalize("http://a.com:8080/b/.."), "http://a.com:8080/")
+        self.assertEqual(canonicalize("http://[::1]:80/"), "http://[::1]/")
+        self.assertEqual(canonicalize("http://a.com/?b=2&a=1"), "http://a.com/?b=2&a=1")
+        self.assertEqual(
+            canonicalize("http://a.com/?b=2&utm_source=x&a=1", sort_query=True, strip_params=TRACKING_PARAMS),
+            "http://a.com/?a=1&b=2",
+        )
+
+    def test_seen_sets(self):
+        urls = [f"http://example.com/{i}" for i in range(5_000)]
+        others = [f"http://example.org/{i}" for i in range(5_000)]
+        for seen in [HashSet64(16), BloomFilter(error_rate=1e-3, initial_capacity=500)]:
+            seen.update(urls)
+            seen.add(urls[0])
+            self.assertTrue(all(url in seen for url in urls))
+            false_positives = sum(url in seen for url in others)
+            self.assertLessEqual(false_positives, 10)
+            self.assertGreaterEqual(len(seen), 4_990)
+
+
+class TestRobots(unittest.TestCase):
+    def test_parse_robots(self):
+        text = """
+            User-agent: *
+            Disallow: /private
+            Allow: /private/public$
+            Disallow: /*.pdf$
+            Crawl-delay: 2
+
+            User-agent: py-downloader
+            Disallow: /
+
+            Sitemap: https://example.com/sitemap.xml
+        """
+        rules = parse_robots(text, "some-bot")
+        self.assertFalse(rules.allowed("https://example.com/private/x"))
+        self.assertTrue(rules.allowed("https://example.com/private/public"))
+        self.assertFalse(rules.allowed("https://example.com/private/public/x"))
+        self.assertFalse(rules.allowed("https://example.com/files/a.pdf"))
+        self.assertTrue(rules.allowed("https://example.com/files/a.pdf?x=1"))
+        self.assertTrue(rules.allowed("https://example.com/"))
+        self.assertEqual(rules.crawl_delay, 2)
+        self.assertEqual(rules.sitemaps, ["https://example.com/sitemap.xml"])
+        self.assertFalse(parse_robots(text, "py-downloader/1.0").allowed("https://example.com/"))
+
+    def test_fetch_error(self):
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.url.path)
+            if len(calls) == 1: raise RuntimeError("broken transport")
+            return httpx.Response(200, text="User-agent: *\nDisallow: /private\n")
+
+        async def lookup() -> tuple[bool, bool]:
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                robots = RobotsCache(client)
+                # an unexpected error fails the lookup without blocking later ones
+                with self.assertRaises(RuntimeError):
+                    await robots.rules("http://a.test/")
+                self.assertEqual(robots.fetching, {})
+                rules = await asyncio.wait_for(robots.rules("http://a.test/"), 1)
+                return rules.allowed("http://a.test/"), rules.allowed("http://a.test/private")
+
+        self.assertEqual(asyncio.run(lookup()), (True, False))
+
+
+class TestSitemap(unittest.TestCase):
+    def test_parser(self):
+        data = gzip.compress(
+            b"<urlset><url><loc> http://a.test/1 </loc><lastmod>2024-01-01</lastmod></url>"
+            b"<url><loc>http://a.test/2</loc></url><url><lastmod>2024-01-01</lastmod></url></urlset>"
+        )
+        parser = SitemapParser()
+        # fed in small chunks, like a streamed response
+        items = [item for i in range(0, len(data), 7) for item in parser.feed(data[i:i + 7])]
+        parser.close()
+        self.assertEqual(items, [("url", SitemapUrl("http://a.test/1", "2024-01-01")), ("url", SitemapUrl("http://a.test/2"))])
+        self.assertEqual(items[0][1].timestamp(), 1704067200.0)
+        self.assertIsNone(SitemapUrl("http://a.test/", "yesterday").timestamp())
+
+        parser = SitemapParser(max_size=100)
+        with self.assertRaises(ValueError):
+            list(parser.feed(b"<urlset>" + b" " * 100))
+
+
+class TestGraph(unittest.TestCase):
+    def test_graph(self):
+        graph = LinkGraph(capacity=2)
+        graph.add_edges("http://a.test/", ["http://a.test/1", "http://a.test/2"])
+        graph.add_edges("http://a.test/2", ["http://a.test/3", "http://a.test/"])
+        graph.add_edges("http://a.test/1", ["http://a.test/3"])
+        graph.id("http://b.test/")
+        self.assertEqual((len(graph), graph.edges), (5, 5))
+
+        with TemporaryDirectory() as directory:
+            path = join(directory, "graph.bin")
+            graph.export(path)
+            with MappedGraph(path) as mapped:
+                for g in (graph, mapped):
+                    self.assertEqual(g.out_links("http://a.test/2"), ["http://a.test/3", "http://a.test/"])
+                    self.assertEqual(g.out_degree("http://a.test/"), 2)
+                    self.assertEqual(g.in_degree("http://a.test/3"), 2)
+                    self.assertEqual(g.depth("http://a.test/3", "http://a.test/"), 2)
+                    self.assertIsNone(g.depth("http://b.test/", "http://a.test/"))
+                    self.assertEqual(g.url(g.get_id("http://a.test/1")), "http://a.test/1")
+                    self.assertIsNone(g.get_id("http://c.test/"))
+                    with self.assertRaises(KeyError):
+                        g.in_degree("http://c.test/")
+            with open(path, "r+b") as file:
+                file.write(b"NOTAGRPH")
+            with self.assertRaises(ValueError):
+                MappedGraph(path)
+
+
+class TestTraps(unittest.TestCase):
+    def test_simhash(self):
+        text = CalendarHandler.events
+        page = simhash(page_features("Day 1 " + text, ["/calendar/2.html"]))
+        next_page = simhash(page_features("Day 2 " + text, ["/calendar/3.html"]))
+        other_page = simhash(page_features("A different page about something else entirely", ["/other.html"]))
+        self.assertLessEqual(hamming_distance(page, next_page), 3)
+        self.assertGreater(hamming_distance(page, other_page), 3)
+
+        index = SimHashIndex(max_distance=3)
+        index.add(page, "/calendar/1.html")
+        self.assertEqual(index.find(next_page), "/calendar/1.html")
+        self.assertEqual(index.find(page ^ 0b1011), "/calendar/1.html")
+        self.assertIsNone(index.find(page ^ 0b1111))
+        self.assertIsNone(index.find(other_page))
+
+    def test_url_template(self):
+        self.assertEqual(url_template("http://a.test/cal/2024/05?day=3&sid=x"), "http://a.test/cal/{n}/{n}?day&sid")
+        self.assertEqual(url_template("http://a.test/s/0123456789abcdef0123/page"), "http://a.test/s/{id}/page")
+        self.assertEqual(url_template("http://a.test/about"), "http://a.test/about")
+
+    def test_detector(self):
+        detector = TrapDetector(min_pages=3, action="down-rank", penalty=10)
+        fingerprint = simhash(page_features(CalendarHandler.events, []))
+        self.assertIsNone(detector.check_page("http://a.test/day/1", fingerprint))
+        self.assertEqual(detector.check_page("http://a.test/day/2", fingerprint), "http://a.test/day/1")
+        self.assertFalse(detector.is_trap("http://a.test/day/3"))
+        detector.check_page("http://a.test/day/3", fingerprint)
+        self.assertTrue(detector.is_trap("http://a.test/day/4"))
+        self.assertFalse(detector.drops("http://a.test/day/4"))
+        self.assertEqual(detector.adjust_score("http://a.test/day/4", 1.0), -9.0)
+        self.assertEqual(detector.adjust_score("http://a.test/other", 1.0), 1.0)
+
+
+class TestParsing(unittest.IsolatedAsyncioTestCase):
+    def test_backends_agree(self):
+        with open("test/websites/testing_website.html", "rb") as f:
+            body = f.read()
+        bs4_result = parse_bs4(body, None, "img", True)
+        links_result = parse_links(body, None, "img", True)
+        self.assertEqual(bs4_result, links_result)
+        self.assertIsNotNone(bs4_result.fingerprint)
+        self.assertEqual(bs4_result.links, ["1.html", "/test/websites/1a.html"])
+        self.assertEqual(len(bs4_result.selected), 6)
+
+    def test_selected_attributes(self):
+        body = b'<a href="x.png">x</a><img src="y.png"><img>'
+        self.assertEqual(parse_bs4(body, None, "a, img").selected, ["x.png", "y.png"])
+        self.assertEqual(parse_bs4(body, None, "a, img", attributes=("src",)).selected, ["y.png"])
+
+    def test_links_backend_selectors(self):
+        with self.assertRaises(ValueError):
+            Parser("links", "div > img", processes=0)
+
+    async def test_process_pool(self):
+        with Parser("links", "img", processes=2, max_in_flight=1) as parser:
+            results = await asyncio.gather(*[parser.parse(b'<a href="x.html"><img src="y.png"></a>') for _ in range(4)])
+        self.assertEqual([(r.links, r.selected) for r in results], [(["x.html"], ["y.png"])] * 4)
+
+
+class TestCrawler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(("localhost", 0), QuietHandler)
+        self.port = self.httpd.server_address[1]
+        self.server_thread = Thread(target=self.httpd.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.server_thread.join()
+        self.httpd.server_close()
+
+    async def test_run(self):
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        async with httpx.AsyncClient() as client:
+            crawler = Crawler(
+                client,
+                urls=[f"http://localhost:{self.port}/test/websites/testing_website.html"],
+                filter=filterer,
+                workers=4,
+                max_depth=3,
+                max_sites=-1,
+                host_rate=100,
+                max_per_host=4,
+                parser=Parser("bs4", "img", processes=2),
+                graph=LinkGraph(),
+            )
+            await crawler.run()
+            crawler.parser.close()
+
+        self.assertEqual(crawler.selected, {f"http://localhost:{self.port}/test/wikipedia.png"})
+        pages = sorted(url.rsplit("/", 1)[1] for url in crawler.seen)
+        self.assertEqual(pages, ["1.html", "1a.html", "2.html", "2a.html", "3.html", "loopback.html", "testing_website.html"])
+        base = f"http://localhost:{self.port}/test/websites/"
+        self.assertEqual(crawler.graph.out_links(base + "testing_website.html"), [base + "1.html", base + "1a.html"])
+        self.assertEqual(crawler.graph.depth(base + "2.html", base + "testing_website.html"), 2)
+
+    async def test_resume(self):
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        start = f"http://localhost:{self.port}/test/websites/testing_website.html"
+        with TemporaryDirectory() as directory:
+            path = join(directory, "state.db")
+            async with httpx.AsyncClient() as client:
+                # a crawl that is stopped part of the way through
+                crawler = Crawler(client, [start], filterer, 1, 3, -1, host_rate=10, parser=Parser(processes=0), state=path)
+                with self.assertRaises(TimeoutError):
+                    await asyncio.wait_for(crawler.run(), 0.25)
+                crawled_first = crawler.parsed
+                crawler.close()
+
+                crawler = Crawler(client, [start], filterer, 4, 3, -1, host_rate=100, parser=Parser(processes=0), state=path)
+                await crawler.run()
+
+            pages = sorted(url.rsplit("/", 1)[1] for url in crawler.seen)
+            statuses = crawler.state.conn.execute("SELECT status FROM urls WHERE state = ?", (DONE,)).fetchall()
+            selected = list(crawler.selected)
+            crawler.close()
+
+        self.assertGreater(crawled_first, 0)
+        self.assertLess(crawled_first, 6)
+        self.assertEqual(pages, ["1.html", "1a.html", "2.html", "2a.html", "3.html", "loopback.html", "testing_website.html"])
+        # 3.html is found at the maximum depth and is not crawled
+        self.assertEqual(statuses, [(200,)] * 6)
+        self.assertEqual(crawled_first + crawler.parsed, 6)
+        self.assertEqual(selected, [])
+
+    async def test_response_cache(self):
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        start = f"http://localhost:{self.port}/test/websites/testing_website.html"
+        with TemporaryDirectory() as directory:
+            cache = ResponseCache(join(directory, "cache.db"))
+            crawlers = []
+            async with httpx.AsyncClient() as client:
+                for _ in range(2):
+                    crawler = Crawler(client, [start], filterer, 4, 3, -1, host_rate=100, parser=Parser(processes=0), cache=cache)
+                    await crawler.run()
+                    crawlers.append(crawler)
+            cache.close()
+
+        first, second = crawlers
+        self.assertEqual(first.not_modified, 0)
+        # SimpleHTTPRequestHandler answers If-Modified-Since with 304 Not Modified
+        self.assertEqual(second.not_modified, 6)
+        self.assertEqual(second.seen, first.seen)
+
+    async def test_robots(self):
+        self.httpd.RequestHandlerClass = RobotsHandler
+        RobotsHandler.requested = []
+        async with httpx.AsyncClient() as client:
+            filterer = UrlFilterer(
+                lambda x: x == f"localhost:{self.port}",
+                lambda x: x in ["http", "https"],
+                lambda x: x in [".html", ""],
+                robots=RobotsCache(client),
+            )
+            start = f"http://localhost:{self.port}/test/websites/testing_website.html"
+            crawler = Crawler(client, [start], filterer, 4, 3, -1, host_rate=100, parser=Parser(processes=0))
+            await crawler.run()
+
+        pages = sorted(url.rsplit("/", 1)[1] for url in crawler.seen)
+        self.assertEqual(pages, ["1.html", "1a.html", "loopback.html"])
+        self.assertEqual(RobotsHandler.requested.count("/robots.txt"), 1)
+        self.assertFalse(any(path.startswith("/test/websites/2") for path in RobotsHandler.requested))
+
+    async def test_pipelined_downloads(self):
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        start = f"http://localhost:{self.port}/test/websites/testing_website.html"
+        image = f"http://localhost:{self.port}/test/wikipedia.png"
+        with TemporaryDirectory() as directory:
+            async with httpx.AsyncClient() as client, DownloadQueue(directory, workers=2, maxsize=1) as downloads:
+                crawler = Crawler(client, [start], filterer, 4, 4, -1, host_rate=100, parser=Parser("bs4", "img", processes=0), downloads=downloads)
+                await crawler.run()
+            files = os.listdir(directory)
+
+            # a budget smaller than the image skips it
+            async with DownloadQueue(directory, budget=Budget(max_bytes=1000)) as downloads:
+                await downloads.put(image)
+            too_large = downloads.results
+            async with DownloadQueue(directory, budget=Budget(max_files=1)) as downloads:
+                await downloads.put(image)
+                await downloads.put(image)
+            statuses = sorted(result.status for result in downloads.results)
+
+        self.assertEqual([(result.url, result.status) for result in crawler.downloads.results], [(image, "downloaded")])
+        self.assertEqual(files, ["wikipedia.png"])
+        self.assertEqual([result.status for result in too_large], ["skipped"])
+        self.assertEqual(statuses, ["downloaded", "skipped"])
+
+    async def test_metrics(self):
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        start = f"http://localhost:{self.port}/test/websites/testing_website.html"
+        metrics = Metrics()
+        summary = io.StringIO()
+        with TemporaryDirectory() as directory:
+            lines = join(directory, "metrics.jsonl")
+            with Reporter(metrics, [JsonLinesSink(lines), SummarySink(summary)], interval=60):
+                async with httpx.AsyncClient() as client, DownloadQueue(directory, metrics=metrics) as downloads:
+                    crawler = Crawler(
+                        client, [start], filterer, 4, 3, -1, host_rate=100,
+                        parser=Parser("bs4", "img", processes=0), downloads=downloads, metrics=metrics,
+                    )
+                    await crawler.run()
+            with open(lines) as file:
+                snapshot = json.loads(file.readline())
+
+        host = f"localhost:{self.port}"
+        # 6 pages and the image
+        self.assertEqual(metrics.total("requests"), 7)
+        self.assertEqual(metrics.counters[("downloads", (("host", host), ("status", "downloaded")))], 1)
+        self.assertEqual(metrics.histogram("ttfb_seconds").count, 7)
+        self.assertEqual(metrics.histogram("parse_seconds").count, 6)
+        self.assertEqual(metrics.histogram("queue_wait_seconds").count, 6)
+        self.assertGreater(metrics.histogram("connect_seconds").count, 0)
+        self.assertEqual(metrics.total("bytes_written"), os.path.getsize(join("test", "wikipedia.png")))
+        self.assertIn("7 requests", summary.getvalue())
+        self.assertIn({"name": "requests", "labels": {"host": host, "status": "200"}, "value": 7}, snapshot["counters"])
+
+        server = serve_prometheus(metrics, port=0)
+        try:
+            async with httpx.AsyncClient() as client:
+                text = (await client.get(f"http://localhost:{server.server_address[1]}/metrics")).text
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn(f'requests{{host="{host}",status="200"}} 7', text)
+        self.assertIn('parse_seconds_bucket{le="+Inf"} 6', text)
+
+        NULL_METRICS.inc("requests")
+        self.assertEqual(NULL_METRICS.total("requests"), 0)
+
+    async def test_sitemap(self):
+        self.httpd.RequestHandlerClass = SitemapHandler
+        base = f"http://localhost:{self.port}/test/websites/"
+        async with httpx.AsyncClient() as client:
+            urls = [item async for item in sitemap_urls(client, f"http://localhost:{self.port}/")]
+            self.assertEqual(sorted(urls, key=lambda item: item.loc), [
+                SitemapUrl(base + "2a.html", "2024-01-01T12:00:00+00:00"),
+                SitemapUrl(base + "3.html", "2024-01-02"),
+                SitemapUrl(base + "loopback.html"),
+            ])
+
+            filterer = UrlFilterer(
+                lambda x: x == f"localhost:{self.port}",
+                lambda x: x in ["http", "https"],
+                lambda x: x in [".html", ""],
+            )
+            # at a maximum depth of 1 only the start page and the pages from the sitemaps are crawled
+            crawler = Crawler(client, [base + "testing_website.html"], filterer, 4, 1, -1, host_rate=100, parser=Parser(processes=0))
+            await crawler.run(sitemap_urls(client, base))
+
+        pages = sorted(url.rsplit("/", 1)[1] for url in crawler.seen)
+        # 3.html also links to its directory
+        self.assertEqual(pages, ["", "1.html", "1a.html", "2a.html", "3.html", "loopback.html", "testing_website.html"])
+        self.assertEqual(crawler.parsed, 4)
+
+
+    async def test_retries(self):
+        self.httpd.RequestHandlerClass = FlakyHandler
+        FlakyHandler.failed.clear()
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        health = HostHealth(RetryPolicy(base_delay=0.01), failure_threshold=100)
+        async with httpx.AsyncClient() as client:
+            crawler = Crawler(
+                client, [f"http://localhost:{self.port}/test/websites/testing_website.html"], filterer, 4, 3, -1,
+                host_rate=1_000, max_per_host=4, parser=Parser(processes=0), health=health,
+            )
+            await crawler.run()
+
+        # every page failed once and was crawled on its second attempt
+        pages = sorted(url.rsplit("/", 1)[1] for url in crawler.seen)
+        self.assertEqual(pages, ["1.html", "1a.html", "2.html", "2a.html", "3.html", "loopback.html", "testing_website.html"])
+        self.assertEqual(crawler.parsed, 6)
+        self.assertEqual(crawler.attempts, {})
+
+    async def test_traps(self):
+        self.httpd.RequestHandlerClass = CalendarHandler
+        filterer = UrlFilterer(
+            lambda x: x == f"localhost:{self.port}",
+            lambda x: x in ["http", "https"],
+            lambda x: x in [".html", ""],
+        )
+        async with httpx.AsyncClient() as client:
+            crawler = Crawler(
+                client, [f"http://localhost:{self.port}/calendar/1.html"], filterer, 1, 1_000, -1, host_rate=1_000,
+                parser=Parser(processes=0, fingerprint=True), traps=TrapDetector(min_pages=4),
+            )
+            await crawler.run()
+
+        # the days after the first are the same page, so their links are not followed
+        days = [url for url in crawler.seen if "/calendar/" in url]
+        self.assertEqual(len(days), 4)
+        self.assertEqual(crawler.duplicates, 3)
+        self.assertTrue(crawler.traps.is_trap(f"http://localhost:{self.port}/calendar/100.html"))
+        self.assertIn(f"http://localhost:{self.port}/test/websites/2.html", crawler.seen)
+
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        # listening on all addresses, so every 127.0.0.x is a different host of the same server
+        self.httpd = ThreadingHTTPServer(("", 0), HostsHandler)
+        self.port = self.httpd.server_address[1]
+        self.server_thread = Thread(target=self.httpd.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.server_thread.join()
+        self.httpd.server_close()
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of("http://a.test/1", 4), shard_of("http://A.test/2?x", 4))
+        self.assertEqual(len({shard_of(f"http://{i}.test/", 4) for i in range(100)}), 4)
+
+    def test_sharded_crawl(self):
+        start = f"http://127.0.0.1:{self.port}/pages/0.html"
+        options = {"host_rate": 1_000, "max_per_host": 4, "selector": "img"}
+        result = crawl_sharded([start], any_host_filter, shards=3, workers=4, max_depth=100, **options)
+        hosts, pages = HostsHandler.hosts, HostsHandler.pages
+        self.assertEqual(result.urls, {f"http://127.0.0.{host + 1}:{self.port}/pages/{page}.html" for host in range(hosts) for page in range(pages)})
+        self.assertEqual((result.parsed, result.admitted), (hosts * pages, hosts * pages))
+        self.assertEqual(len(result.selected), hosts * pages)
+        self.assertEqual(sum(shard["parsed"] for shard in result.shards), hosts * pages)
+
+        # the depth and the number of sites are limited over all shards
+        result = crawl_sharded([start], any_host_filter, shards=3, workers=4, max_depth=3, address=("127.0.0.1", 0), **options)
+        self.assertEqual(result.parsed, 6)  # 1 page at depth 0, 2 at depth 1, 3 at depth 2
+        result = crawl_sharded([start], any_host_filter, shards=3, workers=4, max_depth=100, max_sites=12, **options)
+        self.assertLessEqual(result.admitted, 12)
+        self.assertEqual(len(result.urls), result.admitted)
+
+
+if __name__ == "__main__":
+    unittest.main()
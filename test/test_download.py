@@ -11,18 +11,111 @@ itself after ^C; kill it using task manager or through `kill -9 <PID>`.
 """
 
 
-from os import makedirs, remove, rmdir
-from os.path import isfile, join
+from os import listdir, makedirs, remove, rmdir, stat
+from os.path import basename, isfile, join
+import json
+import shutil
+from tempfile import TemporaryDirectory
 from http.server import  SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from socketserver import TCPServer, ThreadingTCPServer
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
+from time import perf_counter, sleep
 import unittest
 
-from src.file_downloader import download
+import requests
+
+from src.content_index import ContentIndex
+from src.file_downloader import DirectoryIndex, download, download_file, download_many, part_path
+from src.health import HostHealth, RetryPolicy
+from src.probe import cached, clear_cache, probe_many
 from src.simple_crawler import crawl
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler that also answers requests with a `Range: bytes=<start>-<end>` header.
+    """
+    requested_ranges = []
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_GET(self):
+        byte_range = self.headers.get("Range")
+        if byte_range is None: return super().do_GET()
+        start, end = map(int, byte_range.removeprefix("bytes=").split("-"))
+        RangeRequestHandler.requested_ranges.append((start, end))
+        with open(self.translate_path(self.path), "rb") as f:
+            data = f.read()
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NoLengthHeadHandler(RangeRequestHandler):
+    """
+    Request handler that does not report the size of files in responses to HEAD requests.
+    """
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(self.path))
+        self.end_headers()
+
+
+class FlakyRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler which answers the first request for every path with 500 Internal Server Error.
+    """
+    failed = set()
+
+    def do_GET(self):
+        if self.path in FlakyRequestHandler.failed: return super().do_GET()
+        FlakyRequestHandler.failed.add(self.path)
+        self.send_response(500)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler which waits a second before answering, like a host that hangs.
+    """
+    def do_GET(self):
+        sleep(1)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InterferingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler which creates a file at `target` after sending the headers of a response and before its body,
+    like another program saving a file under the name a download was going to use.
+    """
+    target = None
+
+    def copyfile(self, source, outputfile):
+        sleep(0.2)
+        with open(InterferingRequestHandler.target, "wb") as f:
+            f.write(b"other")
+        super().copyfile(source, outputfile)
+
+    def log_message(self, format, *args):
+        pass
+
+
 class TestDownload(unittest.TestCase):
     def test_download(self):
         PORT = randint(1_000, 10_000)
@@ -81,6 +174,408 @@ class TestDownload(unittest.TestCase):
         print("Finished!")
         print("=" * 15)
     
+    def test_download_many(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            path = join("test", "test_downloads")
+            try:
+                results = download_many([url] * 6, path, "Edit name", workers=6, per_host=3)
+                downloaded_files = []
+                print("Removing downloaded files...")
+                for result in results:
+                    if result.path is None or not isfile(result.path): continue
+                    with open(result.path, mode="rb") as f:
+                        downloaded_files.append(f.read())
+                    remove(result.path)
+                # the names of the removed files are free again for the next batch
+                again = download_many([url] * 2, path, "Edit name", workers=2)
+                for result in again:
+                    if result.path is not None and isfile(result.path): remove(result.path)
+                outcome["results"] = results
+                outcome["downloaded_files"] = downloaded_files
+                outcome["again"] = sorted(result.path for result in again)
+            finally:
+                httpd.shutdown()
+
+        makedirs(join("test", "test_downloads"), exist_ok=True)
+
+        addr = ("", PORT)
+        with TCPServer(addr, SimpleHTTPRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+        rmdir(join("test", "test_downloads"))
+
+        with open(join("test", "wikipedia.png"), mode='rb') as f:
+            correct_file = f.read()
+        results = outcome["results"]
+        path = join("test", "test_downloads")
+        self.assertEqual(outcome["again"], [join(path, "wikipedia (1).png"), join(path, "wikipedia.png")])
+        self.assertEqual([result.status for result in results], ["downloaded"] * 6)
+        self.assertEqual(len({result.path for result in results}), 6)
+        self.assertEqual(outcome["downloaded_files"], [correct_file] * 6)
+        self.assertEqual([result.size for result in results], [len(correct_file)] * 6)
+        self.assertTrue(all(result.mb_per_s > 0 for result in results))
+
+    def test_same_name(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer, sources: str):
+            urls = [f"http://localhost:{PORT}/{sources}/{folder}/x.png".replace("\\", "/") for folder in "ab"]
+            try:
+                for override in ["Skip", "Strict", "Write over"]:
+                    with TemporaryDirectory() as path:
+                        results = download_many(urls, path, override, workers=2)
+                        with open(join(path, "x.png"), "rb") as f:
+                            content = f.read()
+                        outcome[override] = sorted(result.status for result in results), listdir(path), content, results
+            finally:
+                httpd.shutdown()
+
+        with TemporaryDirectory(dir="test") as sources:
+            # two different files with the same name, downloaded in parallel
+            for folder in "ab":
+                makedirs(join(sources, folder))
+                with open(join(sources, folder, "x.png"), "wb") as f:
+                    f.write(folder.encode() * 100_000)
+
+            addr = ("", PORT)
+            with TCPServer(addr, SimpleHTTPRequestHandler) as httpd:
+                server_thread = Thread(target=httpd.serve_forever)
+                tests_thread = Thread(target=testing_func, args=(httpd, sources))
+
+                server_thread.start()
+                tests_thread.start()
+
+                tests_thread.join()
+                server_thread.join()
+
+        # the downloads are handled as if they ran one after another
+        contents = [b"a" * 100_000, b"b" * 100_000]
+        statuses, files, content, _ = outcome["Skip"]
+        self.assertEqual((statuses, files), (["downloaded", "skipped"], ["x.png"]))
+        self.assertIn(content, contents)
+        statuses, files, content, results = outcome["Strict"]
+        self.assertEqual((statuses, files), (["downloaded", "failed"], ["x.png"]))
+        self.assertIn(content, contents)
+        self.assertTrue(any(isinstance(result.error, FileExistsError) for result in results))
+        statuses, files, content, _ = outcome["Write over"]
+        self.assertEqual((statuses, files), (["downloaded", "downloaded"], ["x.png"]))
+        self.assertIn(content, contents)
+
+    def test_created_during_download(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            try:
+                for override in ["Edit name", "Skip", "Strict"]:
+                    with TemporaryDirectory() as path:
+                        InterferingRequestHandler.target = join(path, "wikipedia.png")
+                        [result] = download_many([url], path, override)
+                        with open(join(path, "wikipedia.png"), "rb") as f:
+                            content = f.read()
+                        outcome[override] = result, sorted(listdir(path)), content
+            finally:
+                httpd.shutdown()
+
+        addr = ("", PORT)
+        with TCPServer(addr, InterferingRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+
+        # the file created by the other program is never replaced
+        result, files, content = outcome["Edit name"]
+        self.assertEqual((result.status, files, content), ("downloaded", ["wikipedia (1).png", "wikipedia.png"], b"other"))
+        self.assertEqual(basename(result.path), "wikipedia (1).png")
+        result, files, content = outcome["Skip"]
+        self.assertEqual((result.status, files, content), ("skipped", ["wikipedia.png"], b"other"))
+        result, files, content = outcome["Strict"]
+        self.assertEqual((result.status, files, content), ("failed", ["wikipedia.png"], b"other"))
+        self.assertIsInstance(result.error, FileExistsError)
+
+    def test_segmented_download(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+        with open(join("test", "wikipedia.png"), mode='rb') as f:
+            correct_file = f.read()
+        size = len(correct_file)
+        half = size // 2
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            path = join("test", "test_downloads")
+            download_path = join(path, "wikipedia.png")
+            partial_path = part_path(download_path, url)
+            try:
+                # pretend an earlier run was interrupted after downloading the first half of the file
+                validator = requests.head(url).headers.get("Last-Modified")
+                with open(partial_path, "wb") as f:
+                    f.write(correct_file[:half] + bytes(size - half))
+                with open(partial_path + ".json", "w") as f:
+                    json.dump({"url": url, "size": size, "validator": validator, "segments": [[0, half - 1, half], [half, size - 1, 0]]}, f)
+
+                RangeRequestHandler.requested_ranges = []
+                outcome["ok"] = download(url, path, None, "Edit name", segments=2)
+
+                with open(download_path, mode="rb") as f:
+                    outcome["downloaded_file"] = f.read()
+                outcome["requested_ranges"] = RangeRequestHandler.requested_ranges
+                # an existing file is skipped before any segment is requested
+                RangeRequestHandler.requested_ranges = []
+                outcome["skipped"] = download_file(url, path, None, "Skip", segments=2).status
+                outcome["skipped_ranges"] = RangeRequestHandler.requested_ranges
+                remove(download_path)
+                outcome["files"] = listdir(path)
+            finally:
+                httpd.shutdown()
+
+        makedirs(join("test", "test_downloads"), exist_ok=True)
+
+        addr = ("", PORT)
+        with TCPServer(addr, RangeRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+        rmdir(join("test", "test_downloads"))
+
+        self.assertTrue(outcome["ok"])
+        self.assertEqual(outcome["downloaded_file"], correct_file)
+        self.assertEqual(outcome["requested_ranges"], [(half, size - 1)])
+        self.assertEqual(outcome["files"], [])
+        self.assertEqual(outcome["skipped"], "skipped")
+        self.assertEqual(outcome["skipped_ranges"], [])
+
+    def test_segmented_same_name(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+        contents = {folder: bytes(range(256)) * 400 + folder.encode() * 1_000 for folder in "ab"}
+
+        def testing_func(httpd: TCPServer, sources: str):
+            urls = [f"http://localhost:{PORT}/{sources}/{folder}/x.png" for folder in "ab"]
+            try:
+                with TemporaryDirectory() as path:
+                    # two different files with the same name are downloaded in segments at the same time
+                    results = download_many(urls * 2, path, "Edit name", workers=4, segments=4)
+                    outcome["statuses"] = [result.status for result in results]
+                    files = []
+                    for result in results:
+                        with open(result.path, "rb") as f:
+                            files.append(f.read())
+                    outcome["files"] = files
+                    outcome["names"] = sorted(listdir(path))
+            finally:
+                httpd.shutdown()
+
+        with TemporaryDirectory(dir="test") as sources:
+            for folder, content in contents.items():
+                makedirs(join(sources, folder))
+                with open(join(sources, folder, "x.png"), "wb") as f:
+                    f.write(content)
+
+            addr = ("", PORT)
+            with ThreadingTCPServer(addr, RangeRequestHandler) as httpd:
+                server_thread = Thread(target=httpd.serve_forever)
+                tests_thread = Thread(target=testing_func, args=(httpd, sources))
+
+                server_thread.start()
+                tests_thread.start()
+
+                tests_thread.join()
+                server_thread.join()
+
+        self.assertEqual(outcome["statuses"], ["downloaded"] * 4)
+        self.assertEqual(outcome["files"], [contents["a"], contents["b"]] * 2)
+        self.assertEqual(outcome["names"], ["x (1).png", "x (2).png", "x (3).png", "x.png"])
+
+    def test_content_index(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            copy_url = f"http://localhost:{PORT}/test/test_downloads/copy.png"
+            with TemporaryDirectory() as path:
+                index = ContentIndex(join(path, "index.db"))
+                first = download_file(url, path, index=index)
+                # SimpleHTTPRequestHandler answers If-Modified-Since with 304 Not Modified
+                again = download_file(url, path, index=index)
+                # the same content from another url is hardlinked
+                copy = download_file(copy_url, path, index=index)
+                outcome["statuses"] = [first.status, again.status, copy.status]
+                outcome["again_path"] = again.path == first.path
+                outcome["linked"] = stat(first.path).st_ino == stat(copy.path).st_ino
+                index.close()
+
+                same = download_file(url, path, override="Skip if same")
+                with open(join(path, "wikipedia.png"), "wb") as f:
+                    f.write(b"different content")
+                different = download_file(url, path, override="Skip if same")
+                outcome["skip_if_same"] = [same.status, different.status]
+                outcome["files"] = sorted(name for name in listdir(path) if not name.startswith("index.db"))
+            httpd.shutdown()
+
+        makedirs(join("test", "test_downloads"), exist_ok=True)
+        shutil.copy(join("test", "wikipedia.png"), join("test", "test_downloads", "copy.png"))
+
+        addr = ("", PORT)
+        with TCPServer(addr, SimpleHTTPRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+        remove(join("test", "test_downloads", "copy.png"))
+        rmdir(join("test", "test_downloads"))
+
+        self.assertEqual(outcome["statuses"], ["downloaded", "skipped", "downloaded"])
+        self.assertTrue(outcome["again_path"])
+        self.assertTrue(outcome["linked"])
+        self.assertEqual(outcome["skip_if_same"], ["skipped", "downloaded"])
+        self.assertEqual(outcome["files"], ["copy.png", "wikipedia (1).png", "wikipedia.png"])
+
+    def test_retries(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            with TemporaryDirectory() as path:
+                outcome["without_health"] = download_file(url, path).status
+                FlakyRequestHandler.failed.clear()
+                health = HostHealth(RetryPolicy(base_delay=0.01))
+                outcome["with_health"] = download_file(url, path, health=health).status
+                outcome["error_rate"] = health.stats(f"localhost:{PORT}").error_rate
+            httpd.shutdown()
+
+        addr = ("", PORT)
+        with TCPServer(addr, FlakyRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+
+        self.assertEqual(outcome["without_health"], "failed")
+        self.assertEqual(outcome["with_health"], "downloaded")
+        self.assertGreater(outcome["error_rate"], 0)
+
+    def test_timeout(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+
+        def testing_func(httpd: TCPServer):
+            url = f"http://localhost:{PORT}/test/wikipedia.png"
+            with TemporaryDirectory() as path:
+                start = perf_counter()
+                results = download_many([url], path, timeout=(1, 0.1))
+                outcome["seconds"] = perf_counter() - start
+                outcome["error"] = results[0].error
+            httpd.shutdown()
+
+        addr = ("", PORT)
+        with TCPServer(addr, SlowRequestHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+
+        self.assertIsInstance(outcome["error"], requests.Timeout)
+        self.assertLess(outcome["seconds"], 1)
+
+    def test_directory_index(self):
+        with TemporaryDirectory() as path:
+            for name in ["a.png", "a (1).png", "a (2).png"]:
+                open(join(path, name), "w").close()
+            index = DirectoryIndex(path)
+            self.assertEqual(index.free_name("a.png"), "a (3).png")
+            # a file created by someone else after the directory was scanned
+            open(join(path, "a (3).png"), "w").close()
+            self.assertEqual(index.claim_copy("a.png"), "a (4).png")
+            index.release("a (4).png")
+            # claims are not written to the directory, so a download that dies leaves nothing behind
+            self.assertFalse(isfile(join(path, "a (4).png")))
+            self.assertFalse(index.claim("a.png"))
+            self.assertTrue(index.claim("b.png"))
+            self.assertFalse(index.claim("b.png"))
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                names = list(executor.map(lambda _: index.claim_copy("a.png"), range(50)))
+            self.assertEqual(sorted(names), sorted(f"a ({i}).png" for i in range(4, 54)))
+            self.assertEqual(len(listdir(path)), 4)
+            with self.assertRaises(ValueError):
+                index.free_name("a")
+
+    def test_probe(self):
+        PORT = randint(1_000, 10_000)
+        outcome = {}
+        url = f"http://localhost:{PORT}/test/wikipedia.png"
+        missing = f"http://localhost:{PORT}/test/missing.png"
+
+        def testing_func(httpd: TCPServer):
+            try:
+                clear_cache()
+                outcome["infos"] = probe_many([url, missing, url], workers=2, timeout=5)
+                outcome["cached"] = cached(url)
+                outcome["cached_missing"] = cached(missing)
+            finally:
+                httpd.shutdown()
+
+        addr = ("", PORT)
+        with TCPServer(addr, NoLengthHeadHandler) as httpd:
+            server_thread = Thread(target=httpd.serve_forever)
+            tests_thread = Thread(target=testing_func, args=([httpd]))
+
+            server_thread.start()
+            tests_thread.start()
+
+            tests_thread.join()
+            server_thread.join()
+
+        with open(join("test", "wikipedia.png"), mode='rb') as f:
+            correct_size = len(f.read())
+        infos = outcome["infos"]
+        self.assertEqual(list(infos), [url, missing])
+        self.assertEqual(infos[url].size, correct_size)
+        self.assertEqual(infos[url].content_type, "image/png")
+        self.assertTrue(infos[url].accept_ranges)
+        self.assertIsNone(infos[missing].size)
+        self.assertIsNone(infos[missing].content_type)
+        # error responses are not cached, so the url is probed again later
+        self.assertEqual(outcome["cached"], infos[url])
+        self.assertIsNone(outcome["cached_missing"])
+
     def test_crawl(self):
         PORT = randint(1_000, 10_000)
 